@@ -0,0 +1,62 @@
+import os
+import sys
+import json
+import time
+import subprocess
+
+# helpers shared by the test scripts, run from this directory or as
+# python3 test/<script>.py
+
+N = 10
+script = os.path.join(os.path.dirname(__file__), '..', 'scripts', 'zchecker')
+
+
+def timeit(f, n=N):
+    """Mean wall-clock time of `f()`, ms."""
+    t0 = time.monotonic()
+    for i in range(n):
+        f()
+    return (time.monotonic() - t0) / n * 1000
+
+
+def command(config, *args):
+    """Run a zchecker command in a new process."""
+    subprocess.run([sys.executable, script, '--config', config] + list(args),
+                   check=True, stdout=subprocess.DEVNULL)
+
+
+def configure(path, url=None, **kwargs):
+    """Write a configuration file for a temporary directory.
+
+    Parameters
+    ----------
+    path : string
+      Directory for the configuration, database, and cutouts.
+    url : string, optional
+      Stand-in server URL, for IRSA and Horizons.
+    **kwargs
+      Additional configuration keys, with underscores for spaces,
+      e.g., cutout_format='rice'.
+
+    Returns
+    -------
+    config : string
+      Configuration file name.
+
+    """
+
+    config = os.path.join(path, 'zchecker.config')
+    parameters = {'database': os.path.join(path, 'zchecker.db'),
+                  'log': '/dev/null', 'user': '', 'password': '',
+                  'cutout path': path}
+    if url is not None:
+        parameters.update({
+            'irsa url': url,
+            'horizons url': url + '/api/horizons.api',
+            'rate limits': {'irsa': {'rate': 0}, 'horizons': {'rate': 0}}})
+    for k, v in kwargs.items():
+        parameters[k.replace('_', ' ')] = v
+
+    with open(config, 'w') as outf:
+        json.dump(parameters, outf)
+    return config
@@ -0,0 +1,127 @@
+import io
+import os
+import tempfile
+from multiprocessing import Pool
+from contextlib import redirect_stdout
+import numpy as np
+from zchecker import ZChecker, Config, standin, project, cube
+from zchecker.stack import combine
+from common import configure
+
+# the projected cutout store: planes are appended, overwritten in
+# place when reprojected, and rebuilt from the archive; stacks from
+# the store equal stacks from the cutout files
+
+dates = ('2018-01-31', '2018-02-01', '2018-02-02')
+objects = ['C/2017 AB{}'.format(i) for i in range(40)]
+plane_size = cube.SHAPE[0] * cube.SHAPE[1]
+
+
+def image(v):
+    return np.full(cube.SHAPE, v, np.float32)
+
+
+def sizes(c):
+    return [os.path.getsize(fn) for fn in c.files]
+
+
+# 1. CutoutCube
+with tempfile.TemporaryDirectory() as path:
+    c = cube.CutoutCube(path, 'C/2017 AB0')
+    assert len(c) == 0 and len(c.cube()[0]) == 0
+
+    # a mask left by an interrupted first append is replaced
+    os.makedirs(c.path)
+    with open(c.files[1], 'wb') as outf:
+        outf.write(b'\x01' * plane_size * 2)
+    assert [c.append(image(i)) for i in range(3)] == [0, 1, 2]
+    assert sizes(c) == [plane_size * 4 * 3, plane_size * 3]
+
+    # overwrite in place, later planes are kept
+    mask = np.zeros(cube.SHAPE, int)
+    mask[:, :10] = 4
+    assert c.append(image(10), mask, plane=1) == 1
+    assert c.append(image(20), plane=0) == 0
+    images, masks = c.cube()
+    assert [images[i, 0, 0] for i in range(3)] == [20, 10, 2]
+    assert masks[1].sum() == 10 * cube.SHAPE[0]
+    assert masks[0].sum() == masks[2].sum() == 0
+    assert sizes(c) == [plane_size * 4 * 3, plane_size * 3]
+
+    # a plane not in the cube is appended
+    assert c.append(image(3), plane=5) == 3
+    assert len(c) == 4
+
+    # an image left by an interrupted append is replaced
+    with open(c.files[0], 'ab') as outf:
+        outf.write(b'\x00' * 100)
+    assert c.append(image(4)) == 4
+    assert sizes(c) == [plane_size * 4 * 5, plane_size * 5]
+    c.clear()
+    assert len(c) == 0
+
+
+# 2. the store, filled by zproject
+def stacks(z, foundids, path):
+    return [combine(z, foundids, scale_by, path).data
+            for scale_by in ('coma', 'surface')]
+
+
+def equal(a, b):
+    return all([np.array_equal(x, y, equal_nan=True) for x, y in zip(a, b)])
+
+
+with tempfile.TemporaryDirectory() as path:
+    irsa = standin.start()
+    cube_path = os.path.join(path, 'cube')
+    # read now, both write zchecker.config
+    files = Config(configure(path, irsa.url))
+    config = Config(configure(path, irsa.url, cube_path=cube_path))
+
+    with redirect_stdout(io.StringIO()), Pool(2) as pool:
+        with ZChecker(config) as z:
+            for date in dates:
+                z.update_obs(date)
+            z.update_ephemeris(objects, '2018-01-30', '2018-02-03')
+            z.fov_search(dates[0], dates[-1], objects=objects)
+            z.download_cutouts()
+            project.process(z, pool, project.pending(z))
+
+            desg, n = z.db.execute('''
+            SELECT desg,count() FROM found GROUP BY desg
+            ORDER BY count() DESC''').fetchone()
+            foundids = [row[0] for row in z.db.execute(
+                'SELECT foundid FROM found WHERE desg=?', [desg])]
+            c = cube.CutoutCube(cube_path, desg)
+            planes = cube.planes(z.db, foundids)
+            assert n > 2
+            assert len(c) == n
+            assert sorted(planes.values()) == list(range(n))
+
+        # stacks from the cube and from the files
+        with ZChecker(files) as z:
+            expected = stacks(z, foundids, path)
+        with ZChecker(config) as z:
+            assert equal(stacks(z, foundids, path), expected)
+
+            # reprojected images keep their planes
+            project.process(z, pool, project.pending(z, force=True))
+            assert len(c) == n
+            assert cube.planes(z.db, foundids) == planes
+            assert equal(stacks(z, foundids, path), expected)
+
+            # deleted images leave planes until the cube is rebuilt
+            z.db.execute('DELETE FROM found WHERE foundid=?', [foundids[0]])
+            z.db.commit()
+            assert len(c) == n
+            assert cube.rebuild(z.db, cube_path, path, desg) == n - 1
+            assert len(c) == n - 1
+            planes = cube.planes(z.db, foundids[1:])
+            assert sorted(planes.values()) == list(range(n - 1))
+            expected = stacks(z, foundids[1:], path)
+        with ZChecker(files) as z:
+            assert equal(stacks(z, foundids[1:], path), expected)
+    irsa.shutdown()
+
+print('Cube planes appended, overwritten, and rebuilt; {} stacks from the'
+      ' cube equal stacks from the files.'.format(desg))
@@ -0,0 +1,75 @@
+import os
+import time
+import tempfile
+import numpy as np
+from astropy.io import fits
+from zchecker import cutout
+
+# write and read times, and file sizes, for each cutout format; data
+# and header keywords are read back, exactly except for the RICE_1
+# science image
+
+N = 50
+shape = (296, 296)
+
+np.random.seed(0)
+y, x = np.indices(shape)
+sci = (np.random.randn(*shape) * 5 + 100
+       + 1000 * np.exp(-((x - 148)**2 + (y - 148)**2) / 8)).astype('f4')
+mask = np.zeros(shape, 'i2')
+mask[:, :10] = 2
+psf = np.random.rand(25, 25).astype('f4')
+header = fits.Header()
+header['DESG'] = 'C/2017 AB0'
+header['TGTX'] = 148
+
+print('{:6} {:>10} {:>10} {:>10} {:>10}'.format(
+    'format', 'size (kB)', 'write (ms)', 'read (ms)', 'mask (ms)'))
+with tempfile.TemporaryDirectory() as path:
+    for fmt in cutout.FORMATS:
+        files = [os.path.join(path, '{}-{}{}'.format(fmt, i,
+                                                     cutout.suffix(fmt)))
+                 for i in range(N)]
+
+        t0 = time.monotonic()
+        for fn in files:
+            hdu = cutout.assemble(sci, header, mask=mask, psf=psf, fmt=fmt)
+            cutout.write(hdu, fn, fmt=fmt)
+        write = (time.monotonic() - t0) / N
+
+        # all extensions
+        t0 = time.monotonic()
+        for fn in files:
+            with fits.open(fn) as hdu:
+                for ext in ['SCI', 'MASK', 'PSF']:
+                    hdu[ext].data.sum()
+        read = (time.monotonic() - t0) / N
+
+        # one extension, memory mapped where possible
+        t0 = time.monotonic()
+        for fn in files:
+            with fits.open(fn, memmap=True) as hdu:
+                hdu['MASK'].data.sum()
+        read_mask = (time.monotonic() - t0) / N
+
+        with fits.open(files[0]) as hdu:
+            assert hdu['SCI'].header['DESG'] == header['DESG'], fmt
+            assert hdu['SCI'].header['TGTX'] == header['TGTX'], fmt
+            assert np.array_equal(hdu['MASK'].data, mask), fmt
+            assert np.array_equal(hdu['PSF'].data, psf), fmt
+            d = hdu['SCI'].data - sci
+            if fmt == 'rice':
+                # quantized at a fraction of the noise, 5
+                assert np.abs(d).max() < 1, fmt
+            else:
+                assert np.all(d == 0), fmt
+
+        size = os.path.getsize(files[0]) / 1024
+        print('{:6} {:10.1f} {:10.2f} {:10.2f} {:10.2f}'.format(
+            fmt, size, write * 1000, read * 1000, read_mask * 1000))
+
+        if fmt == 'rice':
+            # quantization error
+            d = fits.getdata(files[0], 'SCI') - sci
+            print('       RICE_1 science image rms error: {:.3f}'.format(
+                d.std()))
@@ -0,0 +1,67 @@
+import time
+import tempfile
+import numpy as np
+from zchecker import ZChecker, Config
+from common import timeit, configure
+
+# compare queries on the foundcat table with the foundobs view
+
+nights = 100
+quads = 2000
+targets = 500
+found_per_night = 500
+
+
+def query(z, cmd, args=(), n=5):
+    rows = []
+    t = timeit(lambda: rows.append(z.db.execute(cmd, args).fetchall()), n=n)
+    return t, len(rows[-1])
+
+
+with tempfile.TemporaryDirectory() as path:
+    config = configure(path)
+
+    with ZChecker(Config(config)) as z:
+        np.random.seed(0)
+        t0 = time.monotonic()
+        for night in range(nights):
+            z.db.execute('INSERT INTO nights VALUES (?,?,?)',
+                         [night + 1, '2018-{:03d}'.format(night), quads])
+            pid = (night * quads + np.arange(quads)).tolist()
+            jd = (2458150.5 + night + np.linspace(0.1, 0.4, quads)).tolist()
+            z.db.executemany('''
+            INSERT INTO obs (nightid,infobits,field,ccdid,qid,rcid,fid,
+              filtercode,pid,obsjd,filefracday,ra,dec)
+            VALUES (?,0,700,1,2,3,1,'zg',?,?,20180201123456,10,10)
+            ''', [(night + 1, p, j) for p, j in zip(pid, jd)])
+            i = np.random.choice(quads, found_per_night, replace=False)
+            z.db.executemany('''
+            INSERT INTO found (desg,obsjd,ra,dec,vmag,rh,rdot,delta,pid,
+              sciimg)
+            VALUES (?,?,10,10,18,2,1,1,?,1)
+            ''', [('C/2017 AB{}'.format(np.random.randint(targets)),
+                   jd[k], pid[k]) for k in i])
+        z.db.commit()
+        print('{} found rows, {:.1f} s to insert with triggers'.format(
+            nights * found_per_night, time.monotonic() - t0))
+
+        night = nights // 2
+        desg = 'C/2017 AB1'
+        tests = [
+            ('target', 'SELECT foundid,obsjd,filtercode,url FROM {}'
+             ' WHERE desg=?', [desg]),
+            ('night', 'SELECT desg,AVG(rh),AVG(rdot) FROM {}'
+             ' WHERE infobits=0 AND nightid=? GROUP BY desg', [night]),
+            ('baseline', 'SELECT filtercode,foundid FROM {}'
+             ' WHERE desg=? AND obsjd<? AND obsjd>=?',
+             [desg, 2458150.5 + night, 2458150.5 + night - 14]),
+            ('all urls', 'SELECT foundid,url FROM {} ORDER BY pid', []),
+        ]
+
+        print('{:10} {:>12} {:>12} {:>8}'.format(
+            'query', 'view (ms)', 'table (ms)', 'rows'))
+        for name, cmd, args in tests:
+            view, n = query(z, cmd.format('foundobs'), args)
+            table, m = query(z, cmd.format('foundcat'), args)
+            assert n == m
+            print('{:10} {:12.2f} {:12.2f} {:8}'.format(name, view, table, n))
@@ -0,0 +1,53 @@
+import io
+import time
+import tempfile
+from contextlib import redirect_stdout
+from zchecker import ZChecker, Config, standin
+from common import timeit, configure
+
+# single-target "where was it imaged" latency: ZChecker.lookup,
+# read-only, compared with a forced fov_search for the same target
+
+date = '2018-02-01'
+objects = ['C/2017 AB{}'.format(i) for i in range(40)]
+targets = objects[:10]
+
+
+with tempfile.TemporaryDirectory() as path:
+    irsa = standin.start()
+    config = configure(path, irsa.url)
+
+    with redirect_stdout(io.StringIO()):
+        with ZChecker(Config(config)) as z:
+            z.update_obs(date)
+            z.update_ephemeris(objects, '2018-01-31', '2018-02-02')
+
+        lookups = []
+        with ZChecker(Config(config)) as z:
+            t0 = time.monotonic()
+            z.lookup(targets[0], date, date)
+            first = (time.monotonic() - t0) * 1000
+            for desg in targets:
+                rows = z.lookup(desg, date, date, confirm=True)
+                lookups.append((
+                    desg,
+                    timeit(lambda: z.lookup(desg, date, date)),
+                    timeit(lambda: z.lookup(desg, date, date, confirm=True),
+                           n=3),
+                    len(rows)))
+            assert z.db.total_changes == 0
+
+            searches = [
+                timeit(lambda: z.fov_search(date, date, objects=[desg],
+                                            force=True), n=3)
+                for desg in targets]
+        irsa.shutdown()
+
+    print('First lookup, including imports: {:.1f} ms'.format(first))
+    print('Fine search and confirm Horizons calls go to the local stand-in'
+          ' server.')
+    print('{:12} {:>12} {:>12} {:>12} {:>6}'.format(
+        'target', 'lookup (ms)', 'confirm (ms)', 'search (ms)', 'pids'))
+    for (desg, lookup, confirm, n), search in zip(lookups, searches):
+        print('{:12} {:12.1f} {:12.1f} {:12.1f} {:6}'.format(
+            desg, lookup, confirm, search, n))
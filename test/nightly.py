@@ -0,0 +1,112 @@
+import io
+import os
+import tempfile
+from contextlib import redirect_stdout
+from astropy.io import fits
+from zchecker import ZChecker, Config, standin
+from zchecker.nightly import Pipeline
+from common import configure
+
+# run the nightly pipeline on the stand-in server for three nights:
+# every detection is downloaded, projected, and stacked; the second
+# night's baseline cutouts have no cutout_meta, as if projected
+# before the table existed; the projection stage fails on the third
+# night, and the run still finishes
+
+objects = ['C/2017 AB{}'.format(i) for i in range(40)]
+
+
+class FailingPipeline(Pipeline):
+    """Projection fails on the first batch."""
+
+    def _project(self, w, message):
+        if message is not None and message[0] == 'found':
+            raise RuntimeError('Injected projection failure.')
+        yield from Pipeline._project(self, w, message)
+
+
+def night(z, date):
+    """Detections, cutouts, projections, and stack sets of a night."""
+    nightid = z.nightid(date)
+    counts = z.db.execute('''
+    SELECT count(),total(sciimg!=0),total(sangleimg!=0)
+    FROM foundcat INNER JOIN found ON foundcat.foundid=found.foundid
+    LEFT JOIN projections ON foundcat.foundid=projections.foundid
+    WHERE nightid=?''', [nightid]).fetchone()
+    sets = z.db.execute('''
+    SELECT count(DISTINCT desg || filtercode) FROM foundcat
+    WHERE nightid=? AND infobits=0''', [nightid]).fetchone()[0]
+    files = [row[0] for row in z.db.execute('''
+    SELECT DISTINCT stackfile FROM stacks
+    INNER JOIN foundcat ON stacks.foundid=foundcat.foundid
+    WHERE nightid=? AND stackfile IS NOT NULL''', [nightid])]
+    return [int(c) for c in counts] + [sets], files
+
+
+def journal_mode(z):
+    return z.db.execute('PRAGMA journal_mode').fetchone()[0]
+
+
+results = []
+with tempfile.TemporaryDirectory() as path:
+    irsa = standin.start()
+    stack_path = os.path.join(path, 'stacks')
+    config = configure(path, irsa.url, stack_path=stack_path)
+
+    with redirect_stdout(io.StringIO()):
+        with ZChecker(Config(config)) as z:
+            z.update_ephemeris(objects, '2018-01-29', '2018-02-03')
+
+            date = '2018-01-31'
+            p = Pipeline(z, processes=2)
+            p.run(date, objects=objects)
+            (found, downloaded, projected, sets), files = night(z, date)
+            assert found > 0
+            assert p.counts['found'] == found
+            assert p.counts['downloaded'] == downloaded == found
+            assert p.counts['projected'] == projected == found
+            assert p.counts['stacks'] == len(files) == sets
+            assert p.counts['errors'] == 0
+            assert all([os.path.exists(os.path.join(stack_path, fn))
+                        for fn in files])
+            assert journal_mode(z) == 'delete'
+            results.append((date, p.counts))
+
+            # baseline cutouts projected before cutout_meta existed
+            baseline = z.db.execute('DELETE FROM cutout_meta').rowcount
+            z.db.commit()
+
+            date = '2018-02-01'
+            p = Pipeline(z, processes=2)
+            p.run(date, objects=objects)
+            (found, downloaded, projected, sets), files = night(z, date)
+            assert p.counts['errors'] == 0
+            assert p.counts['downloaded'] == projected == found
+            assert p.counts['stacks'] == len(files) == sets
+            assert z.db.execute('SELECT count() FROM cutout_meta'
+                                ).fetchone()[0] == baseline + found
+            blpids = [fits.getheader(os.path.join(stack_path, fn))['BLPID']
+                      for fn in files]
+            assert any([blpid != '' for blpid in blpids])
+            results.append((date, p.counts))
+
+            date = '2018-02-02'
+            p = FailingPipeline(z, processes=2)
+            p.run(date, objects=objects)
+            (found, downloaded, projected, sets), files = night(z, date)
+            assert p.counts['errors'] == 1
+            # upstream stages keep going, downstream stages finish
+            assert p.counts['found'] == found
+            assert p.counts['downloaded'] == downloaded == found
+            assert found > 0
+            assert p.counts['projected'] == projected == 0
+            assert p.counts['stacks'] == 0
+            assert journal_mode(z) == 'delete'
+            results.append((date, p.counts))
+    irsa.shutdown()
+
+print('{:10} {:>6} {:>10} {:>9} {:>6} {:>6}'.format(
+    'date', 'found', 'downloaded', 'projected', 'stacks', 'errors'))
+for date, counts in results:
+    print('{:10} {found:6} {downloaded:10} {projected:9} {stacks:6}'
+          ' {errors:6}'.format(date, **counts))
@@ -0,0 +1,102 @@
+import io
+import os
+import tempfile
+from contextlib import redirect_stdout
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from zchecker import ZChecker, Config, standin, cutout
+from zchecker.project import project_one
+from zchecker.cache import ProductCache
+from common import configure
+
+# cutouts downloaded from the stand-in server keep the mask WCS, and
+# the MASK extension can be projected, for each cutout format and
+# each download path: one target per request, a covering request cut
+# into sub-cutouts, a full quadrant, and the cached full mask
+
+date = '2018-02-01'
+objects = ['C/2017 AB{}'.format(i) for i in range(10)]
+
+# copied ephemeris columns for synthetic detections
+columns = ('obsjd,dra,ddec,ra3sig,dec3sig,vmag,rh,rdot,delta,phase,'
+           'selong,sangle,vangle,trueanomaly,tmtp,pid')
+
+
+def add_target(z, foundid, desg, ra, dec):
+    """Synthetic detection on the same image as `foundid`."""
+    z.db.execute('''
+    INSERT INTO found (desg,ra,dec,sciimg,{0})
+    SELECT ?,?,?,0,{0} FROM found WHERE foundid=?
+    '''.format(columns), (desg, ra, dec, foundid))
+
+
+def quad(z, foundid):
+    return z.db.execute('''
+    SELECT obs.ra,obs.dec FROM found INNER JOIN obs ON found.pid=obs.pid
+    WHERE foundid=?''', [foundid]).fetchone()
+
+
+def check(fn):
+    """Mask and science WCS agree, and the mask projects."""
+    with fits.open(fn) as hdu:
+        sci = WCS(hdu['SCI'].header)
+        mask = WCS(hdu['MASK'].header)
+        ext = hdu.index_of('MASK')
+        shape = hdu['MASK'].data.shape
+    assert mask.wcs.ctype[0] == 'RA---TAN', fn
+    assert np.allclose(mask.wcs.crpix, sci.wcs.crpix), fn
+    assert np.allclose(mask.wcs.crval, sci.wcs.crval), fn
+    assert np.allclose(mask.pixel_scale_matrix, sci.pixel_scale_matrix), fn
+    projected = project_one(fn, ext, 'sangle')
+    assert projected.data.shape == (300, 300), fn
+    return shape
+
+
+for fmt in cutout.FORMATS:
+    with tempfile.TemporaryDirectory() as path:
+        irsa = standin.start()
+        config = configure(path, irsa.url, cutout_format=fmt)
+
+        with redirect_stdout(io.StringIO()):
+            with ZChecker(Config(config)) as z:
+                z.update_obs(date)
+                z.update_ephemeris(objects, '2018-01-31', '2018-02-02')
+                z.fov_search(date, date, objects=objects)
+                rows = z.db.execute('''
+                SELECT foundid,ra,dec FROM found ORDER BY foundid
+                ''').fetchall()
+                assert len(rows) >= 2
+
+                # covering request: a second target 1' away
+                foundid, ra, dec = rows[0]
+                add_target(z, foundid, 'X/near', ra + 1 / 60, dec)
+
+                # full quadrant: 30 targets spread over another image
+                foundid = rows[1][0]
+                ra0, dec0 = quad(z, foundid)
+                for i in range(30):
+                    add_target(z, foundid, 'X/grid{}'.format(i),
+                               ra0 + 0.42 * np.cos(i) / np.cos(
+                                   np.radians(dec0)),
+                               dec0 + 0.42 * np.sin(i))
+                z.download_cutouts()
+                pid = z.db.execute('SELECT pid FROM found WHERE foundid=?',
+                                   [foundid]).fetchone()[0]
+                assert ProductCache(os.path.join(path, '.product-cache'),
+                                    2048).get(pid, 'mskimg') is not None
+
+                # full mask from the cache
+                add_target(z, foundid, 'X/cached', ra0, dec0)
+                z.download_cutouts()
+
+                files = z.db.execute('''
+                SELECT archivefile FROM found WHERE mskimg=1
+                ''').fetchall()
+                assert len(files) == len(rows) + 32
+                shapes = [check(os.path.join(path, row[0]))
+                          for row in files]
+        irsa.shutdown()
+
+    print('{:6} {} cutouts with masks projected, mask sizes {} to {}'
+          ' pixels'.format(fmt, len(files), min(shapes), max(shapes)))
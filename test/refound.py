@@ -0,0 +1,69 @@
+import io
+import os
+import tempfile
+from contextlib import redirect_stdout
+from zchecker import ZChecker, Config, standin
+from common import configure
+
+# a forced search over a night with downloaded cutouts keeps the
+# detections and their files; only a detection that moved by more
+# than the "found tolerance" is replaced
+
+date = '2018-02-01'
+objects = ['C/2017 AB{}'.format(i) for i in range(10)]
+
+
+def state(z):
+    return dict([(row[0], tuple(row[1:])) for row in z.db.execute('''
+    SELECT desg || ' ' || pid,foundid,archivefile,sciimg,mskimg
+    FROM found''')])
+
+
+def stale(z):
+    return z.db.execute('SELECT count() FROM stale_files').fetchone()[0]
+
+
+with tempfile.TemporaryDirectory() as path:
+    irsa = standin.start()
+    config = configure(path, irsa.url)
+
+    with redirect_stdout(io.StringIO()):
+        with ZChecker(Config(config)) as z:
+            z.update_obs(date)
+            z.update_ephemeris(objects, '2018-01-31', '2018-02-02')
+            z.fov_search(date, date, objects=objects)
+            z.download_cutouts()
+            before = state(z)
+            assert len(before) >= 2
+            assert all([row[1] is not None and row[2] == 1
+                        for row in before.values()])
+
+            # unchanged detections keep foundid, files, and products
+            z.fov_search(date, date, objects=objects, force=True)
+            after = state(z)
+            assert after == before
+            assert stale(z) == 0
+            assert all([os.path.exists(os.path.join(path, row[1]))
+                        for row in after.values()])
+
+            # a detection 10" from the new position is replaced
+            moved = sorted(before)[0]
+            foundid, archivefile = before[moved][:2]
+            z.db.execute('UPDATE found SET dec=dec+10/3600.'
+                         ' WHERE foundid=?', [foundid])
+            z.db.commit()
+            z.fov_search(date, date, objects=objects, force=True)
+            after = state(z)
+            assert set(after) == set(before)
+            assert after[moved][0] != foundid
+            assert after[moved][1:] == (None, 0, 0)
+            assert stale(z) == 1
+            assert z.db.execute('''
+            SELECT archivefile FROM stale_files''').fetchone()[0] \
+                == archivefile
+            del after[moved], before[moved]
+            assert after == before
+    irsa.shutdown()
+
+print('{} detections kept their cutouts on a forced search, one moved'
+      ' detection was replaced.'.format(len(before)))
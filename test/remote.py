@@ -0,0 +1,136 @@
+import os
+import time
+import threading
+import tempfile
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from zchecker import remote
+from zchecker.ztf import IRSA
+from zchecker.exceptions import RemoteError, CircuitOpenError, DownloadError
+
+# fake service: /flaky/N fails with 503 for the first N requests,
+# /down always fails, /missing is 404, /slow is 429 with Retry-After
+requests_seen = {}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        n = requests_seen.get(self.path, 0) + 1
+        requests_seen[self.path] = n
+        parts = self.path.strip('/').split('/')
+        if parts[0] == 'flaky' and n <= int(parts[1]):
+            self.send_response(503)
+        elif parts[0] == 'down':
+            self.send_response(503)
+        elif parts[0] == 'missing':
+            self.send_response(404)
+        elif parts[0] == 'slow' and n == 1:
+            self.send_response(429)
+            self.send_header('Retry-After', '0.2')
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.end_headers()
+            self.wfile.write(b'ok\n')
+            return
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+server = HTTPServer(('localhost', 0), Handler)
+url = 'http://localhost:{}'.format(server.server_port)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+fast = {'backoff': 0.01, 'max backoff': 0.5, 'rate': 0}
+remote.configure({'irsa': dict(fast, retries=3, threshold=100),
+                  'horizons': dict(fast, retries=1, threshold=3,
+                                   reset=0.3)})
+
+print('Transient failures are retried: ', end='', flush=True)
+r = remote.get('irsa', url + '/flaky/2')
+assert r.text == 'ok\n'
+assert requests_seen['/flaky/2'] == 3
+assert remote.stats()['irsa']['retries'] == 2
+print('passed.')
+
+print('Retries are limited: ', end='', flush=True)
+try:
+    remote.get('irsa', url + '/flaky/10')
+except RemoteError as e:
+    assert e.status == 503
+assert requests_seen['/flaky/10'] == 4
+print('passed.')
+
+print('Client errors are not retried: ', end='', flush=True)
+try:
+    remote.get('irsa', url + '/missing')
+except RemoteError as e:
+    assert e.status == 404
+assert requests_seen['/missing'] == 1
+print('passed.')
+
+print('Retry-After is respected: ', end='', flush=True)
+t0 = time.monotonic()
+remote.get('irsa', url + '/slow')
+assert time.monotonic() - t0 >= 0.1
+print('passed.')
+
+print('wget downloads are retried: ', end='', flush=True)
+with tempfile.TemporaryDirectory() as path:
+    irsa = IRSA(path, {'user': 'user', 'password': 'password'})
+    fn = os.path.join(path, 'test.txt')
+    irsa.download(url + '/flaky/1/test.txt', fn)
+    assert open(fn).read() == 'ok\n'
+    assert requests_seen['/flaky/1/test.txt'] == 2
+    try:
+        irsa.download(url + '/missing/test.txt', fn)
+    except DownloadError:
+        pass
+    assert requests_seen['/missing/test.txt'] == 1
+print('passed.')
+
+print('Circuit opens after repeated failures: ', end='', flush=True)
+horizons = remote.service('horizons')
+for i in range(2):
+    try:
+        remote.get('horizons', url + '/down')
+    except (RemoteError, CircuitOpenError):
+        pass
+# third failure opens the circuit, the retry is rejected
+assert requests_seen['/down'] == 3
+assert horizons.breaker.state == 'open'
+try:
+    remote.get('horizons', url + '/flaky/0')
+except CircuitOpenError:
+    pass
+assert '/flaky/0' not in requests_seen
+print('passed.')
+
+print('Circuit closes after a successful trial: ', end='', flush=True)
+time.sleep(0.35)
+assert horizons.breaker.state == 'half-open'
+remote.get('horizons', url + '/flaky/0')
+assert horizons.breaker.state == 'closed'
+print('passed.')
+
+print('Rate limiting: ', end='', flush=True)
+remote.configure({'irsa': {'rate': 20, 'burst': 2}})
+t0 = time.monotonic()
+threads = [threading.Thread(target=remote.get,
+                            args=('irsa', url + '/flaky/0'))
+           for i in range(10)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+# 2 immediately, then 8 at 20 per second
+assert time.monotonic() - t0 >= 0.35
+assert remote.stats()['irsa']['throttled'] == 8
+print('passed.')
+
+for name in sorted(remote.services):
+    print(remote.services[name].summary())
+
+server.shutdown()
@@ -0,0 +1,116 @@
+import io
+import os
+import json
+import time
+import tempfile
+import socket as sock
+import threading
+from contextlib import redirect_stdout
+from zchecker import ZChecker, Config, standin
+from zchecker.server import serve, request
+from common import timeit, command, configure
+
+# request latency of a zchecker serve process, compared with running
+# each command in a new process, or with a new ZChecker instance;
+# served results equal direct results, and a client that keeps its
+# connection open does not block others
+
+date = '2018-02-01'
+objects = ['C/2017 AB{}'.format(i) for i in range(40)]
+
+
+def run_server(config, socket):
+    # sqlite3 connections are used by the thread that made them
+    with ZChecker(Config(config)) as z:
+        serve(z, socket)
+
+
+def search(config):
+    with ZChecker(Config(config)) as z:
+        z.fov_search(date, date, objects=objects, force=True)
+
+
+def direct(config):
+    """Results of the served commands, from a new ZChecker instance."""
+    with ZChecker(Config(config)) as z:
+        found = [dict(row) for row in z.db.execute('''
+        SELECT * FROM foundcat WHERE desg=? ORDER BY obsjd
+        ''', [objects[0]])]
+        results = {
+            'list-nights': z.available_nights(exposures=True),
+            'list-objects': [list(row) for row in z.available_objects()],
+            'found': found,
+            'lookup': z.lookup(objects[0], date, date),
+        }
+    # as sent by the server
+    return json.loads(json.dumps(results))
+
+
+def served(socket):
+    return {
+        'list-nights': request(socket, 'list-nights', exposures=True),
+        'list-objects': request(socket, 'list-objects'),
+        'found': request(socket, 'found', desg=objects[0]),
+        'lookup': request(socket, 'lookup', desg=objects[0], start=date,
+                          end=date),
+    }
+
+
+def blocked(socket):
+    """Is a request blocked by another open connection?"""
+    with sock.socket(sock.AF_UNIX) as s:
+        s.connect(socket)
+        s.sendall(b'{"command": "ping"}\n')
+        with s.makefile('rb') as inf:
+            assert json.loads(inf.readline().decode())['status'] == 'ok'
+
+        # the first client is connected and idle
+        t = threading.Thread(target=request, args=(socket, 'ping'))
+        t.start()
+        t.join(10)
+        return t.is_alive()
+
+
+with tempfile.TemporaryDirectory() as path:
+    irsa = standin.start()
+    config = configure(path, irsa.url)
+    socket = os.path.join(path, 'zchecker.sock')
+
+    with redirect_stdout(io.StringIO()):
+        with ZChecker(Config(config)) as z:
+            z.update_obs(date)
+            z.update_ephemeris(objects, '2018-01-31', '2018-02-02')
+
+        server = threading.Thread(target=run_server, args=(config, socket))
+        server.start()
+        while not os.path.exists(socket):
+            time.sleep(0.01)
+
+        results = [
+            ('list-objects', timeit(lambda: command(config, 'list-objects')),
+             timeit(lambda: request(socket, 'list-objects'))),
+            ('search', timeit(lambda: search(config), n=3),
+             timeit(lambda: request(socket, 'search', start=date, end=date,
+                                    objects=objects, force=True), n=3)),
+        ]
+
+        search(config)
+        expected = direct(config)
+        results_served = served(socket)
+        request(socket, 'search', start=date, end=date, objects=objects,
+                force=True)
+        assert served(socket) == expected
+        assert results_served == expected
+        assert len(expected['found']) > 0
+        assert not blocked(socket)
+
+        request(socket, 'shutdown')
+        server.join()
+        irsa.shutdown()
+
+    print('Served results equal direct results; an idle connection does'
+          ' not block other clients.')
+    print('Fine search Horizons calls go to the local stand-in server.')
+    print('{:14} {:>14} {:>14}'.format('command', 'direct (ms)', 'server (ms)'))
+    for name, direct, served in results:
+        print('{:14} {:14.1f} {:14.1f}'.format(name, direct, served))
@@ -0,0 +1,49 @@
+import os
+import json
+import tempfile
+from zchecker import standin, remote, ZChecker, Config
+
+# run the ZTF update, ephemeris, search, and cutout steps against a
+# local stand-in server
+server = standin.start(latency=0.01, failure_rate=0.05)
+objects = ['C/2017 AB{}'.format(i) for i in range(20)]
+
+with tempfile.TemporaryDirectory() as path:
+    config = os.path.join(path, 'zchecker.config')
+    with open(config, 'w') as f:
+        json.dump({
+            'database': os.path.join(path, 'zchecker.db'),
+            'log': os.path.join(path, 'zchecker.log'),
+            'user': 'user',
+            'password': 'password',
+            'cutout path': os.path.join(path, 'cutouts'),
+            'stack path': os.path.join(path, 'stacks'),
+            'irsa url': server.url,
+            'horizons url': server.url + '/api/horizons.api',
+            'rate limits': {'irsa': {'rate': 0, 'backoff': 0.1},
+                            'horizons': {'rate': 0, 'backoff': 0.1}}
+        }, f)
+
+    with ZChecker(Config(config), log=True) as z:
+        z.update_obs('2018-02-01')
+        nframes = z.db.execute('SELECT count() FROM obs').fetchone()[0]
+        print('Observations: ', nframes)
+        assert nframes > 0
+
+        z.update_ephemeris(objects, '2018-01-31', '2018-02-02')
+        z.fov_search('2018-02-01', '2018-02-01')
+        found = z.db.execute('SELECT count() FROM found').fetchone()[0]
+        print('Found: ', found)
+        assert found > 0
+
+        z.download_cutouts()
+        downloaded = z.db.execute(
+            'SELECT count() FROM found WHERE sciimg=1').fetchone()[0]
+        print('Cutouts: ', downloaded)
+        assert downloaded == found
+
+    print(remote.stats())
+    print(server.RequestHandlerClass.counters)
+
+server.shutdown()
+print('passed.')
@@ -0,0 +1,69 @@
+import io
+import os
+import sys
+import sqlite3
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+from common import timeit, command, configure
+
+# wall-clock time of short zchecker commands, and of opening and
+# closing the database, for a new and an already set up database;
+# setup is skipped when the schema version is current
+
+
+def connect(config):
+    from zchecker import ZChecker, Config
+    with redirect_stdout(io.StringIO()):
+        with ZChecker(Config(config)):
+            pass
+
+
+def setups(config):
+    """Number of setup_db calls to open and close the database."""
+    from zchecker import ZChecker
+    calls = []
+    setup_db = ZChecker.setup_db
+
+    def counted(self):
+        calls.append(1)
+        setup_db(self)
+
+    ZChecker.setup_db = counted
+    try:
+        connect(config)
+    finally:
+        ZChecker.setup_db = setup_db
+    return len(calls)
+
+
+def user_version(db):
+    with sqlite3.connect(db) as c:
+        return c.execute('PRAGMA user_version').fetchone()[0]
+
+
+with tempfile.TemporaryDirectory() as path:
+    from zchecker import schema
+    config = configure(path)
+    db = os.path.join(path, 'zchecker.db')
+
+    # set up once, then the fast path, until the version changes
+    assert setups(config) == 1
+    assert user_version(db) == schema.version
+    assert setups(config) == 0
+    with sqlite3.connect(db) as c:
+        c.execute('PRAGMA user_version = 0')
+    assert setups(config) == 1
+    assert user_version(db) == schema.version
+
+    t = timeit(lambda: (os.path.exists(db) and os.unlink(db),
+                        connect(config)))
+    print('{:24} {:8.1f} ms'.format('open/close, new', t))
+    print('{:24} {:8.1f} ms'.format('open/close', timeit(
+        lambda: connect(config))))
+
+    print('{:24} {:8.1f} ms'.format('python -c pass', timeit(
+        lambda: subprocess.run([sys.executable, '-c', 'pass'], check=True))))
+    for args in (['list-nights'], ['list-objects']):
+        print('{:24} {:8.1f} ms'.format(' '.join(args), timeit(
+            lambda: command(config, *args))))
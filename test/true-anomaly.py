@@ -0,0 +1,101 @@
+import io
+import os
+import sqlite3
+import tempfile
+from contextlib import redirect_stdout
+import numpy as np
+from astropy.time import Time
+from zchecker import ZChecker, Config, standin, remote, eph
+from common import configure
+
+# true anomaly and time from perihelion derived from osculating
+# elements, compared with the time of flight from the true anomaly,
+# and with the mean anomaly reported by the stand-in Horizons, for
+# elliptic, parabolic, and hyperbolic orbits; and the elements cache
+
+k = 0.01720209895  # Gaussian gravitational constant, rad/day
+
+
+def time_of_flight(e, q, nu):
+    """Time from perihelion, days, and mean anomaly, deg."""
+    nu = np.radians(nu)
+    if e == 1:
+        D = np.tan(nu / 2)
+        return np.sqrt(2 * q**3) / k * (D + D**3 / 3), None
+    elif e < 1:
+        a = q / (1 - e)
+        E = 2 * np.arctan(np.sqrt((1 - e) / (1 + e)) * np.tan(nu / 2))
+        M = E - e * np.sin(E)
+    else:
+        a = q / (e - 1)
+        H = 2 * np.arctanh(np.sqrt((e - 1) / (e + 1)) * np.tan(nu / 2))
+        M = e * np.sinh(H) - H
+    return M * a**1.5 / k, np.degrees(M)
+
+
+def dangle(a, b):
+    return np.abs((np.asarray(a) - b + 180) % 360 - 180)
+
+
+# 1. nu -> T-Tp -> nu
+for e in (0, 0.2, 0.7, 0.97, 1.0, 1.03, 1.5, 4.0):
+    for q in (0.1, 1.0, 5.0):
+        # hyperbolic asymptote
+        nu_max = 179 if e <= 1 else np.degrees(np.arccos(-1 / e)) - 1
+        nu = np.linspace(-nu_max, nu_max, 101)
+        tmtp = time_of_flight(e, q, nu)[0]
+        err = dangle(eph.true_anomaly(e, q, tmtp), nu)
+        assert err.max() < 1e-6, (e, q, err.max())
+
+# 2. ephemeris nu and T-Tp from the stand-in elements
+jd0 = 2458150.5
+orbits = {'C/2017 E1': (0.7, 1.5, jd0 + 40),
+          'C/2017 P1': (1.0, 1.5, jd0 - 30),
+          'C/2017 H1': (1.3, 2.0, jd0 + 10)}
+epochs = jd0 + np.linspace(-100, 100, 41)
+irsa = standin.start(orbits=orbits)
+remote.configure({'horizons': {'rate': 0}},
+                 urls={'horizons': irsa.url + '/api/horizons.api'})
+eph.clear_elements()
+for desg, (e, q, tp) in orbits.items():
+    tab = eph.ephemeris(desg, epochs)
+    tdb = Time(epochs, format='jd', scale='utc').tdb.jd
+    # TDB - TT differs by ms between T and Tp
+    assert np.allclose(tab['T-Tp'], tdb - tp, rtol=0, atol=1e-6), desg
+
+    tmtp, M = time_of_flight(e, q, np.array(tab['nu'], float))
+    assert np.allclose(tmtp, tdb - tp, rtol=0, atol=1e-6), desg
+    if M is not None:
+        query = eph._horizons(id=desg, id_type='designation',
+                              location='0', epochs=tdb.tolist())
+        orb = query.elements(closest_apparition=True, no_fragments=True,
+                         cache=False)
+        assert dangle(orb['M'], M).max() < 1e-6, desg
+
+# 3. elements cache: bounded, least recently used dropped first
+eph.clear_elements()
+size = eph.elements_cache_size
+eph.elements_cache_size = 2
+for desg in ('C/2017 E1', 'C/2017 P1', 'C/2017 E1', 'C/2017 H1'):
+    eph.elements(desg, jd0)
+assert list(eph._elements) == ['C/2017 E1', 'C/2017 H1']
+eph.elements_cache_size = size
+irsa.shutdown()
+
+# and dropped by refresh after another connection wrote
+with tempfile.TemporaryDirectory() as path:
+    config = configure(path)
+
+    with redirect_stdout(io.StringIO()):
+        with ZChecker(Config(config)) as z:
+            z.refresh()
+            assert len(eph._elements) == 2
+            db = sqlite3.connect(os.path.join(path, 'zchecker.db'))
+            db.execute("INSERT INTO nights VALUES (1,'2018-02-01',0)")
+            db.commit()
+            db.close()
+            z.refresh()
+            assert len(eph._elements) == 0
+
+print('True anomaly and T-Tp agree with the time of flight and the'
+      ' stand-in mean anomaly: elliptic, parabolic, and hyperbolic.')
@@ -0,0 +1,97 @@
+import io
+import time
+import tempfile
+import numpy as np
+from contextlib import redirect_stdout
+from zchecker import ZChecker, Config, standin
+from zchecker.watch import Watch
+from zchecker.exceptions import RemoteError
+from common import configure
+
+# replay a night on the stand-in server, SPEEDUP times faster than
+# real time, and watch it; compare the detections with a search of
+# the complete night.  The watch sees partly archived exposures, a
+# failed poll, and a target added mid-night.
+
+SPEEDUP = 600
+INTERVAL = 2  # s, real time
+date = '2018-02-01'
+objects = ['C/2017 AB{}'.format(i) for i in range(40)]
+
+# first exposure, 2018-02-01 00:00 UT is JD 2458150.5
+night_start = 2458150.5 + standin.NIGHT_START
+t_start = time.monotonic()
+
+
+def clock():
+    """Simulated Julian date, from just before the first exposure."""
+    return night_start - 1e-4 + (time.monotonic() - t_start) * SPEEDUP / 86400
+
+
+def detections(z):
+    return set(tuple(row) for row in z.db.execute(
+        'SELECT desg,pid FROM found'))
+
+
+with tempfile.TemporaryDirectory() as path:
+    irsa = standin.start()
+    with redirect_stdout(io.StringIO()):
+        with ZChecker(Config(configure(path, irsa.url))) as z:
+            z.update_obs(date)
+            z.update_ephemeris(objects, '2018-01-31', '2018-02-02')
+            z.fov_search(date, date, objects=objects)
+            expected = detections(z)
+
+            # ztf-update again keeps detections and search history
+            z.update_obs(date)
+            assert detections(z) == expected
+    irsa.shutdown()
+
+# first detected target: its ephemeris is added mid-night
+late = min(expected, key=lambda row: row[1])[0]
+
+with tempfile.TemporaryDirectory() as path:
+    # quadrants are archived 2 s apart, so polls see partial exposures
+    irsa = standin.start(clock=clock, quad_delay=2)
+    with redirect_stdout(io.StringIO()):
+        with ZChecker(Config(configure(path, irsa.url))) as z:
+            z.update_ephemeris([obj for obj in objects if obj != late],
+                               '2018-01-31', '2018-02-02')
+
+            # one failed search, then a new target
+            searches = []
+            fov_search = z.fov_search
+
+            def search(*args, **kwargs):
+                searches.append(kwargs.get('pids') is not None)
+                if sum(searches) == 3:
+                    raise RemoteError('Stand-in outage.')
+                if sum(searches) == 5:
+                    z.update_ephemeris([late], '2018-01-31', '2018-02-02')
+                return fov_search(*args, **kwargs)
+
+            z.fov_search = search
+
+            night_end = night_start + 299 * standin.CADENCE
+            polls = int((night_end - night_start) * 86400 / SPEEDUP
+                        / INTERVAL) + 3
+            t_start = time.monotonic()
+            w = Watch(z, interval=INTERVAL, clock=clock)
+            w.run(date=date, polls=polls)
+            found = detections(z)
+            nframes = z.db.execute('SELECT nframes FROM nights').fetchone()[0]
+    irsa.shutdown()
+
+print('Replayed {} at {}x real time, polling every {} s ({:g} s'
+      ' simulated).'.format(date, SPEEDUP, INTERVAL, INTERVAL * SPEEDUP))
+print('{:>5} {:>8} {:>10}'.format('poll', 'images', 'detections'))
+for i, (t, n, m) in enumerate(w.polls):
+    print('{:5} {:8} {:10}'.format(i + 1, n, m))
+print('Detections: {} watched, {} from the complete night.'.format(
+    len(found), len(expected)))
+assert found == expected
+assert nframes == 300 * 64
+print('Lag from exposure to detection: median {:.0f} s, max {:.0f} s'
+      ' simulated ({:.2f} s, {:.2f} s real time).'.format(
+          np.median(w.lags), max(w.lags), np.median(w.lags) / SPEEDUP,
+          max(w.lags) / SPEEDUP))
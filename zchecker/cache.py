@@ -0,0 +1,104 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""cache
+========
+
+Local cache of quadrant-level IRSA products.
+
+Products that belong to a whole quadrant image, e.g., the PSF
+('sciimgdaopsfcent') or a full mask ('mskimg'), are saved by product
+ID and product type, and shared by all cutouts of that image.  The
+least recently used files are removed when the cache grows beyond its
+size limit.
+
+"""
+
+
+class ProductCache:
+    """Size-limited, least recently used file cache.
+
+    Parameters
+    ----------
+    path : string
+      Cache directory, created as needed.
+    size : float
+      Size limit, MiB.
+
+    """
+
+    def __init__(self, path, size):
+        import os
+        self.path = path
+        self.size = size * 2**20
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def filename(self, pid, product):
+        import os
+        return os.path.join(self.path, '{}-{}.fits'.format(pid, product))
+
+    def get(self, pid, product):
+        """Cached product file name, or `None` if not cached."""
+        import os
+        fn = self.filename(pid, product)
+        if os.path.exists(fn):
+            # access time may not be updated by the file system
+            os.utime(fn)
+            self.hits += 1
+            return fn
+        self.misses += 1
+        return None
+
+    def put(self, pid, product, filename):
+        """Move a file into the cache.
+
+        Parameters
+        ----------
+        pid : int
+          Product ID.
+        product : string
+          Product type, e.g., 'sciimgdaopsfcent'.
+        filename : string
+          File to move.
+
+        Returns
+        -------
+        fn : string
+          Cached file name.
+
+        """
+
+        import shutil
+        fn = self.filename(pid, product)
+        shutil.move(filename, fn)
+        self.evict(keep=fn)
+        return fn
+
+    def evict(self, keep=None):
+        """Remove least recently used files until within the limit.
+
+        Parameters
+        ----------
+        keep : string, optional
+          Never remove this file.
+
+        """
+
+        import os
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum([f[1] for f in files])
+        for mtime, size, fn in sorted(files):
+            if total <= self.size:
+                break
+            if fn == keep:
+                continue
+            os.unlink(fn)
+            total -= size
+            self.evicted += 1
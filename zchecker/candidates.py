@@ -0,0 +1,182 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""candidates
+=============
+
+Compact storage for coarse search candidates.
+
+Quad geometry is kept in a NumPy structured array for the current
+search window, and each candidate refers to its nearest quads by
+index into that array.  This is the hand-off format between
+`ZChecker.coarse_quad_search`, `ZChecker.local_quad_search`, and
+`ZChecker.fine_quad_search`.
+
+"""
+
+# quad geometry, angles in radians
+quad_dtype = [('obsjd', 'f8'), ('pid', 'i8'),
+              ('ra', 'f8'), ('dec', 'f8'),
+              ('ra1', 'f8'), ('ra2', 'f8'), ('ra3', 'f8'), ('ra4', 'f8'),
+              ('dec1', 'f8'), ('dec2', 'f8'), ('dec3', 'f8'), ('dec4', 'f8'),
+              ('nightid', 'i8'), ('maglimit', 'f8')]
+
+# object code, indices of the nearest four quads (-1 for none), and the
+# interpolated ephemeris position and its uncertainty in radians
+candidate_dtype = [('obj', 'i4'), ('quads', 'i4', 4),
+                   ('ra', 'f8'), ('dec', 'f8'), ('margin', 'f8')]
+
+
+class CandidateBuffer:
+    """Coarse search candidates for the fine search.
+
+    Parameters
+    ----------
+    size : int, optional
+      Initial number of quads and candidates to allocate.  Storage
+      is doubled as needed.
+
+    Examples
+    --------
+    buf = CandidateBuffer()
+    offset = buf.add_quads(quads)
+    buf.add('C/2017 AB5', offset + nearest, ra, dec, margin)
+    for obj, c in buf.groups():
+        print(obj, buf.quads['pid'][c['quads']])
+
+    """
+
+    def __init__(self, size=1024):
+        import numpy as np
+        self._quads = np.zeros(size, quad_dtype)
+        self._candidates = np.zeros(size, candidate_dtype)
+        self.nquads = 0
+        self.n = 0
+        self.objects = []
+        self._codes = {}
+        self.peak_nbytes = 0
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def quads(self):
+        """Quad geometry for the current window."""
+        return self._quads[:self.nquads]
+
+    @property
+    def candidates(self):
+        """Candidates for the current window."""
+        return self._candidates[:self.n]
+
+    @property
+    def nbytes(self):
+        """Size of the stored quads and candidates."""
+        return self.quads.nbytes + self.candidates.nbytes
+
+    @staticmethod
+    def _grow(a, n):
+        import numpy as np
+        if n <= len(a):
+            return a
+        b = np.zeros(max(n, 2 * len(a)), a.dtype)
+        b[:len(a)] = a
+        return b
+
+    def add_quads(self, quads):
+        """Add quads to the window.
+
+        Parameters
+        ----------
+        quads : ndarray
+          Quad geometry, structured with `quad_dtype`.
+
+        Returns
+        -------
+        offset : int
+          Index of the first quad in the window.
+
+        """
+
+        offset = self.nquads
+        self._quads = self._grow(self._quads, offset + len(quads))
+        self._quads[offset:offset + len(quads)] = quads
+        self.nquads += len(quads)
+        return offset
+
+    def add(self, obj, quads, ra=0, dec=0, margin=0):
+        """Add a candidate.
+
+        Parameters
+        ----------
+        obj : string
+          Object designation.
+        quads : array-like
+          Indices of up to four nearest quads in the window.
+        ra, dec : float, optional
+          Approximate position of the object, radians.
+        margin : float, optional
+          Uncertainty of the approximate position, radians.
+
+        """
+
+        if obj not in self._codes:
+            self._codes[obj] = len(self.objects)
+            self.objects.append(obj)
+
+        self._candidates = self._grow(self._candidates, self.n + 1)
+        c = self._candidates[self.n]
+        c['obj'] = self._codes[obj]
+        c['quads'] = -1
+        c['quads'][:len(quads)] = quads
+        c['ra'] = ra
+        c['dec'] = dec
+        c['margin'] = margin
+        self.n += 1
+        self.peak_nbytes = max(self.peak_nbytes, self.nbytes)
+
+    def groups(self):
+        """Iterate over candidates, grouped by object.
+
+        Candidates are returned in the order they were added.
+
+        Yields
+        ------
+        obj : string
+          Object designation.
+        candidates : ndarray
+          The object's candidates, structured with `candidate_dtype`.
+
+        """
+
+        import numpy as np
+        c = self.candidates
+        order = np.argsort(c['obj'], kind='stable')
+        codes = c['obj'][order]
+        edges = np.flatnonzero(np.diff(codes)) + 1
+        for i in np.split(order, edges):
+            if len(i) == 0:
+                continue
+            yield self.objects[c['obj'][i[0]]], c[i]
+
+    def keep(self, mask):
+        """Remove candidates.
+
+        Quads remain in the window.
+
+        Parameters
+        ----------
+        mask : array-like
+          `True` for each candidate to keep, in the order added.
+
+        """
+
+        import numpy as np
+        kept = self.candidates[np.asarray(mask, bool)]
+        self._candidates[:len(kept)] = kept
+        self.n = len(kept)
+
+    def clear(self):
+        """Remove all quads and candidates."""
+        self.nquads = 0
+        self.n = 0
+        self.objects = []
+        self._codes = {}
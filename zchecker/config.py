@@ -10,9 +10,24 @@ The configuration is a JSON-formatted file:
   "user": "IRSA account user name",
   "password": "IRSA account password",
   "cutout path": "/path/to/cutout/directory",
-  "stack path": "/path/to/stack/directory"
+  "stack path": "/path/to/stack/directory",
+  "rate limits": {
+    "irsa": {"rate": 2, "burst": 4, "retries": 4},
+    "horizons": {"rate": 1, "burst": 4, "retries": 4}
+  }
 }
 
+"rate limits" is optional, see `zchecker.remote` for all parameters
+and defaults.  "irsa url" and "horizons url" optionally replace the
+service base URLs, e.g., for `zchecker.standin`.  "cache path" and
+"cache size" (MiB) optionally set the location and size of the IRSA
+product cache, see `zchecker.cache`.  "cutout format" selects the
+cutout file format, see `zchecker.cutout`.  "cube path" enables the
+projected cutout store for stacking, see `zchecker.cube`.  "defer gc"
+leaves stale archive files for `zchecker gc`.  "found tolerance"
+(arcsec) is the position change that makes a repeated search replace a
+detection and its products.
+
 """
 # Configuration file format should match the description in
 # scripts/zchecker help.
@@ -56,6 +71,9 @@ class Config:
     def __getitem__(self, k):
         return self.config[k]
 
+    def get(self, k, default=None):
+        return self.config.get(k, default)
+
     @classmethod
     def from_args(cls, args):
         """Initialize from command-line arguments.
@@ -0,0 +1,159 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""coverage
+===========
+
+Nightly sky coverage maps.
+
+A coverage map is a 1 deg x 1 deg grid in RA and Dec, with a cell set
+for each quad center observed that night.  Maps are stored in the
+database as packed bits, and dilated at search time so that any
+position within a given radius of a quad center falls on a set cell.
+
+"""
+
+SHAPE = (180, 360)
+
+
+def cells(ra, dec):
+    """Grid cell indices.
+
+    Parameters
+    ----------
+    ra, dec : array-like
+      Coordinates in degrees.
+
+    Returns
+    -------
+    i : ndarray
+      Flattened grid cell indices.
+
+    """
+
+    import numpy as np
+    i = np.clip(np.floor(np.asarray(dec) + 90).astype(int), 0, SHAPE[0] - 1)
+    j = np.floor(np.asarray(ra) % 360).astype(int) % SHAPE[1]
+    return i * SHAPE[1] + j
+
+
+def pack(ra, dec):
+    """Coverage map of quad centers, packed for the database.
+
+    Parameters
+    ----------
+    ra, dec : array-like
+      Quad centers in degrees.
+
+    Returns
+    -------
+    blob : bytes
+
+    """
+
+    import numpy as np
+    m = np.zeros(SHAPE[0] * SHAPE[1], bool)
+    m[cells(ra, dec)] = True
+    return np.packbits(m).tobytes()
+
+
+def unpack(blob):
+    """Coverage map from the database.
+
+    Parameters
+    ----------
+    blob : bytes
+
+    Returns
+    -------
+    m : ndarray
+      Boolean array with shape `SHAPE`.
+
+    """
+
+    import numpy as np
+    m = np.unpackbits(np.frombuffer(blob, np.uint8))
+    return m[:SHAPE[0] * SHAPE[1]].astype(bool).reshape(SHAPE)
+
+
+def dilate(m, radius):
+    """Grow a coverage map.
+
+    The result is conservative: all cells with any point within
+    `radius` of any point of a set cell are set.
+
+    Parameters
+    ----------
+    m : ndarray
+      Coverage map.
+    radius : float
+      Angular distance, degrees.
+
+    Returns
+    -------
+    grown : ndarray
+
+    """
+
+    import numpy as np
+
+    n = int(np.ceil(radius))
+    out = m.copy()
+    for k in range(1, n + 1):
+        out[k:] |= m[:-k]
+        out[:-k] |= m[k:]
+
+    grown = out.copy()
+    for i in np.flatnonzero(out.any(1)):
+        # cell edge closest to the pole, plus radius
+        dec = min(max(abs(i - 90), abs(i + 1 - 90)) + radius, 90)
+        c = np.cos(np.radians(dec))
+        if c * SHAPE[1] / 2 <= radius:
+            grown[i] = True
+            continue
+
+        row = out[i]
+        for k in range(1, int(np.ceil(radius / c)) + 1):
+            grown[i] |= np.roll(row, k) | np.roll(row, -k)
+
+    return grown
+
+
+def track(jd, ra, dec, jd_start, jd_end, step=0.25):
+    """Sample an ephemeris over a time range.
+
+    Parameters
+    ----------
+    jd, ra, dec : array-like
+      Ephemeris, sorted by time, angles in degrees.
+    jd_start, jd_end : float
+      Time range to sample.
+    step : float, optional
+      Maximum angular distance between samples, degrees.
+
+    Returns
+    -------
+    ra, dec : ndarray
+      Sampled positions, degrees.
+
+    """
+
+    import numpy as np
+
+    jd = np.asarray(jd)
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    xyz = np.array((np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra),
+                    np.sin(dec)))
+
+    # track length over the time range, including the bracketing
+    # ephemeris points
+    i = max(np.searchsorted(jd, jd_start) - 1, 0)
+    j = min(np.searchsorted(jd, jd_end) + 1, len(jd))
+    arc = np.degrees(np.arccos(np.clip(
+        np.sum(xyz[:, i:j - 1] * xyz[:, i + 1:j], 0), -1, 1))).sum()
+    n = min(int(np.ceil(arc / step)), 10000) + 2
+
+    t = np.linspace(jd_start, jd_end, n)
+    x, y, z = [np.interp(t, jd, xyz[k]) for k in range(3)]
+    ra = np.degrees(np.arctan2(y, x)) % 360
+    dec = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    return ra, dec
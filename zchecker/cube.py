@@ -0,0 +1,227 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""cube
+=======
+
+Per-target store of projected cutouts for stacking.
+
+The projected images (SANGLE) and their masks (SANGLEMASK) of each
+target are appended to two flat array files, and read back as memory
+mapped cubes, one plane per image.  The cube table indexes planes by
+foundid.  The store is enabled with the "cube path" configuration key,
+updated by zproject, and rebuilt from the cutout archive with `zproject
+--rebuild-cube`.
+
+A reprojected cutout overwrites its plane in place.  Planes of deleted
+cutouts remain in the files until the target is rebuilt.
+
+"""
+
+# zproject template size
+SHAPE = (300, 300)
+
+
+class CutoutCube:
+    """Memory-mapped projected images of one target.
+
+    Parameters
+    ----------
+    path : string
+      Cube store directory.
+    desg : string
+      Target designation.
+
+    """
+
+    def __init__(self, path, desg):
+        import os
+        from .zchecker import desg2file
+        self.path = os.path.join(path, desg2file(desg))
+        self.desg = desg
+
+    @property
+    def files(self):
+        import os
+        return (os.path.join(self.path, 'sangle.f32'),
+                os.path.join(self.path, 'sanglemask.u8'))
+
+    def __len__(self):
+        import os
+        fn = self.files[0]
+        if not os.path.exists(fn):
+            return 0
+        return os.path.getsize(fn) // (SHAPE[0] * SHAPE[1] * 4)
+
+    def append(self, image, mask=None, plane=None):
+        """Append an image.
+
+        Parameters
+        ----------
+        image : ndarray
+          Projected image.
+        mask : ndarray, optional
+          Projected mask, non-zero for masked pixels.
+        plane : int, optional
+          Overwrite this plane instead, if it is in the cube.
+
+        Returns
+        -------
+        plane : int
+          Index of the new or overwritten plane.
+
+        """
+
+        import os
+        import numpy as np
+
+        if image.shape != SHAPE:
+            raise ValueError('Image shape {} is not {}'.format(
+                image.shape, SHAPE))
+        if mask is None:
+            mask = np.zeros(SHAPE, bool)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        # planes are counted from the image file, so the mask is
+        # written first, and both are written at the plane offset,
+        # overwriting anything left by an interrupted append
+        n = len(self)
+        overwrite = plane is not None and 0 <= plane < n
+        if not overwrite:
+            plane = n
+        for fn, data in zip(self.files[::-1], [
+                (mask != 0).astype(np.uint8),
+                np.asarray(image, np.float32)]):
+            with open(fn, 'r+b' if plane > 0 or overwrite else 'wb') as outf:
+                outf.seek(plane * data.nbytes)
+                outf.write(data.tobytes())
+                if not overwrite:
+                    outf.truncate()
+
+        return plane
+
+    def cube(self):
+        """Images and masks as read-only memory-mapped arrays.
+
+        Returns
+        -------
+        images : numpy.memmap
+          Shape (N,) + `SHAPE`, float32.
+        masks : numpy.memmap
+          Shape (N,) + `SHAPE`, uint8.
+
+        """
+
+        import numpy as np
+        n = len(self)
+        if n == 0:
+            return np.empty((0,) + SHAPE, np.float32), np.empty(
+                (0,) + SHAPE, np.uint8)
+
+        images = np.memmap(self.files[0], np.float32, 'r',
+                           shape=(n,) + SHAPE)
+        masks = np.memmap(self.files[1], np.uint8, 'r', shape=(n,) + SHAPE)
+        return images, masks
+
+    def clear(self):
+        """Remove the cube files."""
+        import os
+        for fn in self.files:
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+
+def add(db, path, foundid, desg, image, mask=None):
+    """Add a projected image to a target's cube and index it.
+
+    An image already in the cube, e.g., reprojected, is overwritten in
+    place.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+    path : string
+      Cube store directory.
+    foundid : int
+    desg : string
+    image, mask : ndarray
+      See `CutoutCube.append`.
+
+    """
+
+    row = db.execute('SELECT plane FROM cube WHERE foundid=? AND desg=?',
+                     [foundid, desg]).fetchone()
+    plane = CutoutCube(path, desg).append(
+        image, mask, plane=None if row is None else row[0])
+    db.execute('INSERT OR REPLACE INTO cube VALUES (?,?,?)',
+               [foundid, desg, plane])
+
+
+def planes(db, foundids):
+    """Cube planes for a list of images.
+
+    Returns
+    -------
+    planes : dict
+      Plane index keyed by foundid, only for indexed images.
+
+    """
+
+    foundids = [int(i) for i in foundids]
+    rows = db.execute(
+        'SELECT foundid,plane FROM cube WHERE foundid IN ({})'.format(
+            ','.join('?' * len(foundids))), foundids).fetchall()
+    return dict([(row[0], row[1]) for row in rows])
+
+
+def rebuild(db, path, cutout_path, desg, logger=None):
+    """Rebuild a target's cube from the projected cutout archive.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+    path : string
+      Cube store directory.
+    cutout_path : string
+      Cutout archive directory.
+    desg : string
+      Target designation.
+    logger : logging.Logger, optional
+      Report files that cannot be read.
+
+    Returns
+    -------
+    n : int
+      Number of planes.
+
+    """
+
+    import os
+    from astropy.io import fits
+
+    cube = CutoutCube(path, desg)
+    cube.clear()
+    db.execute('DELETE FROM cube WHERE desg=?', [desg])
+
+    rows = db.execute('''
+    SELECT found.foundid,archivefile FROM found
+    INNER JOIN projections ON found.foundid=projections.foundid
+    WHERE desg=? AND sangleimg!=0
+    ORDER BY obsjd
+    ''', [desg]).fetchall()
+
+    n = 0
+    for foundid, archivefile in rows:
+        try:
+            with fits.open(os.path.join(cutout_path, archivefile)) as hdu:
+                mask = (hdu['SANGLEMASK'].data if 'SANGLEMASK' in hdu
+                        else None)
+                add(db, path, foundid, desg, hdu['SANGLE'].data, mask)
+                n += 1
+        except (OSError, KeyError, ValueError) as e:
+            if logger is not None:
+                logger.error('    Error reading {}: {}'.format(
+                    archivefile, str(e)))
+
+    db.commit()
+    return n
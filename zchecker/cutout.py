@@ -0,0 +1,140 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""cutout
+=========
+
+Cutout file formats.
+
+Cutouts are assembled in memory and written once, in one of three
+formats, selected with the "cutout format" configuration key:
+
+  gzip   science image in the primary HDU, gzip compressed file
+         (.fits.gz), the default
+  rice   tile-compressed (RICE_1) science image and mask extensions
+         (.fits); lossy for the science image, but extensions may be
+         read individually
+  none   uncompressed (.fits); extensions may be memory mapped
+
+In all formats the science image, mask, and PSF have the extension
+names SCI, MASK, and PSF.
+
+Science image header keywords needed downstream are also recorded in
+the cutout_meta table when files are written, so that zstack does not
+need to read them back.
+
+"""
+
+FORMATS = ('gzip', 'rice', 'none')
+
+# cutout_meta columns, named after SCI header keywords; META are set by
+# download_cutouts, PROJECTION by zproject
+META = ('desg', 'obsjd', 'dbpid', 'exposure', 'gain', 'magzp', 'rh',
+        'delta', 'phase', 'rdot', 'selong', 'sangle', 'vangle', 'trueanom',
+        'tmtp', 'tgtra', 'tgtdec', 'tgtdra', 'tgtddec', 'tgtrasig',
+        'tgtdesig')
+PROJECTION = ('bgmean', 'bgmedian', 'bgstdev', 'nbg', 'sanglewcs')
+
+
+def suffix(fmt):
+    """File name suffix for a format."""
+    if fmt not in FORMATS:
+        raise ValueError('Unknown cutout format: {}'.format(fmt))
+    return '.fits.gz' if fmt == 'gzip' else '.fits'
+
+
+def meta(header, keys=META):
+    """Metadata for the cutout_meta table from a SCI header.
+
+    Missing keywords and empty strings are `None`.
+
+    Parameters
+    ----------
+    header : astropy.io.fits.Header
+    keys : tuple, optional
+      Keywords to record.
+
+    Returns
+    -------
+    meta : dict
+
+    """
+
+    meta = {}
+    for k in keys:
+        v = header.get(k)
+        meta[k] = None if v == '' else v
+    return meta
+
+
+def assemble(data, header, mask=None, psf=None, fmt='gzip',
+             mask_header=None):
+    """Cutout HDU list.
+
+    Parameters
+    ----------
+    data : ndarray
+      Science image.
+    header : astropy.io.fits.Header
+      Science image header.
+    mask : ndarray, optional
+      Mask image.
+    mask_header : astropy.io.fits.Header, optional
+      Mask image header, with the WCS needed for projection.
+    psf : ndarray, optional
+      PSF image.
+    fmt : string, optional
+      File format, see `FORMATS`.
+
+    Returns
+    -------
+    hdu : astropy.io.fits.HDUList
+
+    """
+
+    from astropy.io import fits
+
+    hdu = fits.HDUList()
+    if fmt == 'rice':
+        hdu.append(fits.PrimaryHDU())
+        hdu.append(fits.CompImageHDU(data, header, name='sci',
+                                     compression_type='RICE_1'))
+        if mask is not None:
+            hdu.append(fits.CompImageHDU(mask, mask_header, name='mask',
+                                         compression_type='RICE_1'))
+    else:
+        hdu.append(fits.PrimaryHDU(data, header))
+        hdu[0].name = 'sci'
+        if mask is not None:
+            hdu.append(fits.ImageHDU(mask, mask_header, name='mask'))
+
+    if psf is not None:
+        hdu.append(fits.ImageHDU(psf, name='psf'))
+
+    return hdu
+
+
+def write(hdu, filename, fmt='gzip'):
+    """Write a cutout in one pass.
+
+    gzip files are compressed at level 1, which is several times
+    faster than the default, for a nearly identical size.
+
+    Parameters
+    ----------
+    hdu : astropy.io.fits.HDUList
+      From `assemble`.
+    filename : string
+    fmt : string, optional
+      File format, see `FORMATS`.
+
+    """
+
+    import io
+    import gzip
+
+    if fmt == 'gzip':
+        buf = io.BytesIO()
+        hdu.writeto(buf)
+        with open(filename, 'wb') as outf:
+            outf.write(gzip.compress(buf.getvalue(), compresslevel=1))
+    else:
+        hdu.writeto(filename)
@@ -43,73 +43,458 @@ def interp(jd, c1, c2):
 
 
 def update(desg, start, end, step, orbit=False):
+    """Ephemeris rows for the local database.
+
+    Parameters
+    ----------
+    desg : string
+      Object designation.
+    start, end : string or float
+      Date range as ISO strings or Julian dates.
+    step : string or float
+      Time step, a Horizons step string or a float in hours.
+    orbit : bool, optional
+      Set to `True` to also retrieve orbital parameters.
+
+    Returns
+    -------
+    rows : list of tuples
+      desg, jd, ra, dec, dra, ddec, vmag, retrieved, ra3sig, dec3sig
+
+    """
+
     import numpy as np
+    from itertools import repeat
     from astropy.time import Time
     now = Time.now().iso[:16]
     if isinstance(start, str):
-        eph = ephemeris(desg, {'start': start, 'stop': end, 'step': step})
+        eph = ephemeris(desg, {'start': start, 'stop': end, 'step': step},
+                        orbit=orbit)
     else:
         # step in hours
         n = int(round((end - start) / (step / 24)))
-        eph = ephemeris(desg, np.linspace(start, end, n + 1))
+        eph = ephemeris(desg, np.linspace(start, end, n + 1), orbit=orbit)
 
-    for i in range(len(eph)):
-        yield (desg, eph['datetime_jd'][i], eph['RA'][i], eph['DEC'][i],
-               eph['RA_rate'][i], eph['DEC_rate'][i], eph['V'][i], now)
+    # convert whole columns at once, masked or missing values become
+    # NULL
+    def column(k):
+        try:
+            return np.ma.filled(eph[k].astype(float), np.nan).tolist()
+        except (KeyError, ValueError):
+            return [np.nan] * len(eph)
 
+    columns = [column(k) for k in ('datetime_jd', 'RA', 'DEC', 'RA_rate',
+                                   'DEC_rate', 'V')]
+    uncertainty = [column(k) for k in ('RA_3sigma', 'DEC_3sigma')]
+    return list(zip(repeat(desg), *columns, repeat(now), *uncertainty))
+
+
+# orbital elements retrieved by `elements`, keyed by designation,
+# least recently used first, for at most this many objects
+elements_cache_size = 2000
+_elements = {}
+_elements_lock = {}
+
+
+def _cache_lock():
+    """Lock for `_elements`, created on first use."""
+    import threading
+    # setdefault is atomic: all threads get the same lock
+    return _elements_lock.setdefault('lock', threading.Lock())
 
-def ephemeris(desg, epochs, orbit=True):
-    """Ephemeris and orbital parameters.
+
+def clear_elements():
+    """Drop all cached orbital elements."""
+    with _cache_lock():
+        _elements.clear()
+
+
+def _id_type(desg):
+    """Horizons ID type and query options for a designation."""
+    import re
+    opts = {}
+    if re.match('^([CPID]/|[0-9]+P)', desg) is not None:
+        id_type = 'designation'
+        opts['closest_apparition'] = True
+        opts['no_fragments'] = True
+    else:
+        id_type = 'smallbody'
+    return id_type, opts
+
+
+def _horizons(**kwargs):
+    """Horizons query object, using the 'horizons' remote service URL."""
+    from astroquery.jplhorizons import Horizons, conf
+    from . import remote
+
+    q = Horizons(**kwargs)
+    url = remote.service('horizons').url
+    if url is not None:
+        # astroquery only allows the official server URL
+        remote.rebase(q._session, conf.horizons_server, url)
+    return q
+
+
+def elements(desg, epoch, window=30):
+    """Osculating orbital elements.
+
+    Elements are cached, and reused for any epoch within `window`
+    days of the retrieved epoch.  The cache holds the most recently
+    used `elements_cache_size` objects.
 
     Parameters
     ----------
     desg : string
       Object designation.
-    epochs : array-like or dictionary
-      `epochs` parameter for `astroquery.jplhorizons.Horizons`.
-    orbit : bool, optional
-      Set to `False` to exclude orbital parameters.
+    epoch : float
+      Julian date, TDB.
+    window : float, optional
+      Days.
 
     Returns
     -------
-    eph : astropy.table.Table
-      All jplhorizons ephemeris and orbital quantities, plus 'T-Tp'.
+    el : dict
+      'epoch', 'e', 'q', 'Tp_jd'
 
     """
 
-    import re
-    from astropy.time import Time
-    from astropy.table import Column, join, vstack
-    from astroquery.jplhorizons import Horizons
-    from .exceptions import EphemerisError
-
-    # limit Horizons requests to 200 individual epochs (530 is
-    # definitely too many)
-    if not isinstance(epochs, dict):
-        if len(epochs) > 200:
-            eph = ephemeris(desg, epochs[:200], orbit=orbit)
-            for i in range(200, len(epochs), 200):
-                j = min(i + 200, len(epochs))
-                eph = vstack((eph, ephemeris(desg, epochs[i:j], orbit=orbit)))
-            return eph
+    from . import remote
+    from .exceptions import EphemerisError, CircuitOpenError
 
-    opts = {}
-    if re.match('^([CPID]/|[0-9]+P)', desg) is not None:
-        id_type = 'designation'
-        opts['closest_apparition'] = True
-        opts['no_fragments'] = True
+    with _cache_lock():
+        el = _elements.pop(desg, None)
+        if el is not None:
+            # most recently used last
+            _elements[desg] = el
+            if abs(el['epoch'] - epoch) <= window:
+                return el
+
+    id_type, opts = _id_type(desg)
+    try:
+        q = _horizons(id=desg, id_type=id_type, location='0', epochs=epoch)
+        orb = remote.service('horizons').call(q.elements, cache=False,
+                                              **opts)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        raise EphemerisError('{}: {}'.format(desg, str(e)))
+
+    if len(orb) == 0:
+        raise EphemerisError('{}'.format(desg))
+
+    el = {'epoch': epoch,
+          'e': float(orb['e'][0]),
+          'q': float(orb['q'][0]),
+          'Tp_jd': float(orb['Tp_jd'][0])}
+    with _cache_lock():
+        _elements.pop(desg, None)
+        _elements[desg] = el
+        while len(_elements) > elements_cache_size:
+            del _elements[next(iter(_elements))]
+    return el
+
+
+def true_anomaly(e, q, tmtp):
+    """True anomaly of a two-body orbit.
+
+    Parameters
+    ----------
+    e : float
+      Eccentricity.
+    q : float
+      Perihelion distance, au.
+    tmtp : array-like
+      Time from perihelion, days.
+
+    Returns
+    -------
+    nu : ndarray
+      True anomaly, 0 to 360 deg.
+
+    """
+
+    import numpy as np
+
+    k = 0.01720209895  # Gaussian gravitational constant, rad/day
+    tmtp = np.asarray(tmtp, float)
+    if abs(e - 1) < 1e-8:
+        # parabolic, Barker's equation
+        W = 3 * k * tmtp / np.sqrt(2 * q**3)
+        # odd in W, solved for |W| to avoid cancellation before
+        # perihelion
+        Y = np.cbrt(np.abs(W) / 2 + np.sqrt(W**2 / 4 + 1))
+        nu = 2 * np.arctan(np.sign(W) * (Y - 1 / Y))
+    elif e < 1:
+        a = q / (1 - e)
+        M = (k / a**1.5 * tmtp + np.pi) % (2 * np.pi) - np.pi
+        E = np.where(e < 0.8, M, np.pi * np.sign(M))
+        for i in range(50):
+            dE = (E - e * np.sin(E) - M) / (1 - e * np.cos(E))
+            E = E - dE
+            if np.all(np.abs(dE) < 1e-12):
+                break
+        nu = 2 * np.arctan2(np.sqrt(1 + e) * np.sin(E / 2),
+                            np.sqrt(1 - e) * np.cos(E / 2))
     else:
-        id_type = 'smallbody'
+        a = q / (e - 1)
+        M = k / a**1.5 * tmtp
+        H = np.arcsinh(M / e)
+        for i in range(50):
+            dH = (e * np.sinh(H) - H - M) / (e * np.cosh(H) - 1)
+            H = H - dH
+            if np.all(np.abs(dH) < 1e-12):
+                break
+        nu = 2 * np.arctan(np.sqrt((e + 1) / (e - 1)) * np.tanh(H / 2))
+
+    return np.degrees(nu) % 360
+
+
+# angles interpolated with wrapping at 360 deg
+_angles = ('RA', 'RA_app', 'EclLon', 'ObsEclLon', 'GlxLon', 'PABLon',
+           'sunTargetPA', 'velocityPA', 'true_anom')
+
 
+def plan(epochs, step=5, max_epochs=200):
+    """Plan Horizons requests for a list of epochs.
+
+    Uniformly spaced epochs are requested as a single range.
+    Otherwise, runs of epochs that can be covered by fewer range
+    points, spaced by `step`, are coalesced into range requests to be
+    interpolated, and the rest are requested as explicit lists.
+
+    Parameters
+    ----------
+    epochs : array-like
+      Julian dates, UT.
+    step : int, optional
+      Range request step size, minutes.
+    max_epochs : int, optional
+      Maximum number of epochs in an explicit list request.
+
+    Returns
+    -------
+    requests : list of tuples
+      (i, epochs, exact) where `i` are the indices of the epochs
+      covered by the request, `epochs` is the `Horizons` epochs
+      parameter, and `exact` is `True` if the request returns the
+      epochs themselves.
+
+    """
+
+    import numpy as np
+    from astropy.time import Time
+
+    def iso(jd):
+        # nudge whole minutes to avoid rounding down to the
+        # previous minute
+        return Time(jd + 1e-7, format='jd').iso[:16]
+
+    jd = np.asarray(epochs, float)
+    order = np.argsort(jd)
+    jd = jd[order]
+    minutes = jd * 1440
+
+    # uniform spacing of whole minutes, starting on a whole minute
+    if len(jd) > 2:
+        dt = np.diff(minutes)
+        if (np.ptp(dt) < 1e-3 and dt[0] > 0.5
+                and abs(dt[0] - round(dt[0])) < 1e-3
+                and abs(minutes[0] - round(minutes[0])) < 1e-3):
+            return [(order, {'start': iso(jd[0]), 'stop': iso(jd[-1]),
+                             'step': '{}m'.format(int(round(dt[0])))},
+                     True)]
+
+    requests = []
+    explicit = []
+    i = 0
+    while i < len(jd):
+        # range start and end on whole minutes; number of range
+        # points for each possible cluster end
+        start = np.floor(minutes[i])
+        n = np.ceil((minutes[i:] - start) / step) + 1
+        count = np.arange(1, len(n) + 1)
+        j = np.flatnonzero(n < count)
+        if len(j) == 0:
+            explicit.append(i)
+            i += 1
+            continue
+
+        j = i + j[-1] + 1
+        stop = start + (n[j - i - 1] - 1) * step
+        requests.append((order[i:j], {'start': iso(start / 1440),
+                                      'stop': iso(stop / 1440),
+                                      'step': '{}m'.format(step)}, False))
+        i = j
+
+    for k in range(0, len(explicit), max_epochs):
+        i = order[explicit[k:k + max_epochs]]
+        requests.append((i, np.asarray(epochs, float)[i].tolist(), True))
+
+    return requests
+
+
+def _query(desg, epochs):
+    """Single Horizons ephemeris request.
+
+    Requests are rate limited and transient failures are retried by
+    the 'horizons' remote service.
+
+    """
+    from . import remote
+    from .exceptions import EphemerisError, CircuitOpenError
+
+    id_type, opts = _id_type(desg)
     try:
-        q = Horizons(id=desg, id_type=id_type, location='I41', epochs=epochs)
-        eph = q.ephemerides(cache=False, **opts)
+        q = _horizons(id=desg, id_type=id_type, location='I41',
+                      epochs=epochs)
+        eph = remote.service('horizons').call(q.ephemerides, cache=False,
+                                              **opts)
+    except CircuitOpenError:
+        raise
     except Exception as e:
         raise EphemerisError('{}: {}'.format(desg, str(e)))
 
     if len(eph) == 0:
         raise EphemerisError('{}'.format(desg))
 
+    return eph
+
+
+def interpolation_error(eph):
+    """Estimate the linear interpolation error of an ephemeris.
+
+    Parameters
+    ----------
+    eph : astropy.table.Table
+      Uniformly spaced ephemeris with 'RA' and 'DEC' in degrees.
+
+    Returns
+    -------
+    err : float
+      Maximum error, arcsec.
+
+    """
+
+    import numpy as np
+
+    if len(eph) < 3:
+        return 0
+
+    ra = np.unwrap(np.radians(np.array(eph['RA'], float)))
+    dec = np.radians(np.array(eph['DEC'], float))
+    d2ra = np.diff(ra, 2) * np.cos(dec[1:-1])
+    d2dec = np.diff(dec, 2)
+    return np.degrees(np.hypot(d2ra, d2dec).max()) * 3600 / 8
+
+
+def interpolate(eph, jd):
+    """Linearly interpolate an ephemeris table.
+
+    Parameters
+    ----------
+    eph : astropy.table.Table
+      Ephemeris sorted by 'datetime_jd'.
+    jd : array-like
+      Julian dates, UT, of the result.
+
+    Returns
+    -------
+    interpolated : astropy.table.Table
+      Floating-point columns are interpolated, others are taken from
+      the nearest row.
+
+    """
+
+    import numpy as np
+    from astropy.table import Table, Column, MaskedColumn
+
+    jd = np.asarray(jd, float)
+    x = np.array(eph['datetime_jd'], float)
+    nearest = np.abs(x[:, None] - jd).argmin(0)
+
+    out = Table()
+    for name in eph.colnames:
+        col = eph[name]
+        if name == 'datetime_jd':
+            out[name] = Column(jd, name=name, unit=col.unit)
+        elif col.dtype.kind == 'f':
+            y = np.ma.filled(col.astype(float), np.nan)
+            if name in _angles:
+                y = np.degrees(np.unwrap(np.radians(y)))
+            v = np.interp(jd, x, y)
+            if name in _angles:
+                v = v % 360
+            if hasattr(col, 'mask'):
+                out[name] = MaskedColumn(v, name=name, unit=col.unit,
+                                         mask=~np.isfinite(v))
+            else:
+                out[name] = Column(v, name=name, unit=col.unit)
+        else:
+            out[name] = col[nearest]
+
+    return out
+
+
+def ephemeris(desg, epochs, orbit=True, step=5, tol=0.1):
+    """Ephemeris and orbital parameters.
+
+    Lists of epochs are requested from Horizons as planned by `plan`.
+    Dense epochs are retrieved as ranges and interpolated, unless the
+    estimated interpolation error exceeds `tol`, in which case they
+    are requested explicitly.
+
+    Orbital parameters are derived from osculating elements retrieved
+    once per object, see `elements`.
+
+    Parameters
+    ----------
+    desg : string
+      Object designation.
+    epochs : array-like or dictionary
+      `epochs` parameter for `astroquery.jplhorizons.Horizons`.
+    orbit : bool, optional
+      Set to `False` to exclude orbital parameters.
+    step : int, optional
+      Range request step size, minutes.
+    tol : float, optional
+      Interpolation tolerance, arcsec.
+
+    Returns
+    -------
+    eph : astropy.table.Table
+      All jplhorizons ephemeris quantities, plus true anomaly, 'nu',
+      and 'T-Tp'.  Rows are in the order of `epochs`.
+
+    """
+
+    import numpy as np
+    from astropy.time import Time
+    from astropy.table import Column, vstack
+
+    if isinstance(epochs, dict):
+        eph = _query(desg, epochs)
+    else:
+        pieces = []
+        indices = []
+        for i, request, exact in plan(epochs, step=step):
+            eph = _query(desg, request)
+            jd = np.asarray(epochs, float)[i]
+            if exact and len(eph) == len(i):
+                # avoid float errors
+                eph['datetime_jd'] = jd
+            elif interpolation_error(eph) <= tol:
+                eph = interpolate(eph, jd)
+            else:
+                # too coarse, request each epoch
+                eph = vstack([_query(desg, list(jd[k:k + 200]))
+                              for k in range(0, len(jd), 200)])
+                eph['datetime_jd'] = jd
+            pieces.append(eph)
+            indices.append(i)
+
+        eph = vstack(pieces)
+        eph = eph[np.argsort(np.concatenate(indices))]
+
     # combine Tmag and Nmag into V
     if 'Tmag' in eph.colnames:
         V = eph['Tmag']
@@ -124,24 +509,14 @@ def ephemeris(desg, epochs, orbit=True):
     eph['V'] = Column(V, name='V')
 
     if orbit:
-        q = Horizons(id=desg, id_type=id_type, location='0', epochs=epochs)
-        orb = q.elements(cache=False, **opts)
-        if len(orb) == 0:
-            raise EphemerisError('{}'.format(desg))
+        jd = np.array(eph['datetime_jd'], float)
+        el = elements(desg, (jd.min() + jd.max()) / 2)
 
-        Tp = Time(orb['Tp_jd'], format='jd', scale='tdb')
-        T = Time(orb['datetime_jd'], format='jd', scale='utc')
+        Tp = Time(el['Tp_jd'], format='jd', scale='tdb')
+        T = Time(jd, format='jd', scale='utc')
         tmtp = (T - Tp).jd
-        orb.add_column(Column(tmtp, name='T-Tp'))
-
-        # remove repeated columns
-        repeated = [c for c in orb.colnames
-                    if (c in eph.colnames) and (c != 'datetime_jd')]
-        orb.remove_columns(repeated)
-
-        # cheat to avoid float errors
-        orb['datetime_jd'] = eph['datetime_jd']
-
-        eph = join(eph, orb)
+        eph.add_column(Column(true_anomaly(el['e'], el['q'], tmtp),
+                              name='nu'))
+        eph.add_column(Column(tmtp, name='T-Tp'))
 
     return eph
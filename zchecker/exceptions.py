@@ -10,3 +10,23 @@ class DateRangeError(ZCheckerError):
 
 class EphemerisError(ZCheckerError):
     pass
+
+class RemoteError(ZCheckerError):
+    """Error response from a remote service.
+
+    Parameters
+    ----------
+    msg : string
+    status : int, optional
+      HTTP status code, or `None` if no response was received.
+    retry_after : float, optional
+      Seconds the service asked us to wait.
+
+    """
+    def __init__(self, msg, status=None, retry_after=None):
+        super().__init__(msg)
+        self.status = status
+        self.retry_after = retry_after
+
+class CircuitOpenError(ZCheckerError):
+    pass
@@ -1,8 +1,19 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
+def timestamp():
+    """Current UTC time, ISO format, e.g., 2018-02-01 12:34:56.789Z.
+
+    Same as `astropy.time.Time.now().iso + 'Z'`, without importing
+    astropy.
+
+    """
+    from datetime import datetime, timezone
+    now = datetime.now(timezone.utc)
+    return now.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] + 'Z'
+
+
 def setup(filename='zchecker.log'):
     import sys
     import logging
-    from astropy.time import Time
 
     logger = logging.Logger('ZChecker')
     logger.setLevel(logging.DEBUG)
@@ -23,7 +34,7 @@ def setup(filename='zchecker.log'):
         logger.addHandler(logfile)
 
     logger.info('#' * 70)
-    logger.info(Time.now().iso + 'Z')
+    logger.info(timestamp())
     logger.info('Command line: ' + ' '.join(sys.argv[1:]))
     for handler in logger.handlers:
         if hasattr(handler, 'baseFilename'):
@@ -0,0 +1,325 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""nightly
+==========
+
+`zchecker nightly`: ztf-update, search, download-cutouts, zproject,
+and zstack for one night, with overlapping stages.
+
+The search runs in the calling thread.  Each batch of detections is
+passed on as soon as `ZChecker.fov_search` saves it, through bounded
+queues, to three stage threads:
+
+  search -> download -> project -> stack
+
+Downloads start while the search is still running, projection starts
+on finished downloads, and a target-night is stacked once the search
+has passed the end of that night and all its detections have been
+projected.  Queues are FIFO, so a stage knows that a night is
+complete when the search's progress marker reaches it.  A full queue
+blocks the stage upstream of it.
+
+Each stage thread has its own database connection (`ZChecker.copy`).
+The database is switched to write-ahead logging for the run, so the
+search's long read does not block the other stages' commits, and
+switched back at the end.  Projections run in a process pool.
+
+Queue messages:
+
+  ('found', foundids, t)   detections saved at time t
+  ('searched', jd)         all detections before jd have been sent
+  None                     end of input
+
+"""
+
+
+class Pipeline:
+    """Nightly pipeline.
+
+    Parameters
+    ----------
+    z : ZChecker
+      Runs the search; stage threads use copies of it.
+    queue_size : int, optional
+      Maximum number of messages waiting between two stages.
+    processes : int, optional
+      Projection worker processes, default: number of CPUs.
+    baseline : float, optional
+      Stack baseline period, days, see `stack.data_to_stack`.
+    scale_by : list of string, optional
+      Stack scaling models, see `stack.stack`.
+    skip_flagged : bool, optional
+      Skip searching and downloading images with non-zero infobits,
+      which are not stacked.
+
+    """
+
+    def __init__(self, z, queue_size=10, processes=None, baseline=14,
+                 scale_by=('coma', 'surface'), skip_flagged=False):
+        self.z = z
+        self.queue_size = queue_size
+        self.processes = processes
+        self.baseline = baseline
+        self.scale_by = scale_by
+        self.skip_flagged = skip_flagged
+
+        # stage name: busy time, s
+        self.busy = {}
+        self.counts = {'found': 0, 'downloaded': 0, 'projected': 0,
+                       'stacks': 0, 'errors': 0}
+        # per stack: file name, seconds since data availability and
+        # since the first detection of the set was saved
+        self.latency = []
+
+        # stack stage: (desg, nightid): time of the first detection;
+        # nightid: last exposure, JD; cutout_meta checked for old
+        # cutouts
+        self._sets = {}
+        self._night_end = {}
+        self._indexed = False
+
+    def run(self, date, objects=None, vlim=22.0, depth_margin=None,
+            update=True):
+        """Process one night.
+
+        Parameters
+        ----------
+        date : string
+          UT date, YYYY-MM-DD.
+        objects : list of string, optional
+          Targets to search, default: all targets with ephemerides.
+        vlim : float, optional
+          Search magnitude limit.
+        depth_margin : float, optional
+          See `ZChecker.fov_search`.
+        update : bool, optional
+          Set to `False` to skip ztf-update.
+
+        """
+
+        import os
+        import time
+        import queue
+        import threading
+        from multiprocessing import Pool
+
+        z = self.z
+        t_start = time.monotonic()
+        os.makedirs(z.config['stack path'], exist_ok=True)
+        if update:
+            z.update_obs(date)
+        # data availability: the night's exposures are in the database
+        self.t_available = time.monotonic()
+
+        journal_mode = z.db.execute('PRAGMA journal_mode').fetchone()[0]
+        z.db.execute('PRAGMA journal_mode = WAL')
+        z.db.execute('PRAGMA busy_timeout = 60000')
+
+        queues = [queue.Queue(self.queue_size) for i in range(3)]
+        stages = [('download', self._download), ('project', self._project),
+                  ('stack', self._stack)]
+        ready = threading.Barrier(len(stages) + 1)
+
+        # fork projection workers before starting any threads
+        pool = Pool(self.processes)
+        try:
+            self._run(z, date, objects, vlim, depth_margin, pool, queues,
+                      stages, ready)
+        finally:
+            pool.close()
+            pool.join()
+            z.db.execute('PRAGMA journal_mode = {}'.format(journal_mode))
+
+        self.t_done = time.monotonic()
+        self.t_start = t_start
+        self.report(date)
+
+    def _run(self, z, date, objects, vlim, depth_margin, pool, queues,
+             stages, ready):
+        """Start the stage threads, and search."""
+        import time
+        import threading
+
+        self.pool = pool
+        threads = []
+        for i, (name, stage) in enumerate(stages):
+            outq = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append(threading.Thread(
+                target=self._stage, name=name,
+                args=(name, stage, queues[i], outq, ready)))
+            threads[-1].start()
+
+        def found(rows, foundids, jd):
+            if len(foundids) > 0:
+                self.counts['found'] += len(foundids)
+                queues[0].put(('found', foundids, time.monotonic()))
+            queues[0].put(('searched', jd))
+
+        t0 = time.monotonic()
+        try:
+            ready.wait()
+            z.fov_search(date, date, objects=objects, vlim=vlim,
+                         depth_margin=depth_margin,
+                         skip_flagged=self.skip_flagged, on_found=found)
+        finally:
+            self.busy['search'] = time.monotonic() - t0
+            self.t_searched = time.monotonic()
+            queues[0].put(None)
+            for thread in threads:
+                thread.join()
+
+    def _stage(self, name, stage, inq, outq, ready):
+        """Run one stage in this thread, on its own connection."""
+        import time
+        import threading
+
+        try:
+            w = self.z.copy()
+            w.db.execute('PRAGMA busy_timeout = 60000')
+            ready.wait()
+        except threading.BrokenBarrierError:
+            return
+        except Exception:
+            ready.abort()
+            raise
+
+        self.busy[name] = 0
+        failed = False
+        while not failed:
+            # None: end of input, flush, e.g., stack the remaining
+            # target-nights
+            message = inq.get()
+            t0 = time.monotonic()
+            try:
+                for out in stage(w, message):
+                    if outq is not None:
+                        outq.put(out)
+            except Exception as e:
+                w.db.rollback()
+                w.logger.error('Nightly {} stage failed: {}'.format(
+                    name, str(e)))
+                self.counts['errors'] += 1
+                failed = True
+            self.busy[name] += time.monotonic() - t0
+            if message is None:
+                break
+
+        if message is not None:
+            # failed, keep the upstream stages moving
+            while inq.get() is not None:
+                pass
+        if outq is not None:
+            outq.put(None)
+        w.db.commit()
+        w.db.close()
+
+    def _download(self, w, message):
+        if message is None:
+            return
+        if message[0] != 'found':
+            yield message
+            return
+
+        foundids, t = message[1:]
+        w.download_cutouts(foundids=foundids, skip_flagged=self.skip_flagged)
+        foundids = [row[0] for row in w.db.execute('''
+        SELECT foundid FROM found WHERE sciimg!=0 AND foundid IN ({})
+        '''.format(','.join('?' * len(foundids))), foundids)]
+        self.counts['downloaded'] += len(foundids)
+        if len(foundids) > 0:
+            yield ('found', foundids, t)
+
+    def _project(self, w, message):
+        from . import project
+
+        if message is None:
+            return
+        if message[0] != 'found':
+            yield message
+            return
+
+        foundids, t = message[1:]
+        rows = project.pending(w, foundids=foundids)
+        self.counts['projected'] += len(project.process(w, self.pool, rows))
+
+        # including cutouts projected by a previous run
+        foundids = [row[0] for row in w.db.execute('''
+        SELECT foundid FROM projections WHERE sangleimg!=0
+          AND foundid IN ({})
+        '''.format(','.join('?' * len(foundids))), foundids)]
+        if len(foundids) > 0:
+            yield ('found', foundids, t)
+
+    def _stack(self, w, message):
+        """Collect target-nights, stack those that are complete."""
+        import time
+        from . import stack
+
+        if not self._indexed:
+            # baseline cutouts projected before cutout_meta existed
+            stack.index_headers(w, w.config['cutout path'])
+            self._indexed = True
+
+        if message is None:
+            complete = list(self._sets)
+        elif message[0] == 'found':
+            foundids, t = message[1:]
+            rows = w.db.execute('''
+            SELECT DISTINCT desg,nightid FROM foundcat
+            WHERE infobits=0 AND foundid IN ({})
+            '''.format(','.join('?' * len(foundids))), foundids)
+            for row in rows:
+                self._sets.setdefault(tuple(row), t)
+            return
+        else:
+            jd = message[1]
+            complete = []
+            for desg, nightid in self._sets:
+                if nightid not in self._night_end:
+                    self._night_end[nightid] = w.db.execute(
+                        'SELECT max(obsjd) FROM obs WHERE nightid=?',
+                        [nightid]).fetchone()[0]
+                if self._night_end[nightid] <= jd:
+                    complete.append((desg, nightid))
+
+        stack_path = w.config['stack path']
+        for desg, nightid in complete:
+            t = self._sets.pop((desg, nightid))
+            for n, foundids, fn, nightly, baseline in stack.data_to_stack(
+                    w, self.baseline, desg=desg, nightid=nightid):
+                stack.check_target_paths(stack_path, fn)
+                w.logger.info('  Stacking {}'.format(fn))
+                if stack.stack(w, foundids, fn, nightly, baseline,
+                               scale_by=self.scale_by, overwrite=True):
+                    now = time.monotonic()
+                    self.counts['stacks'] += 1
+                    self.latency.append(
+                        (fn, now - self.t_available, now - t))
+
+        # a generator, with nothing to pass on
+        yield from ()
+
+    def report(self, date):
+        """Log stage times and latencies."""
+        import numpy as np
+
+        log = self.z.logger
+        log.info('Nightly {}: {found} detections, {downloaded} cutouts,'
+                 ' {projected} projected, {stacks} stacks, {errors} stage'
+                 ' errors.'.format(date, **self.counts))
+        log.info('  Data available after {:.1f} s, search finished after'
+                 ' {:.1f} s, pipeline finished after {:.1f} s.'.format(
+                     self.t_available - self.t_start,
+                     self.t_searched - self.t_start,
+                     self.t_done - self.t_start))
+        log.info('  Stage busy time: ' + ', '.join([
+            '{} {:.1f} s'.format(name, self.busy.get(name, 0))
+            for name in ('search', 'download', 'project', 'stack')]))
+        if len(self.latency) > 0:
+            fns, available, found = list(zip(*self.latency))
+            log.info('  Latency from data availability to finished stack:'
+                     ' first {:.1f} s, median {:.1f} s, last {:.1f} s.'.format(
+                         min(available), np.median(available),
+                         max(available)))
+            log.info('  Latency from detection to finished stack: median'
+                     ' {:.1f} s, max {:.1f} s.'.format(
+                         np.median(found), max(found)))
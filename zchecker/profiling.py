@@ -0,0 +1,172 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""profiling
+============
+
+cProfile and named timing spans for zchecker, zproject, and zstack,
+enabled with their ``--profile`` option.
+
+Spans time the main processing stages, e.g., `ZChecker.fov_search`'s
+SQL fetch, coarse, local, and fine searches, and found object
+updates.  They are no-ops unless profiling is enabled.  cProfile only
+sees the calling thread; spans also collect time from worker threads.
+zproject's worker processes are timed by the span around them, but
+not profiled.
+
+The report, a text summary and the binary cProfile statistics (for
+`pstats` or other viewers), is written next to the log file:
+
+  <log directory>/<program>-profile-YYYYMMDDTHHMMSS.txt
+  <log directory>/<program>-profile-YYYYMMDDTHHMMSS.prof
+
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+# span name: [count, total seconds]
+spans = {}
+enabled = False
+_lock = threading.Lock()
+
+
+class span:
+    """Time a block of code.
+
+    Examples
+    --------
+    with span('fine search'):
+        ...
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if enabled:
+            self.t0 = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        if enabled:
+            _add(self.name, time.monotonic() - self.t0)
+
+
+def _add(name, dt):
+    with _lock:
+        s = spans.setdefault(name, [0, 0.0])
+        s[0] += 1
+        s[1] += dt
+
+
+def timed_iter(name, iterable):
+    """Time the steps of an iterator, e.g., rows of a database query.
+
+    Returns `iterable` unchanged if profiling is disabled.
+
+    """
+
+    if not enabled:
+        return iterable
+
+    def steps():
+        it = iter(iterable)
+        while True:
+            t0 = time.monotonic()
+            try:
+                item = next(it)
+            except StopIteration:
+                _add(name, time.monotonic() - t0)
+                return
+            _add(name, time.monotonic() - t0)
+            yield item
+
+    return steps()
+
+
+@contextmanager
+def profile(program, log, on=True, top=15):
+    """Profile a block of code, and report at exit.
+
+    Parameters
+    ----------
+    program : string
+      Program name, used for the report file names.
+    log : string
+      Log file name; the report is written to the same directory.
+    on : bool, optional
+      Set to `False` to run the block without profiling.
+    top : int, optional
+      Number of functions to list in the summary.
+
+    """
+
+    import os
+    import cProfile
+    from datetime import datetime, timezone
+    global enabled
+
+    if not on:
+        yield
+        return
+
+    spans.clear()
+    enabled = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        enabled = False
+
+        prefix = os.path.join(
+            os.path.dirname(os.path.abspath(log)),
+            '{}-profile-{}'.format(program, datetime.now(
+                timezone.utc).strftime('%Y%m%dT%H%M%S')))
+        profiler.dump_stats(prefix + '.prof')
+        summary = report(profiler, top=top)
+        with open(prefix + '.txt', 'w') as outf:
+            outf.write(summary)
+
+        print(summary)
+        print('Profile written to {}.txt and .prof'.format(prefix))
+
+
+def report(profiler, top=15):
+    """Text summary of spans and the top functions by internal time.
+
+    Parameters
+    ----------
+    profiler : cProfile.Profile
+    top : int, optional
+      Number of functions to list.
+
+    Returns
+    -------
+    summary : string
+
+    """
+
+    import io
+    import pstats
+
+    lines = ['{:24} {:>8} {:>12} {:>12}'.format(
+        'span', 'count', 'total (s)', 'mean (ms)')]
+    for name in sorted(spans, key=lambda k: -spans[k][1]):
+        n, total = spans[name]
+        lines.append('{:24} {:8} {:12.3f} {:12.3f}'.format(
+            name, n, total, total / n * 1000))
+
+    buf = io.StringIO()
+    stats = pstats.Stats(profiler, stream=buf)
+    stats.sort_stats('tottime').print_stats(top)
+    hot = buf.getvalue().strip().splitlines()
+    # skip the pstats preamble
+    i = [j for j, line in enumerate(hot) if line.strip().startswith('ncalls')]
+    hot = hot[i[0]:] if len(i) > 0 else hot
+
+    return '\n'.join(lines + ['', 'Top {} functions by internal time:'.format(
+        top)] + hot) + '\n'
+
@@ -0,0 +1,326 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""project
+==========
+
+Projection of cutouts into the target's frame, used by zproject and
+`zchecker nightly`.
+
+Science images and masks are reprojected with Montage, with the
+projected comet-Sun vector placed along the +x-axis, and appended to
+the cutout file as the SANGLE and SANGLEMASK extensions.  The
+background is estimated, and the results are recorded in the
+projections and cutout_meta tables, and the cube store, if
+configured.
+
+`project` runs in worker processes; everything else uses the database
+connection of the calling thread.
+
+"""
+
+
+def update_background(fn):
+    import numpy as np
+    from numpy import ma
+    from astropy.io import fits
+    from astropy.stats import sigma_clip
+
+    with fits.open(fn, mode='update') as hdu:
+        im = hdu['SCI'].data.copy()
+        mask = ~np.isfinite(im)
+        if 'MASK' in hdu:
+            mask += hdu['MASK'].data > 0
+        im = ma.MaskedArray(im, mask=mask, copy=True)
+
+        scim = sigma_clip(im)
+
+        mean = ma.mean(scim)
+        mean = mean if mean is not ma.masked else 0
+
+        median = ma.median(scim)
+        median = median if median is not ma.masked else 0
+
+        stdev = ma.std(scim)
+        stdev = stdev if stdev is not ma.masked else 0
+
+        hdu['SCI'].header['bgmean'] = mean, 'background sigma-clipped mean'
+        hdu['SCI'].header['bgmedian'] = median, 'background sigma-clipped median'
+        hdu['SCI'].header['bgstdev'] = stdev, 'background sigma-clipped standard dev.'
+        hdu['SCI'].header['nbg'] = ma.sum(~scim.mask), 'area considered in background stats.'
+
+    return {'bgmean': float(mean), 'bgmedian': float(median),
+            'bgstdev': float(stdev), 'nbg': int(ma.sum(~scim.mask))}
+
+
+def mkheader(radec, angle):
+    """Write a Montage template header to a file.
+
+    WCS centered on `radec` (deg).
+    Position angle `angle` at top (E of N, deg).
+
+    """
+
+    from tempfile import NamedTemporaryFile
+    import numpy as np
+
+    c = np.cos(np.radians(-angle))
+    s = np.sin(np.radians(-angle))
+    pc = np.matrix([[c, s], [-s, c]])
+
+    with NamedTemporaryFile(mode='w', delete=False) as h:
+        h.write('''SIMPLE  = T
+BITPIX  = -64
+NAXIS   = 2
+NAXIS1  = 300
+NAXIS2  = 300
+CTYPE1  = 'RA---TAN'
+CTYPE2  = 'DEC--TAN'
+EQUINOX = 2000
+CRVAL1  =  {:13.9}
+CRVAL2  =  {:13.9}
+CRPIX1  =       150.0000
+CRPIX2  =       150.0000
+CDELT1  =   -0.000281156
+CDELT2  =    0.000281156
+PC1_1   =  {:13.9}
+PC1_2   =  {:13.9}
+PC2_1   =  {:13.9}
+PC2_2   =  {:13.9}
+END
+'''.format(radec[0], radec[1], pc[0, 0], pc[0, 1], pc[1, 0], pc[1, 1]))
+
+    return h.name
+
+
+def project_one(fn, ext, alignment):
+    """Project extension `extname` in file `fn`.
+
+    alignment:
+      'vangle': Projected velocity will be placed along the +x-axis.
+      'sangle': Projected comet-Sun vector will be placed along the +x-axis.
+
+    Image distortions should be removed.
+
+    Tile-compressed extensions are decompressed to a temporary file
+    for Montage.
+
+    """
+    import os
+    from tempfile import mkstemp
+    from astropy.io import fits
+    import montage_wrapper as m
+
+    assert alignment in ['vangle', 'sangle'], 'Alignment must be vangle or sangle'
+
+    h0 = fits.getheader(fn, 'SCI')
+    assert alignment in h0, 'Alignment vector not in FITS header'
+
+    radec = (h0['tgtra'], h0['tgtdec'])
+    temp_header = mkheader(radec, 90 + h0[alignment])
+
+    with fits.open(fn) as original:
+        bitpix = original[ext].header['BITPIX']
+        compressed = isinstance(original[ext], fits.CompImageHDU)
+
+    if bitpix == 16 or compressed:
+        # convert to float, uncompressed
+        fd_in, inf = mkstemp()
+        with fits.open(fn) as original:
+            data = original[ext].data
+            if bitpix == 16:
+                data = data.astype(float)
+            newhdu = fits.PrimaryHDU(data, original[ext].header)
+            newhdu.writeto(inf, overwrite=True)
+        ext = 0
+    else:
+        fd_in = None
+        inf = fn
+
+    fd_out, outf = mkstemp()
+    try:
+        m.reproject(inf, outf, hdu=ext, header=temp_header, exact_size=True,
+                    silent_cleanup=True)
+        im, h = fits.getdata(outf, header=True)
+        if bitpix == 16:
+            im = im.round().astype(int)
+            im[im < 0] = 0
+        projected = fits.ImageHDU(im, h)
+    except m.MontageError:
+        raise
+    finally:
+        # temp file clean up
+        if fd_in is not None:
+            os.fdopen(fd_in).close()
+            os.unlink(inf)
+        os.fdopen(fd_out).close()
+        os.unlink(outf)
+        os.unlink(temp_header)
+
+    return projected
+
+
+def append_image_to(hdu, newhdu, extname):
+    newhdu.name = extname
+    if extname in hdu:
+        hdu[extname] = newhdu
+    else:
+        hdu.append(newhdu)
+
+
+def project(fn):
+    """Project images in `fn` and estimate the background.
+
+    Returns cutout_meta updates, or an error message.
+
+    """
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    import montage_wrapper as m
+
+    with fits.open(fn) as hdu:
+        sci_ext = hdu.index_of('SCI')
+        if 'MASK' in hdu:
+            mask_ext = hdu.index_of('MASK')
+        else:
+            mask_ext = None
+
+    for alignment in ['sangle']:
+        try:
+            newsci = project_one(fn, sci_ext, alignment)
+        except (m.MontageError, AssertionError) as e:
+            return str(e)
+
+        if mask_ext is not None:
+            try:
+                newmask = project_one(fn, mask_ext, alignment)
+            except (m.MontageError, AssertionError) as e:
+                return str(e)
+
+        with fits.open(fn, mode='update') as hdu:
+            append_image_to(hdu, newsci, alignment.upper())
+            if mask_ext is not None:
+                append_image_to(hdu, newmask, alignment.upper() + 'MASK')
+
+    # background estimate
+    meta = update_background(fn)
+    meta['sanglewcs'] = WCS(newsci.header).to_header_string()
+
+    return meta
+
+
+def add_to_cube(z, foundid, fn):
+    """Add projected images to the target's cube."""
+    from astropy.io import fits
+    from . import cube
+
+    desg = z.db.execute('SELECT desg FROM found WHERE foundid=?',
+                        [foundid]).fetchone()[0]
+    with fits.open(fn) as hdu:
+        mask = hdu['SANGLEMASK'].data if 'SANGLEMASK' in hdu else None
+        cube.add(z.db, z.config['cube path'], foundid, desg,
+                 hdu['SANGLE'].data, mask)
+
+
+def pending(z, desg=None, force=False, foundids=None, limit=None):
+    """Downloaded cutouts to project.
+
+    Parameters
+    ----------
+    z : ZChecker
+    desg : string, optional
+      Only this target.
+    force : bool, optional
+      Include cutouts already projected.
+    foundids : list of int, optional
+      Only these detections.
+    limit : int, optional
+      Return at most this many.
+
+    Returns
+    -------
+    rows : list
+      foundid and archivefile of each cutout.
+
+    """
+
+    cmd = '''
+    SELECT found.foundid,archivefile FROM found
+    LEFT JOIN projections ON found.foundid=projections.foundid
+    WHERE sciimg!=0
+    '''
+
+    bindings = []
+    if not force:
+        cmd += ' AND sangleimg IS NULL'
+    if desg is not None:
+        cmd += ' AND desg=?'
+        bindings.append(desg)
+    if foundids is not None:
+        cmd += ' AND found.foundid IN ({})'.format(
+            ','.join('?' * len(foundids)))
+        bindings.extend(foundids)
+    cmd += ' ORDER BY desg + 0,desg'
+    if limit is not None:
+        cmd += ' LIMIT {:d}'.format(limit)
+
+    return z.db.execute(cmd, bindings).fetchall()
+
+
+def process(z, pool, rows, bar=None):
+    """Project cutouts in a process pool, and record the results.
+
+    Parameters
+    ----------
+    z : ZChecker
+    pool : multiprocessing.Pool
+    rows : list
+      foundid and archivefile of each cutout, see `pending`.
+    bar : ProgressBar, optional
+      Updated for each cutout.
+
+    Returns
+    -------
+    projected : list of int
+      foundids of the projected cutouts.
+
+    """
+
+    import os
+    from . import profiling
+
+    path = z.config['cutout path'] + os.path.sep
+    cube_path = z.config.get('cube path')
+
+    if len(rows) == 0:
+        return []
+
+    foundids, archivefiles = list(zip(*rows))
+    with profiling.span('projection'):
+        status = pool.map(project, [path + f for f in archivefiles])
+
+    projected = []
+    for i in range(len(foundids)):
+        if isinstance(status[i], dict):
+            z.db.execute('''
+            INSERT OR REPLACE INTO projections
+            (foundid,vangleimg,sangleimg) VALUES (?,0,1)
+            ''', [foundids[i]])
+            z.update_cutout_meta(foundids[i], status[i])
+            if cube_path is not None:
+                try:
+                    with profiling.span('cube'):
+                        add_to_cube(z, foundids[i], path + archivefiles[i])
+                except (OSError, ValueError) as e:
+                    z.logger.error(
+                        '    Error adding {} to cube: {}'.format(
+                            archivefiles[i], str(e)))
+            z.db.commit()
+            projected.append(foundids[i])
+        else:
+            z.logger.error('    Error projecting {}: {}'.format(
+                archivefiles[i], status[i]))
+
+        if bar is not None:
+            bar.update()
+
+    z.db.commit()
+    return projected
@@ -0,0 +1,413 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""remote
+=========
+
+Client-side protection for remote services.
+
+Each remote service (IRSA, JPL/Horizons) has a `Service` with a
+token-bucket rate limiter, jittered exponential retries for transient
+failures, and a circuit breaker that fails fast after repeated
+failures.  Services are shared by all threads in the process.  Limits
+are set with the "rate limits" configuration key, e.g.,
+
+{
+  "rate limits": {
+    "irsa": {"rate": 2, "burst": 4, "retries": 4},
+    "horizons": {"rate": 1, "burst": 4, "threshold": 5, "reset": 60}
+  }
+}
+
+The service base URLs may be changed with the "irsa url" and
+"horizons url" configuration keys, e.g., to use the local stand-in
+server in `zchecker.standin`.
+
+rate : requests per second
+burst : maximum number of requests sent without waiting
+retries : number of times to retry a transient failure
+backoff : initial retry delay, seconds, doubled with each retry
+max backoff : maximum retry delay, seconds
+threshold : consecutive failures that open the circuit
+reset : seconds to wait before trying an open circuit again
+
+"""
+
+# HTTP status codes worth retrying
+TRANSIENT = (408, 429, 500, 502, 503, 504)
+
+defaults = {
+    'irsa': {'rate': 2, 'burst': 4, 'retries': 4, 'backoff': 1,
+             'max backoff': 60, 'threshold': 5, 'reset': 60},
+    'horizons': {'rate': 1, 'burst': 4, 'retries': 4, 'backoff': 1,
+                 'max backoff': 60, 'threshold': 5, 'reset': 60}
+}
+
+# base URLs; None for the astroquery default
+urls = {
+    'irsa': 'https://irsa.ipac.caltech.edu',
+    'horizons': None
+}
+
+services = {}
+
+
+class TokenBucket:
+    """Thread-safe token-bucket rate limiter.
+
+    Parameters
+    ----------
+    rate : float
+      Tokens added per second.  Zero or less for no limit.
+    burst : int
+      Bucket size.
+
+    """
+
+    def __init__(self, rate, burst):
+        import time
+        import threading
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if needed.
+
+        Returns
+        -------
+        wait : float
+          Time spent waiting, seconds.
+
+        """
+
+        import time
+
+        if self.rate <= 0:
+            return 0
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            # negative tokens are reservations by waiting threads
+            wait = max(0, -self.tokens / self.rate)
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+
+class CircuitBreaker:
+    """Fail fast after repeated failures.
+
+    The circuit opens after `threshold` consecutive failures.  After
+    `reset` seconds, one trial request is allowed through; the
+    circuit closes on success, or opens again on failure.
+
+    Parameters
+    ----------
+    threshold : int
+      Consecutive failures that open the circuit.
+    reset : float
+      Seconds to wait before allowing a trial request.
+
+    """
+
+    def __init__(self, threshold, reset):
+        import threading
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        import time
+        if self.opened is None:
+            return 'closed'
+        elif time.monotonic() - self.opened >= self.reset:
+            return 'half-open'
+        else:
+            return 'open'
+
+    def allow(self):
+        """`True` if a request may be sent."""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            elif state == 'half-open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self._trial = False
+
+    def failure(self):
+        """Record a failure.
+
+        Returns
+        -------
+        tripped : bool
+          `True` if this failure opened the circuit.
+
+        """
+
+        import time
+        with self._lock:
+            self.failures += 1
+            tripped = (self._trial
+                       or (self.opened is None
+                           and self.failures >= self.threshold))
+            if tripped:
+                self.opened = time.monotonic()
+            self._trial = False
+            return tripped
+
+
+class Service:
+    """Rate limited, retrying, circuit-broken remote service.
+
+    Parameters
+    ----------
+    name : string
+      Service name, for messages.
+    url : string, optional
+      Base URL of the service, or `None` for the default.
+    **limits
+      Keys from the "rate limits" configuration, see module
+      documentation.
+
+    """
+
+    def __init__(self, name, url=None, **limits):
+        import threading
+        self.name = name
+        self.url = urls.get(name) if url is None else url.rstrip('/')
+        self.limits = dict(defaults.get(name, defaults['irsa']))
+        self.limits.update(limits)
+        self.bucket = TokenBucket(self.limits['rate'], self.limits['burst'])
+        self.breaker = CircuitBreaker(self.limits['threshold'],
+                                      self.limits['reset'])
+        self.counters = dict.fromkeys(
+            ['calls', 'requests', 'retries', 'throttled', 'failed',
+             'rejected', 'tripped'], 0)
+        self.counters['throttle wait'] = 0.0
+        self._lock = threading.Lock()
+
+    def _count(self, k, n=1):
+        with self._lock:
+            self.counters[k] += n
+
+    def delay(self, attempt, error=None):
+        """Jittered exponential retry delay, seconds."""
+        import random
+        d = min(self.limits['max backoff'],
+                self.limits['backoff'] * 2**attempt)
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            d = max(d, min(retry_after, self.limits['max backoff']))
+        return d * random.uniform(0.5, 1)
+
+    def call(self, func, *args, **kwargs):
+        """Call `func`, retrying transient failures.
+
+        Raises
+        ------
+        CircuitOpenError
+          If the circuit is open.
+
+        The last exception raised by `func` is re-raised when it is
+        not transient, or when retries are exhausted.
+
+        """
+
+        import time
+        from .exceptions import CircuitOpenError
+
+        self._count('calls')
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self._count('rejected')
+                raise CircuitOpenError(
+                    '{}: too many failures, not sending requests for up to'
+                    ' {} s'.format(self.name, self.limits['reset']))
+
+            wait = self.bucket.acquire()
+            if wait > 0:
+                self._count('throttled')
+                self._count('throttle wait', wait)
+
+            self._count('requests')
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not transient(e):
+                    # the service answered, the request was bad
+                    self.breaker.success()
+                    raise
+
+                self._count('failed')
+                if self.breaker.failure():
+                    self._count('tripped')
+
+                if attempt >= self.limits['retries']:
+                    raise
+
+                self._count('retries')
+                time.sleep(self.delay(attempt, e))
+                attempt += 1
+                continue
+
+            self.breaker.success()
+            return result
+
+    def summary(self):
+        """One line summary of the counters."""
+        c = self.counters
+        return ('{}: {} calls, {} requests, {} retries, {} failures,'
+                ' {} throttled ({:.1f} s), circuit opened {} times,'
+                ' {} rejected').format(
+                    self.name, c['calls'], c['requests'], c['retries'],
+                    c['failed'], c['throttled'], c['throttle wait'],
+                    c['tripped'], c['rejected'])
+
+
+def configure(limits=None, urls=None):
+    """Set up services from the configuration.
+
+    Services are replaced, resetting their counters.
+
+    Parameters
+    ----------
+    limits : dict, optional
+      Service name and limits, i.e., "rate limits".
+    urls : dict, optional
+      Service name and base URL, `None` for the default.
+
+    """
+
+    limits = {} if limits is None else limits
+    urls = {} if urls is None else urls
+    for name in set(defaults) | set(limits):
+        services[name] = Service(name, url=urls.get(name),
+                                 **limits.get(name, {}))
+
+
+def service(name):
+    """Get a service, created with the default limits as needed."""
+    if name not in services:
+        services[name] = Service(name)
+    return services[name]
+
+
+def stats():
+    """Counters for each service.
+
+    Returns
+    -------
+    stats : dict
+
+    """
+    return dict([(name, dict(s.counters)) for name, s in services.items()])
+
+
+def transient(e):
+    """`True` if the exception is a transient failure worth retrying."""
+    import requests
+    from .exceptions import RemoteError
+
+    if isinstance(e, RemoteError):
+        return e.status is None or e.status in TRANSIENT
+    elif isinstance(e, (requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout)):
+        return True
+    elif isinstance(e, requests.exceptions.HTTPError):
+        response = getattr(e, 'response', None)
+        return (response is not None
+                and response.status_code in TRANSIENT)
+    return False
+
+
+def check(response):
+    """Raise `RemoteError` for HTTP error responses.
+
+    Parameters
+    ----------
+    response : requests.Response
+
+    """
+
+    from .exceptions import RemoteError
+
+    if response.status_code < 400:
+        return
+
+    retry_after = response.headers.get('Retry-After')
+    try:
+        retry_after = float(retry_after)
+    except (TypeError, ValueError):
+        retry_after = None
+
+    raise RemoteError('{} {}: {}'.format(
+        response.status_code, response.reason, response.url),
+        status=response.status_code, retry_after=retry_after)
+
+
+def get(name, url, **kwargs):
+    """HTTP GET through a service.
+
+    Parameters
+    ----------
+    name : string
+      Service name.
+    url : string
+    **kwargs
+      Keyword arguments for `requests.get`.
+
+    Returns
+    -------
+    response : requests.Response
+
+    """
+
+    import requests
+
+    def _get():
+        r = requests.get(url, **kwargs)
+        check(r)
+        return r
+
+    return service(name).call(_get)
+
+
+def rebase(session, src, dst):
+    """Send a session's requests for one base URL to another.
+
+    Parameters
+    ----------
+    session : requests.Session
+    src, dst : string
+      Original and new base URLs.
+
+    """
+
+    from requests.adapters import HTTPAdapter
+
+    class Rebase(HTTPAdapter):
+        def send(self, request, **kwargs):
+            request.url = dst + request.url[len(src):]
+            return super().send(request, **kwargs)
+
+    session.mount(src, Rebase())
@@ -1,4 +1,23 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
+
+# foundcat rows from found and obs, see the foundcat table
+_foundcat_select = '''
+    SELECT
+      foundid,desg,CAST(found.obsjd AS FLOAT),found.ra,found.dec,vmag,rh,
+      rdot,delta,found.pid,nightid,infobits,filtercode,
+      printf("https://irsa.ipac.caltech.edu/ibe/data/ztf/products/sci/%s/%s/%s/ztf_%s_%06d_%s_c%02d_o_q%1d_sciimg.fits?center=%f,%fdeg",
+        substr(filefracday,1,4),
+        substr(filefracday,5,4),
+        substr(filefracday,9),
+        filefracday,
+        field,
+        filtercode,
+        ccdid,
+        qid,
+        found.ra,
+        found.dec)
+    FROM found INNER JOIN obs ON obs.pid=found.pid'''
+
 schema = [
     '''CREATE TABLE IF NOT EXISTS nights(
     nightid INTEGER PRIMARY KEY,
@@ -45,6 +64,9 @@ schema = [
     FOREIGN KEY(nightid) REFERENCES nights(nightid)
     )''',
 
+    # time-ordered quad walks, e.g., ZChecker.lookup
+    'CREATE INDEX IF NOT EXISTS obs_obsjd ON obs(obsjd)',
+
     '''CREATE TABLE IF NOT EXISTS eph(
     desg TEXT,
     jd FLOAT,
@@ -53,11 +75,24 @@ schema = [
     dra FLOAT,
     ddec FLOAT,
     vmag FLOAT,
-    retrieved TEXT
+    retrieved TEXT,
+    ra3sig FLOAT,
+    dec3sig FLOAT
     )''',
 
     'CREATE UNIQUE INDEX IF NOT EXISTS desg_jd ON eph(desg,jd)',
 
+    # ephemeris coverage intervals, see ZChecker.update_ephcov
+    '''CREATE TABLE IF NOT EXISTS ephcov(
+    desg TEXT,
+    jd_start FLOAT,
+    jd_end FLOAT,
+    n INTEGER,
+    retrieved TEXT
+    )''',
+
+    'CREATE INDEX IF NOT EXISTS ephcov_desg ON ephcov(desg)',
+
     '''CREATE TABLE IF NOT EXISTS found(
     foundid INTEGER PRIMARY KEY,
     desg TEXT,
@@ -94,6 +129,28 @@ schema = [
 
     'CREATE UNIQUE INDEX IF NOT EXISTS desg_pid ON found(desg,pid)',
 
+    # fov_search history
+    '''CREATE TABLE IF NOT EXISTS searched(
+    desg TEXT,
+    nightid INTEGER,
+    retrieved TEXT,
+    nframes INTEGER,
+    vlim FLOAT,
+    prune TEXT,
+    FOREIGN KEY(nightid) REFERENCES nights(nightid)
+    )''',
+
+    'CREATE UNIQUE INDEX IF NOT EXISTS desg_nightid ON searched(desg,nightid)',
+
+    # nightly sky coverage maps, see coverage.py
+    '''CREATE TABLE IF NOT EXISTS coverage(
+    nightid INTEGER PRIMARY KEY,
+    jd_start FLOAT,
+    jd_end FLOAT,
+    cells BLOB,
+    FOREIGN KEY(nightid) REFERENCES nights(nightid)
+    )''',
+
     '''CREATE VIEW IF NOT EXISTS obsnight AS
     SELECT * FROM obs INNER JOIN nights ON obs.nightid=nights.nightid''',
 
@@ -118,6 +175,45 @@ schema = [
         found.dec)
     FROM found INNER JOIN obs ON obs.pid=found.pid''',
 
+    # materialized found/obs/cutouturl join, maintained by triggers
+    '''CREATE TABLE IF NOT EXISTS foundcat(
+    foundid INTEGER PRIMARY KEY,
+    desg TEXT,
+    obsjd FLOAT,
+    ra FLOAT,
+    dec FLOAT,
+    vmag FLOAT,
+    rh FLOAT,
+    rdot FLOAT,
+    delta FLOAT,
+    pid INTEGER,
+    nightid INTEGER,
+    infobits INTEGER,
+    filtercode TEXT,
+    url TEXT,
+    FOREIGN KEY(foundid) REFERENCES found(foundid)
+    )''',
+
+    'CREATE INDEX IF NOT EXISTS foundcat_desg ON foundcat(desg)',
+    'CREATE INDEX IF NOT EXISTS foundcat_nightid ON foundcat(nightid)',
+    'CREATE INDEX IF NOT EXISTS foundcat_obsjd ON foundcat(obsjd)',
+
+    '''CREATE TRIGGER IF NOT EXISTS insert_found_foundcat
+    AFTER INSERT ON found
+    BEGIN
+      INSERT OR REPLACE INTO foundcat''' + _foundcat_select + '''
+      WHERE foundid=new.foundid;
+    END;
+    ''',
+
+    '''CREATE TRIGGER IF NOT EXISTS update_found_foundcat
+    AFTER UPDATE OF desg,obsjd,ra,dec,vmag,rh,rdot,delta,pid ON found
+    BEGIN
+      INSERT OR REPLACE INTO foundcat''' + _foundcat_select + '''
+      WHERE foundid=new.foundid;
+    END;
+    ''',
+
     # for zproject
     '''CREATE TABLE IF NOT EXISTS projections(
     foundid INTEGER PRIMARY KEY,
@@ -134,6 +230,49 @@ schema = [
     FOREIGN KEY(foundid) REFERENCES found(foundid)
     )''',
 
+    # cutout header keywords, recorded when files are written, see
+    # cutout.py; bgmean through sanglewcs are from zproject
+    '''CREATE TABLE IF NOT EXISTS cutout_meta(
+    foundid INTEGER PRIMARY KEY,
+    desg TEXT,
+    obsjd FLOAT,
+    dbpid INTEGER,
+    exposure FLOAT,
+    gain FLOAT,
+    magzp FLOAT,
+    rh FLOAT,
+    delta FLOAT,
+    phase FLOAT,
+    rdot FLOAT,
+    selong FLOAT,
+    sangle FLOAT,
+    vangle FLOAT,
+    trueanom FLOAT,
+    tmtp FLOAT,
+    tgtra FLOAT,
+    tgtdec FLOAT,
+    tgtdra FLOAT,
+    tgtddec FLOAT,
+    tgtrasig FLOAT,
+    tgtdesig FLOAT,
+    bgmean FLOAT,
+    bgmedian FLOAT,
+    bgstdev FLOAT,
+    nbg INTEGER,
+    sanglewcs TEXT,
+    FOREIGN KEY(foundid) REFERENCES found(foundid)
+    )''',
+
+    # projected cutout store index, see cube.py
+    '''CREATE TABLE IF NOT EXISTS cube(
+    foundid INTEGER PRIMARY KEY,
+    desg TEXT,
+    plane INTEGER,
+    FOREIGN KEY(foundid) REFERENCES found(foundid)
+    )''',
+
+    'CREATE INDEX IF NOT EXISTS cube_desg ON cube(desg)',
+
     # triggers and file clean up
     '''CREATE TABLE IF NOT EXISTS stale_files(
       path TEXT,
@@ -155,6 +294,27 @@ schema = [
     END;
     ''',
 
+    '''CREATE TRIGGER IF NOT EXISTS delete_found_cutout_meta
+    BEFORE DELETE ON found
+    BEGIN
+      DELETE FROM cutout_meta WHERE foundid=old.foundid;
+    END;
+    ''',
+
+    '''CREATE TRIGGER IF NOT EXISTS delete_found_cube
+    BEFORE DELETE ON found
+    BEGIN
+      DELETE FROM cube WHERE foundid=old.foundid;
+    END;
+    ''',
+
+    '''CREATE TRIGGER IF NOT EXISTS delete_found_foundcat
+    BEFORE DELETE ON found
+    BEGIN
+      DELETE FROM foundcat WHERE foundid=old.foundid;
+    END;
+    ''',
+
     '''CREATE TRIGGER IF NOT EXISTS delete_obs BEFORE DELETE ON obs
     BEGIN
       DELETE FROM found WHERE pid=old.pid;
@@ -166,4 +326,41 @@ schema = [
       DELETE FROM obs WHERE nightid=old.nightid;
     END;
     ''',
+
+    '''CREATE TRIGGER IF NOT EXISTS delete_nights_searched
+    BEFORE DELETE ON nights
+    BEGIN
+      DELETE FROM searched WHERE nightid=old.nightid;
+    END;
+    ''',
+
+    '''CREATE TRIGGER IF NOT EXISTS delete_nights_coverage
+    BEFORE DELETE ON nights
+    BEGIN
+      DELETE FROM coverage WHERE nightid=old.nightid;
+    END;
+    ''',
 ]
+
+# columns added after the table was first defined: table, column, type
+columns = [
+    ('eph', 'ra3sig', 'FLOAT'),
+    ('eph', 'dec3sig', 'FLOAT'),
+    ('searched', 'prune', 'TEXT'),
+]
+
+# tables filled from existing data when first created: table, statement
+backfill = [
+    ('foundcat', 'INSERT OR IGNORE INTO foundcat' + _foundcat_select),
+]
+
+# stored as the database user_version after setup; any change to the
+# statements above changes the version and triggers setup on connect
+def _version():
+    import zlib
+    text = '\n'.join(schema + ['{} {} {}'.format(*c) for c in columns]
+                     + ['{} {}'.format(*b) for b in backfill])
+    return zlib.crc32(text.encode()) & 0x7fffffff
+
+
+version = _version()
@@ -0,0 +1,295 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""server
+=========
+
+Long-running ZChecker service over a local Unix socket.
+
+`zchecker serve` keeps one `ZChecker` instance open: the database
+connection and page cache, the ephemeris cache, and the imported
+modules stay warm between requests.  Each client connection is read
+in its own thread, but requests are run one at a time, in the order
+received, by the thread that called `serve`, so writes are serialized
+on the single database connection.  A client that keeps its
+connection open does not block the others.  Writes by other
+processes are detected with `ZChecker.refresh` before each request.
+
+Protocol: the client sends one JSON object per line,
+
+  {"command": "list-nights", "args": {"exposures": true}}
+
+and the server replies with zero or more log lines, as they are
+emitted,
+
+  {"log": "INFO: Searching for 3 objects."}
+
+followed by one result line,
+
+  {"status": "ok", "result": ..., "elapsed": 0.002}
+  {"status": "error", "message": "...", "elapsed": 0.002}
+
+A connection may carry any number of requests.  Commands:
+
+  ping                                  null
+  list-nights   exposures               list of strings
+  list-objects                          list of [desg, jd_start, jd_end, n]
+  found         desg, start, end        list of foundcat rows, as objects
+  lookup        desg, start, end,       list of `ZChecker.lookup` rows,
+                margin, confirm         as objects
+  search        start, end, objects,    null
+                vlim, force,
+                depth_margin,
+                skip_flagged
+  shutdown                              null, then the server exits
+
+Dates are UT, YYYY-MM-DD.  From the command line, pass ``--socket``
+to `zchecker` to send the search, lookup, and list commands to the
+server.
+
+"""
+
+
+def _found(z, desg, start=None, end=None):
+    """Found detections of one target, from foundcat."""
+    from astropy.time import Time
+
+    cmd = 'SELECT * FROM foundcat WHERE desg=?'
+    args = [desg]
+    if start is not None:
+        cmd += ' AND obsjd>=?'
+        args.append(Time(start).jd)
+    if end is not None:
+        cmd += ' AND obsjd<=?'
+        args.append(Time(end).jd + 1.0)
+    cmd += ' ORDER BY obsjd'
+    return [dict(row) for row in z.db.execute(cmd, args)]
+
+
+def _search(z, start, end, objects=None, vlim=22.0, force=False,
+            depth_margin=None, skip_flagged=False):
+    z.fov_search(start, end, objects=objects, vlim=vlim, force=force,
+                 depth_margin=depth_margin, skip_flagged=skip_flagged)
+
+
+# command name: function(z, **args) returning a JSON serializable result
+commands = {
+    'ping': lambda z: None,
+    'list-nights': lambda z, exposures=True: z.available_nights(
+        exposures=exposures),
+    'list-objects': lambda z: [list(row) for row in z.available_objects()],
+    'found': _found,
+    'lookup': lambda z, desg, start, end, margin=10, confirm=False: z.lookup(
+        desg, start, end, margin=margin, confirm=confirm),
+    'search': _search,
+}
+
+
+def handler(z, pending):
+    """Request handler class for `socketserver`.
+
+    Parameters
+    ----------
+    z : ZChecker
+      Handles all requests.
+    pending : queue.Queue
+      Requests are passed to the serving thread as (function, event)
+      on this queue: the serving thread calls the function, then sets
+      the event.
+
+    """
+
+    import json
+    import time
+    import logging
+    import threading
+    from socketserver import StreamRequestHandler
+
+    class LogStream(logging.Handler):
+        """Send log records to the client."""
+
+        def __init__(self, wfile):
+            super().__init__(logging.INFO)
+            self.wfile = wfile
+            self.connected = True
+            self.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+
+        def emit(self, record):
+            # a client that hung up does not interrupt the request
+            if not self.connected:
+                return
+            line = json.dumps({'log': self.format(record)}) + '\n'
+            try:
+                self.wfile.write(line.encode())
+                self.wfile.flush()
+            except OSError:
+                self.connected = False
+
+    class ZCheckerHandler(StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                t0 = time.monotonic()
+                try:
+                    request = json.loads(line.decode())
+                    command = request['command']
+                    args = request.get('args', {})
+                except (ValueError, KeyError, AttributeError) as e:
+                    self.reply(t0, 'error', message='Bad request: {}'.format(
+                        str(e)))
+                    continue
+
+                if command == 'shutdown':
+                    self.reply(t0, 'ok', result=None)
+                    self.server.shutdown_requested = True
+                    # wake the serving thread
+                    pending.put(None)
+                    return
+
+                if command not in commands:
+                    self.reply(t0, 'error', message='Unknown command: {}'.format(
+                        command))
+                    continue
+
+                outcome = {}
+
+                def run():
+                    stream = LogStream(self.wfile)
+                    z.logger.addHandler(stream)
+                    try:
+                        z.refresh()
+                        z.logger.debug('Request: {}'.format(
+                            line.decode().strip()))
+                        outcome['result'] = commands[command](z, **args)
+                        z.db.commit()
+                    except Exception as e:
+                        z.db.rollback()
+                        z.logger.error(str(e))
+                        outcome['error'] = str(e)
+                    finally:
+                        z.logger.removeHandler(stream)
+
+                done = threading.Event()
+                pending.put((run, done))
+                done.wait()
+
+                if 'error' in outcome:
+                    self.reply(t0, 'error', message=outcome['error'])
+                else:
+                    self.reply(t0, 'ok', result=outcome['result'])
+
+        def reply(self, t0, status, **kwargs):
+            kwargs['status'] = status
+            kwargs['elapsed'] = time.monotonic() - t0
+            self.wfile.write((json.dumps(kwargs) + '\n').encode())
+            self.wfile.flush()
+
+    return ZCheckerHandler
+
+
+def serve(z, path):
+    """Serve requests on a Unix socket until a shutdown request.
+
+    Parameters
+    ----------
+    z : ZChecker
+      Handles all requests.
+    path : string
+      Socket file name.  A stale socket left by a previous server is
+      replaced.
+
+    """
+
+    import os
+    import queue
+    import socket
+    import signal
+    import threading
+    from socketserver import ThreadingUnixStreamServer
+    from .exceptions import ZCheckerError
+
+    if os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX) as s:
+                s.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(path)
+        else:
+            raise ZCheckerError(
+                'A server is already listening on {}'.format(path))
+
+    # SIGTERM exits through the normal clean up below
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, terminate)
+
+    # connections are read in threads, requests are run here
+    pending = queue.Queue()
+    server = ThreadingUnixStreamServer(path, handler(z, pending))
+    server.daemon_threads = True
+    server.shutdown_requested = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    z.logger.info('Serving on {}'.format(path))
+    try:
+        while not server.shutdown_requested:
+            item = pending.get()
+            if item is None:
+                continue
+            run, done = item
+            try:
+                run()
+            finally:
+                done.set()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.unlink(path)
+        z.logger.info('Server stopped.')
+
+
+def request(path, command, log=None, **args):
+    """Send a request to a ZChecker server.
+
+    Parameters
+    ----------
+    path : string
+      Server socket file name.
+    command : string
+      Command name, see module documentation.
+    log : function, optional
+      Called with each log line sent by the server.
+    **args
+      Command arguments.
+
+    Returns
+    -------
+    result
+      The command result.
+
+    Raises
+    ------
+    ZCheckerError
+      For error replies.
+
+    """
+
+    import json
+    import socket
+    from .exceptions import ZCheckerError
+
+    with socket.socket(socket.AF_UNIX) as s:
+        s.connect(path)
+        s.sendall((json.dumps({'command': command, 'args': args})
+                   + '\n').encode())
+        with s.makefile('rb') as inf:
+            for line in inf:
+                reply = json.loads(line.decode())
+                if 'log' in reply:
+                    if log is not None:
+                        log(reply['log'])
+                    continue
+                if reply['status'] != 'ok':
+                    raise ZCheckerError(reply['message'])
+                return reply['result']
+
+    raise ZCheckerError('Connection closed by server.')
@@ -0,0 +1,515 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""stack
+========
+
+Nightly stacks of projected cutouts, used by zstack and `zchecker
+nightly`.
+
+For each target and night, the projected images in each filter are
+background subtracted, scaled to rh = delta = 1 au (by the coma model,
+delta**1, or the surface model, delta**2), and median combined.  The
+median of the preceding baseline period is subtracted from the
+nightly stack, in a second extension.  Only images without infobits
+flags are stacked.  Headers are built from the cutout_meta table.
+
+"""
+
+
+class BadDataSet(Exception):
+    pass
+
+
+def groupby(values, keys):
+    """Sort values into `dict` via `set(key)`."""
+    import numpy as np
+    groups = dict()
+    keys = np.array(keys)
+    values = np.array(values)
+    for k in set(keys):
+        i = keys == k
+        groups[k] = values[i]
+    return groups
+
+
+def data_to_stack(z, t_baseline, desg=None, restack=False, nightid=None):
+    """Find and return images to stack.
+
+    Parameters
+    ----------
+    z : ZChecker
+    t_baseline : float
+      Number of days before each night to search for baseline images.
+    desg : string, optional
+      Only stack this target.
+    restack : bool, optional
+      Include nights already stacked.
+    nightid : int, optional
+      Only stack this night.
+
+    Yields
+    ------
+    n : int
+      Number of sets remaining, including this one.
+    foundids : ndarray
+      Detections in the set.
+    fn : string
+      Stack file name, relative to the stack path.
+    nightly, baseline : ndarray
+      foundids of the nightly and baseline images.
+
+    """
+    import numpy as np
+    from astropy.time import Time
+
+    # estimate number of target-nights to stack
+    if desg is not None:
+        desg_match = ' AND desg=?'
+        parameters = [desg]
+    else:
+        desg_match = ''
+        parameters = []
+
+    # find any night, or only those with images not yet stacked
+    if restack:
+        stack_match = ''
+    else:
+        stack_match = 'AND (stacked=0 OR stacked IS NULL)'
+
+    if nightid is not None:
+        stack_match += ' AND nightid={:d}'.format(nightid)
+
+    # find nights with projected images, respecting desg and restack
+    rows = z.db.execute('''
+    SELECT count(DISTINCT filtercode) FROM foundcat
+    INNER JOIN projections ON foundcat.foundid = projections.foundid
+    LEFT JOIN stacks ON foundcat.foundid = stacks.foundid
+    WHERE infobits=0
+      AND sangleimg!=0
+    ''' + desg_match + '''
+    ''' + stack_match + '''
+    GROUP BY nightid
+    ''', parameters).fetchall()
+    count = sum([row[0] for row in rows])
+    n = count
+    z.logger.info('{} sets to stack.'.format(count))
+
+    nights = z.db.execute('''
+    SELECT DISTINCT nightid FROM foundcat
+    INNER JOIN projections ON foundcat.foundid = projections.foundid
+    LEFT JOIN stacks ON foundcat.foundid = stacks.foundid
+    WHERE infobits=0
+      AND sangleimg!=0
+    ''' + stack_match + '''
+    ''' + desg_match, parameters).fetchall()
+    nights = list([n[0] for n in nights])
+
+    # loop by day, target
+    for night in nights:
+        parameters = [night]
+        if desg is not None:
+            parameters += [desg]
+
+        targets = z.db.execute('''
+        SELECT desg,AVG(rh),AVG(rdot) FROM foundcat
+        INNER JOIN projections ON foundcat.foundid = projections.foundid
+        WHERE infobits=0
+          AND sangleimg!=0
+          AND nightid=?
+        ''' + desg_match + '''
+        GROUP BY desg
+        ''', parameters).fetchall()
+        targets = list(targets)
+
+        for target, rh, rdot in targets:
+            rows = z.db.execute('''
+            SELECT foundcat.foundid,obsjd,filtercode FROM foundcat
+            INNER JOIN projections ON foundcat.foundid = projections.foundid
+            WHERE infobits=0
+              AND sangleimg!=0
+              AND nightid=?
+              AND desg=?
+            ''', [night, target]).fetchall()
+            foundid, obsjd, filters = list(zip(*rows))
+            foundid = groupby(foundid, filters)
+            baseline_start = float(min(obsjd))
+            obsjd = groupby(np.array(obsjd, float), filters)
+            nightly = foundid
+
+            rows = z.db.execute('''
+            SELECT filtercode,foundcat.foundid FROM foundcat
+            INNER JOIN projections ON foundcat.foundid = projections.foundid
+            WHERE infobits=0
+              AND sangleimg!=0
+              AND desg=?
+              AND obsjd<?
+              AND obsjd>=?
+            ''', [target, baseline_start, baseline_start - t_baseline - 0.5]
+            ).fetchall()
+            if len(rows) == 0:
+                baseline = {}
+            else:
+                filters, foundids = list(zip(*rows))
+                baseline = groupby(foundids, filters)
+
+            # fill missing baseline filters
+            for k in nightly.keys():
+                if k not in baseline:
+                    baseline[k] = []
+
+            _desg = target.lower().replace(' ', '').replace('/', '')
+            for filt in nightly.keys():
+                date = Time(obsjd[filt].mean(), format='jd')
+                fn = ('{desg}/{desg}-{date}-{prepost}{rh:.3f}-{filt}'
+                      '-ztf-stack.fits.gz').format(
+                          desg=_desg,
+                          date=date.iso[:10].replace('-', ''),
+                          prepost='pre' if rdot < 0 else 'post',
+                          rh=rh,
+                          filt=filt)
+                yield n, foundid[filt], fn, nightly[filt], baseline[filt]
+                n -= 1
+
+
+def check_target_paths(path, fn):
+    import os
+    d = os.path.dirname(os.path.join(path, fn))
+    if not os.path.exists(d):
+        os.mkdir(d)
+
+    return os.path.exists(os.path.join(path, fn))
+
+
+def index_headers(z, path):
+    """Record cutout_meta for projected files that lack it.
+
+    Only needed for files written before the cutout_meta table existed.
+
+    """
+    import os
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    from . import cutout
+
+    rows = z.db.execute('''
+    SELECT found.foundid,archivefile FROM found
+    INNER JOIN projections ON found.foundid=projections.foundid
+    LEFT JOIN cutout_meta ON found.foundid=cutout_meta.foundid
+    WHERE sangleimg!=0
+      AND (cutout_meta.foundid IS NULL OR sanglewcs IS NULL)
+    ''').fetchall()
+    if len(rows) == 0:
+        return
+
+    z.logger.info('Indexing {} cutout headers.'.format(len(rows)))
+    for foundid, archivefile in rows:
+        try:
+            with fits.open(os.path.join(path, archivefile)) as hdu:
+                meta = cutout.meta(hdu['SCI'].header,
+                                   cutout.META + cutout.PROJECTION[:-1])
+                meta['sanglewcs'] = WCS(
+                    hdu['SANGLE'].header).to_header_string()
+        except (OSError, KeyError) as e:
+            z.logger.error('    Error reading {}: {}'.format(
+                archivefile, str(e)))
+            continue
+        z.update_cutout_meta(foundid, meta)
+    z.db.commit()
+
+
+def header(z, foundids):
+    """New FITS header based on this image list.
+
+    Built from the cutout_meta table, no files are read.  Images
+    without cutout_meta are not counted, as `combine` does not stack
+    them; see `index_headers`.
+
+    """
+    from astropy.io import fits
+    from astropy.wcs import WCS
+
+    foundids = [int(i) for i in foundids]
+    where = ' WHERE foundid IN ({})'.format(','.join('?' * len(foundids)))
+    
+    h = fits.Header()
+    h['BUNIT'] = 'e-/s'
+    h['ORIGIN'] = 'Zwicky Transient Facility', 'Data origin'
+    h['OBSERVER'] = 'ZTF Robotic Software', 'Observer'
+    h['INSTRUME'] = 'ZTF/MOSAIC', 'Instrument name'
+    h['OBSERVAT'] = 'Palomar Observatory', 'Observatory'
+    h['TELESCOP'] = 'Palomar 48-inch', 'Observatory telescope'
+    h['OBSLON'] = -116.8597, 'Observatory longitude (deg)'
+    h['OBSLAT'] = 33.3483, 'Observatory latitude (deg E)'
+    h['OBSALT'] = 1706., 'Observatory altitude (m)'
+    h['IMGTYPE'] = 'object', 'Image type'
+
+    rows = []
+    if len(foundids) > 0:
+        rows = z.db.execute(
+            'SELECT dbpid,desg,sanglewcs FROM cutout_meta' + where
+            + ' ORDER BY obsjd', foundids).fetchall()
+    if len(rows) < len(foundids):
+        z.logger.warning('    {} images without cutout_meta are not'
+                         ' stacked.'.format(len(foundids) - len(rows)))
+
+    h['NIMAGES'] = len(rows), 'Number of images in stack'
+    if len(rows) == 0:
+        h['EXPOSURE'] = 0, 'Total stack exposure time (s)'
+        return h
+
+    exposure, obsjd1, obsjdn, obsjdm = z.db.execute(
+        'SELECT total(exposure),min(obsjd),max(obsjd),avg(obsjd)'
+        ' FROM cutout_meta' + where, foundids).fetchone()
+    h['EXPOSURE'] = exposure, 'Total stack exposure time (s)'
+    #h['FILTERS'] = (''.join([_['FILTER'].split()[1] for _ in headers]),
+    #                'Filters in stack')
+
+    h['OBSJD1'] = obsjd1, 'First shutter start time'
+    h['OBSJDN'] = obsjdn, 'Last shutter start time'
+    h['OBSJDM'] = obsjdm, 'Mean shutter start time'
+
+    wcs = [row['sanglewcs'] for row in rows if row['sanglewcs'] is not None]
+    if len(wcs) > 0:
+        h.update(WCS(fits.Header.fromstring(wcs[0])).to_header())
+
+    h['DBPID'] = (','.join([str(row['dbpid']) for row in rows]),
+                  'Database processed-image IDs')
+    h['DESG'] = rows[0]['desg'], 'Target designation'
+
+    means = {
+            'RH': 'Mean heliocentric distance (au)',
+            'DELTA': 'Mean observer-target distance (au)',
+            'PHASE': 'Mean Sun-target-observer angle (deg)',
+            'RDOT': 'Mean heliocentric radial velocity, km/s',
+            'SELONG': 'Mean solar elongation, deg',
+            'SANGLE': 'Mean projected target->Sun position angle, deg',
+            'VANGLE': 'Mean projected velocity position angle, deg',
+            'TRUEANOM': 'Mean true anomaly (osculating), deg',
+            'TMTP': 'Mean T-Tp (osculating), days',
+            'TGTRA': 'Mean target RA, deg',
+            'TGTDEC': 'Mean target Dec, deg',
+            'TGTDRA': 'Mean target RA*cos(dec) rate of change,arcsec/s',
+            'TGTDDEC': 'Mean target Dec rate of change, arcsec/s',
+            'TGTRASIG': 'Mean target RA 3-sigma uncertainty, arcsec',
+            'TGTDESIG': 'Mean target Dec 3-sigma uncertainty, arcsec',
+    }
+    keys = sorted(means)
+    row = z.db.execute(
+        'SELECT ' + ','.join(['avg({})'.format(k) for k in keys])
+        + ' FROM cutout_meta' + where, foundids).fetchone()
+    for k, v in zip(keys, row):
+        # target rates might be empty
+        h[k] = ('' if v is None else v), means[k]
+
+    return h
+
+
+def weighted_median(stack, unc, axis=0):
+    import numpy as np
+    # works, but is slow
+    if stack.shape[axis] == 1:
+        m = stack
+    elif stack.shape[axis] == 2:
+        m = np.ma.average(stack, axis=axis, weights=1/unc**2)
+    else:
+        stack = np.random.randint(1, 100, size=shape)
+        unc = np.sqrt(np.random.randint(1, 100, size=shape))
+        axis = 2
+
+        weight = 1 / unc**2
+        wstack = weight * stack
+        i = np.ma.argsort(wstack, axis=2)
+        a = wstack[list(np.ogrid[[slice(x) for x in wstack.shape]][:-1])+[i]]
+        w = weight[list(np.ogrid[[slice(x) for x in wstack.shape]][:-1])+[i]]
+
+        c = np.ma.cumsum(a, axis=2)
+        c /= np.ma.max(c, axis=2)[:, :, None]
+
+        i = np.ma.apply_along_axis(np.searchsorted, 2, c, [0.5])
+        wm = a[np.arange(a.shape[0])[:, None],
+               np.arange(a.shape[1]),
+               i]
+        wm = a[list(np.ogrid[[slice(x) for x in a.shape]][:-1])+[i]]
+        ww = w[list(np.ogrid[[slice(x) for x in a.shape]][:-1])+[i]]
+        m = wm / ww
+
+    return m
+
+
+def scale_image(image, mask, h, k):
+    """Mask, background subtract, and scale one projected image."""
+    import numpy as np
+    import scipy.ndimage as nd
+
+    # use provided mask, if possible
+    if mask is not None:
+        mask = mask.astype(bool)
+    else:
+        mask = np.zeros_like(image, bool)
+
+    # unmask objects within ~5" of target position
+    lbl, n = nd.label(mask.astype(int))
+    for m in np.unique(lbl[145:156, 145:156]):
+        mask[lbl == m] = False
+
+    # update mask with nans
+    mask = mask + ~np.isfinite(image)
+
+    # get data, subtract background, convert to e-/s
+    im = np.ma.MaskedArray(image, mask=mask, copy=True)
+    im -= h['bgmedian']
+    im *= h['gain'] / h['exposure']
+
+    # scale by image zero point, scale to rh=delta=1 au
+    im *= 10**(-0.4 * (h['magzp'] - 25.0))
+    im *= h['delta']**k * h['rh']**2
+
+    return im
+
+
+def combine(z, foundids, scale_by, path):
+    import os
+    import numpy as np
+    from astropy.io import fits
+    from . import cube
+
+    if scale_by == 'coma':
+        # coma: delta**1
+        k = 1
+    else:
+        # surface: delta**2
+        k = 2
+
+    foundids = [int(i) for i in foundids]
+    rows = z.db.execute('''
+    SELECT cutout_meta.foundid,found.desg,archivefile,exposure,gain,magzp,
+      cutout_meta.rh,cutout_meta.delta,bgmedian FROM cutout_meta
+    INNER JOIN found ON cutout_meta.foundid=found.foundid
+    WHERE cutout_meta.foundid IN ({})
+    ORDER BY cutout_meta.obsjd
+    '''.format(','.join('?' * len(foundids))), foundids).fetchall()
+
+    # read from the cube store if every image is there
+    cube_path = z.config.get('cube path')
+    planes = {}
+    if cube_path is not None and len(rows) > 0:
+        planes = cube.planes(z.db, foundids)
+        if not all([row['foundid'] in planes for row in rows]):
+            planes = {}
+    cubes = {}
+
+    stack = []
+    # loop over each image
+    for h in rows:
+        if h['magzp'] is None:
+            continue
+
+        if h['foundid'] in planes:
+            if h['desg'] not in cubes:
+                cubes[h['desg']] = cube.CutoutCube(
+                    cube_path, h['desg']).cube()
+            images, masks = cubes[h['desg']]
+            i = planes[h['foundid']]
+            im = scale_image(images[i], masks[i], h, k)
+        else:
+            # at the cube's precision, so that stacks do not depend on
+            # the source
+            fn = os.path.join(path, h['archivefile'])
+            with fits.open(fn) as hdu:
+                mask = (hdu['SANGLEMASK'].data if 'SANGLEMASK' in hdu
+                        else None)
+                im = scale_image(np.asarray(hdu['SANGLE'].data, np.float32),
+                                 mask, h, k)
+
+        stack.append(im)
+
+    if len(stack) == 0:
+        raise BadDataSet
+    stack = np.ma.MaskedArray(stack)
+    combined = fits.ImageHDU(np.ma.median(stack, 0).filled(np.nan))
+    combined.name = '{} scaled'.format(scale_by)
+
+    return combined
+
+
+def stack(z, foundids, fn, nightly, baseline, scale_by=('coma', 'surface'),
+          overwrite=False):
+    """Stack one target-night-filter set, and record it.
+
+    Parameters
+    ----------
+    z : ZChecker
+    foundids : array-like
+      Detections in the set, see `data_to_stack`.
+    fn : string
+      Stack file name, relative to the stack path.
+    nightly, baseline : array-like
+      foundids of the nightly and baseline images.
+    scale_by : list of string, optional
+      Scaling models: coma, surface.
+    overwrite : bool, optional
+      Overwrite an existing stack file.
+
+    Returns
+    -------
+    stacked : bool
+      `False` if there was nothing to stack.
+
+    """
+
+    import os
+    from astropy.io import fits
+    from . import profiling
+
+    cutout_path = z.config['cutout path']
+    stack_path = z.config['stack path']
+
+    # setup FITS object, primary HDU is just a header
+    hdu = fits.HDUList()
+    primary_header = header(z, nightly)
+    hdu.append(fits.PrimaryHDU(header=primary_header))
+
+    # update header with baseline info
+    h = header(z, baseline)
+    hdu[0].header['BLPID'] = h.get('DBPID'), 'Baseline processed-image IDs'
+    h['BLNIMAGE'] = h.get('NIMAGES'), 'Number of images in baseline'
+    h['BLEXP'] = h.get('EXPOSURE'), 'Total baseline exposure time (s)'
+    h['BLOBSJD1'] = h.get('OBSJD1'), 'First baseline shutter start time'
+    h['BLOBSJDN'] = h.get('OBSJDN'), 'Last baseline shutter start time'
+    h['BLOBSJDM'] = h.get('OBSJDM'), 'Mean baseline shutter start time'
+
+    # loop over scaling models
+    for i in range(len(scale_by)):
+        # combine nightly
+        try:
+            with profiling.span('combine'):
+                hdu.append(combine(z, nightly, scale_by[i], cutout_path))
+        except BadDataSet:
+            continue
+
+        # combine baseline
+        if len(baseline) > 0:
+            try:
+                with profiling.span('combine'):
+                    im = combine(z, baseline, scale_by[i], cutout_path)
+            except BadDataSet:
+                continue
+            im.data = hdu[-1].data - im.data
+            im.name = '{}-baseline'.format(scale_by[i])
+            hdu.append(im)
+
+    # database update
+    if len(hdu) > 1:
+        # images were stacked
+        with profiling.span('write'):
+            hdu.writeto(os.path.join(stack_path, fn), overwrite=overwrite)
+        z.db.executemany('''
+        INSERT OR REPLACE INTO stacks VALUES (?,?,1)
+        ''', zip(foundids, [fn] * len(foundids)))
+    else:
+        # images were skipped
+        z.db.executemany('''
+        INSERT OR REPLACE INTO stacks VALUES (?,NULL,-1)
+        ''', zip(foundids))
+
+    z.db.commit()
+    return len(hdu) > 1
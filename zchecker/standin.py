@@ -0,0 +1,637 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""standin
+==========
+
+Local stand-in for the IRSA and JPL/Horizons services.
+
+Serves synthetic data in the formats that ZChecker retrieves:
+
+  /account/signon/login.do, logout.do   IRSA log in and out
+  /ibe/search/ztf/products/sci          IBE metadata search, IPAC table
+  /ibe/data/ztf/products/sci/...       science images, masks, PSFs,
+                                       full quadrants or cutouts
+  /api/horizons.api                    Horizons ephemerides and
+                                       orbital elements, text format
+
+Each night has a fixed sequence of synthetic exposures tiling the sky,
+and every designation has a synthetic, smoothly varying ephemeris, so
+that repeated requests return consistent results.  Latency, bandwidth,
+and a failure rate may be set to model the real services.
+
+Run from the command line:
+
+  python3 -m zchecker.standin --port=8000 --latency=0.2
+
+and point ZChecker at it with the configuration keys:
+
+  "irsa url": "http://localhost:8000",
+  "horizons url": "http://localhost:8000/api/horizons.api"
+
+"""
+
+# synthetic survey parameters
+CADENCE = 40 / 86400       # days between exposures
+NIGHT_START = 0.15         # first exposure, days after 0 UT
+PIXSCALE = 1.012           # arcsec
+QUAD_SHAPE = (3080, 3072)  # pixels
+QUAD_SIZE = 0.87           # deg, quadrant spacing in the focal plane
+J0 = 2458000.5             # synthetic epoch zero
+
+
+def _gnomonic(ra0, dec0, xi, eta):
+    """Deproject tangent plane offsets, all angles in degrees."""
+    import numpy as np
+    a0, d0 = np.radians(ra0), np.radians(dec0)
+    xi, eta = np.radians(xi), np.radians(eta)
+    d = np.cos(d0) - eta * np.sin(d0)
+    ra = np.degrees(a0 + np.arctan2(xi, d)) % 360
+    dec = np.degrees(np.arctan2(np.sin(d0) + eta * np.cos(d0),
+                                np.hypot(xi, d)))
+    return ra, dec
+
+
+def exposure_center(day, k):
+    """Pointing of the `k`th exposure of night `day`, degrees."""
+    row, col = divmod(k, 48)
+    dec = -25 + 7 * (row % 13)
+    ra = (7.5 * col + 3.75 * (row % 2) + 0.5 * (day % 15)) % 360
+    return ra, dec
+
+
+def quads(day, k):
+    """Quadrant geometry for an exposure.
+
+    Returns
+    -------
+    quads : list of dict
+      ccdid, qid, rcid, ra, dec, ra1, dec1, ..., ra4, dec4
+
+    """
+
+    ra0, dec0 = exposure_center(day, k)
+    h = QUAD_SIZE / 2
+    quads = []
+    for i in range(8):
+        for j in range(8):
+            q = {'ccdid': (i // 2) * 4 + j // 2 + 1,
+                 'qid': (i % 2) * 2 + j % 2 + 1}
+            q['rcid'] = (q['ccdid'] - 1) * 4 + q['qid'] - 1
+            x = (j - 3.5) * QUAD_SIZE
+            y = (i - 3.5) * QUAD_SIZE
+            q['ra'], q['dec'] = _gnomonic(ra0, dec0, x, y)
+            corners = ((x - h, y - h), (x + h, y - h), (x + h, y + h),
+                       (x - h, y + h))
+            for n, (cx, cy) in enumerate(corners):
+                r, d = _gnomonic(ra0, dec0, cx, cy)
+                q['ra{}'.format(n + 1)] = r
+                q['dec{}'.format(n + 1)] = d
+            quads.append(q)
+    return quads
+
+
+def observations(jd_start, jd_end, exposures=300):
+    """Synthetic ZTF observation log.
+
+    Parameters
+    ----------
+    jd_start, jd_end : float
+      Time range.
+    exposures : int, optional
+      Exposures per night.
+
+    Returns
+    -------
+    tab : astropy.table.Table
+      IBE search columns.
+
+    """
+
+    import numpy as np
+    from astropy.table import Table
+    from astropy.time import Time
+
+    rows = []
+    for night in range(int(np.floor(jd_start - J0)),
+                       int(np.floor(jd_end - J0)) + 1):
+        for k in range(exposures):
+            obsjd = J0 + night + NIGHT_START + k * CADENCE
+            if obsjd <= jd_start or obsjd >= jd_end:
+                continue
+
+            t = Time(obsjd, format='jd')
+            date = t.iso[:10].replace('-', '')
+            fracday = int((obsjd - J0) % 1 * 1e6)
+            expid = night * 10000 + k
+            fid = 1 + (k // 2) % 2
+            # every 25th exposure is flagged, depth varies by +/-0.5 mag
+            infobits = 2**25 if k % 25 == 24 else 0
+            maglimit = 20.5 + 0.5 * np.cos(0.7 * k)
+            for q in quads(night, k):
+                row = dict(q)
+                row.update(
+                    infobits=infobits, field=100 + k, fid=fid,
+                    filtercode=('zg', 'zr')[fid - 1],
+                    pid=expid * 100 + q['rcid'], expid=expid,
+                    obsdate=t.iso + '+00', obsjd=obsjd,
+                    filefracday=int('{}{:06d}'.format(date, fracday)),
+                    seeing=2.0, airmass=1.2, moonillf=0.5,
+                    maglimit=maglimit,
+                    crpix1=(QUAD_SHAPE[1] + 1) / 2,
+                    crpix2=(QUAD_SHAPE[0] + 1) / 2,
+                    crval1=q['ra'], crval2=q['dec'],
+                    cd11=-PIXSCALE / 3600, cd12=0, cd21=0,
+                    cd22=PIXSCALE / 3600)
+                rows.append(row)
+
+    names = ['infobits', 'field', 'ccdid', 'qid', 'rcid', 'fid',
+             'filtercode', 'pid', 'expid', 'obsdate', 'obsjd',
+             'filefracday', 'seeing', 'airmass', 'moonillf', 'maglimit',
+             'crpix1', 'crpix2', 'crval1', 'crval2', 'cd11', 'cd12',
+             'cd21', 'cd22', 'ra', 'dec', 'ra1', 'dec1', 'ra2', 'dec2',
+             'ra3', 'dec3', 'ra4', 'dec4']
+    if len(rows) == 0:
+        return Table(names=names, dtype=[int] * 9 + [str, float, int]
+                     + [float] * 22)
+    return Table(rows=[[row[k] for k in names] for row in rows],
+                 names=names)
+
+
+def _quad_from_filename(fn):
+    """Exposure and quadrant from a ZTF product file name."""
+    import re
+    from astropy.time import Time
+    m = re.match('ztf_([0-9]{8})([0-9]{6})_([0-9]{6})_z[gri]_c([0-9]{2})'
+                 '_o_q([1-4])_([a-z]+)', fn)
+    if m is None:
+        return None
+
+    date, fracday, field, ccdid, qid, product = m.groups()
+    night = int(round(Time('{}-{}-{}'.format(
+        date[:4], date[4:6], date[6:])).jd - J0))
+    k = int(field) - 100
+    pid = (night * 10000 + k) * 100 + (int(ccdid) - 1) * 4 + int(qid) - 1
+    for q in quads(night, k):
+        if q['ccdid'] == int(ccdid) and q['qid'] == int(qid):
+            return q, pid, product
+    return None
+
+
+def _size(size):
+    """Cutout size in pixels from an IBE size parameter."""
+    import re
+    m = re.match('([0-9.]+)(px|pix|arcsec|arcmin|deg)?', size or '')
+    if m is None:
+        return None
+    v = float(m.group(1))
+    unit = m.group(2)
+    scale = {'arcsec': 1, 'arcmin': 60, 'deg': 3600}
+    if unit in scale:
+        v = v * scale[unit] / PIXSCALE
+    return max(int(round(v)), 1)
+
+
+def image(fn, center=None, size=None):
+    """Synthetic ZTF science image, mask, or PSF as FITS data.
+
+    Parameters
+    ----------
+    fn : string
+      ZTF product file name.
+    center : string, optional
+      IBE cutout center, e.g., '123.4,5.6deg'.
+    size : string, optional
+      IBE cutout size, e.g., '5arcmin'.
+
+    Returns
+    -------
+    data : bytes
+      FITS file, or `None` if `fn` is not recognized.
+
+    """
+
+    import io
+    import numpy as np
+    from astropy.io import fits
+    from astropy.wcs import WCS
+
+    found = _quad_from_filename(fn)
+    if found is None:
+        return None
+    q, pid, product = found
+
+    if product == 'sciimgdaopsfcent':
+        y, x = np.mgrid[-12:13, -12:13]
+        psf = np.exp(-(x**2 + y**2) / 2 / 1.0**2).astype(np.float32)
+        buf = io.BytesIO()
+        fits.PrimaryHDU(psf / psf.sum()).writeto(buf)
+        return buf.getvalue()
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = q['ra'], q['dec']
+    wcs.wcs.crpix = (QUAD_SHAPE[1] + 1) / 2, (QUAD_SHAPE[0] + 1) / 2
+    wcs.wcs.cd = [[-PIXSCALE / 3600, 0], [0, PIXSCALE / 3600]]
+
+    y0, x0, y1, x1 = 0, 0, QUAD_SHAPE[0], QUAD_SHAPE[1]
+    target = None
+    n = _size(size)
+    if center is not None:
+        ra, dec = [float(v) for v in center.replace('deg', '').split(',')]
+        x, y = [float(v) for v in wcs.all_world2pix(ra, dec, 0)]
+        target = x, y
+        if n is not None:
+            # trimmed at the image edges
+            x0 = int(round(x)) - n // 2
+            y0 = int(round(y)) - n // 2
+            x0, x1 = np.clip((x0, x0 + n), 0, QUAD_SHAPE[1])
+            y0, y1 = np.clip((y0, y0 + n), 0, QUAD_SHAPE[0])
+
+    shape = (max(y1 - y0, 1), max(x1 - x0, 1))
+    wcs.wcs.crpix = wcs.wcs.crpix[0] - x0, wcs.wcs.crpix[1] - y0
+    header = wcs.to_header()
+    header['PID'] = pid
+
+    if product == 'mskimg':
+        data = np.zeros(shape, np.int16)
+    else:
+        rng = np.random.RandomState(pid % 2**32)
+        data = rng.normal(150, 10, shape).astype(np.float32)
+        if target is not None:
+            y, x = np.mgrid[y0:y0 + shape[0], x0:x0 + shape[1]]
+            data += 1000 * np.exp(-((x - target[0])**2
+                                    + (y - target[1])**2) / 2 / 2.0**2)
+        header['SATURATE'] = 50000.0
+        header['DBPID'] = pid
+        header['EXPOSURE'] = 30.0
+        header['GAIN'] = 6.2
+        header['MAGZP'] = 26.0
+
+    buf = io.BytesIO()
+    fits.PrimaryHDU(data, header).writeto(buf)
+    return buf.getvalue()
+
+
+def _seed(desg):
+    import zlib
+    return zlib.crc32(desg.encode())
+
+
+def position(desg, jd):
+    """Synthetic geocentric ephemeris.
+
+    Returns
+    -------
+    eph : dict of ndarray
+      'ra', 'dec' in degrees, 'dra', 'ddec' in arcsec/hr, 'rh',
+      'delta', 'mag'.
+
+    """
+
+    import numpy as np
+    h = _seed(desg)
+    t = np.asarray(jd, float) - J0
+    ra0 = h % 360
+    dec0 = -20 + (h // 360) % 50
+    rate = 0.05 + (h % 7) * 0.05
+    amp = 5 + h % 11
+    ra = (ra0 + rate * t) % 360
+    dec = dec0 + amp * np.sin(t / 200)
+    ddec = amp * np.cos(t / 200) / 200 * 3600 / 24
+    dra = rate * np.cos(np.radians(dec)) * 3600 / 24
+    rh = 2 + (h % 30) / 10 + 0.2 * np.sin(t / 300)
+    delta = rh - 0.8 + 0.3 * np.cos(t / 180)
+    mag = 16 + (h % 50) / 10 + 0 * t
+    return {'ra': ra, 'dec': dec, 'dra': dra, 'ddec': ddec, 'rh': rh,
+            'delta': delta, 'mag': mag}
+
+
+def orbit(desg):
+    """Synthetic osculating elements.
+
+    Returns
+    -------
+    e : float
+      Eccentricity, elliptic.
+    q : float
+      Perihelion distance, au.
+    tp : float
+      Time of perihelion, Julian date, TDB.
+
+    """
+
+    h = _seed(desg)
+    return 0.3 + (h % 50) / 100, 1 + (h % 30) / 10, J0 + 300 + h % 1000
+
+
+def _horizons_epochs(params):
+    """Julian dates from Horizons request parameters."""
+    import re
+    import numpy as np
+    from astropy.time import Time
+
+    if 'TLIST' in params:
+        return np.array([float(v) for v in
+                         params['TLIST'].strip("'\"").split()])
+
+    start = Time(params['START_TIME'].strip("'\"")).jd
+    stop = Time(params['STOP_TIME'].strip("'\"")).jd
+    step = params['STEP_SIZE'].strip("'\"")
+    m = re.match(r'([0-9.]+)\s*([a-z]*)', step)
+    v, unit = float(m.group(1)), m.group(2)
+    if unit == '':
+        # equal intervals
+        return np.linspace(start, stop, int(v) + 1)
+    scale = {'m': 1440, 'h': 24, 'd': 1}[unit[0]]
+    n = int(np.floor((stop - start) * scale / v + 1e-6))
+    return start + np.arange(n + 1) * v / scale
+
+
+def horizons(params, orbits=None):
+    """Horizons API text response.
+
+    Parameters
+    ----------
+    params : dict
+      Request parameters.
+    orbits : dict, optional
+      Orbital elements (e, q, Tp) by designation, default: `orbit`.
+
+    Returns
+    -------
+    text : string
+
+    """
+
+    import re
+    import numpy as np
+    from astropy.time import Time
+    from .eph import true_anomaly
+
+    desg = params.get('COMMAND', '').strip("'\"")
+    desg = re.sub('^(DES|NAME|COMNAM|ASTNAM)=', '', desg)
+    desg = desg.split(';')[0].strip()
+    comet = re.match('^([CPID]/|[0-9]+P)', desg) is not None
+
+    jd = _horizons_epochs(params)
+    eph = position(desg, jd)
+    lines = ['API VERSION: 1.0', 'API SOURCE: ZChecker stand-in', '',
+             '*' * 79,
+             'Target body name: {:32}{{source: standin}}'.format(desg),
+             'Center body name: Earth (399)                   '
+             '{source: standin}',
+             '*' * 79]
+
+    if params.get('EPHEM_TYPE', '').strip("'\"") == 'ELEMENTS':
+        if orbits is not None and desg in orbits:
+            e, q, tp = orbits[desg]
+        else:
+            e, q, tp = orbit(desg)
+
+        # mean motion and anomaly, as reported by Horizons: 9.9E+99
+        # for undefined quantities
+        k = np.degrees(0.01720209895)  # deg/day
+        undefined = 9.999999999999998E+99
+        if e == 1:
+            a = ad = pr = n = undefined
+            ma = [undefined] * len(jd)
+        else:
+            a = q / (1 - e)
+            n = k / abs(a)**1.5
+            ma = n * (jd - tp)
+            if e < 1:
+                ad = a * (1 + e)
+                pr = 360 / n
+                ma = ma % 360
+            else:
+                ad = pr = undefined
+        ta = true_anomaly(e, q, jd - tp)
+
+        lines.append('JDTDB, Calendar Date (TDB), EC, QR, IN, OM, W, Tp,'
+                     ' N, MA, TA, A, AD, PR,')
+        lines.append('$$SOE')
+        for i, t in enumerate(jd):
+            lines.append(
+                '{:.9f}, A.D. {}, {:.16E}, {:.16E}, 1.0E+01, 1.0E+02,'
+                ' 1.0E+02, {:.16E}, {:.16E}, {:.16E}, {:.16E}, {:.16E},'
+                ' {:.16E}, {:.16E},'.format(
+                    t, Time(t, format='jd').iso, e, q, tp, n, ma[i],
+                    ta[i], a, ad, pr))
+        lines.append('$$EOE')
+        return '\n'.join(lines) + '\n'
+
+    magnitudes = 'T-mag, N-mag' if comet else 'APmag, S-brt'
+    lines.append(
+        ' Date__(UT)__HR:MN, Date_________JDUT, , , R.A._(ICRF),'
+        ' DEC_(ICRF), dRA*cosD, d(DEC)/dt, {}, r, rdot, delta, deldot,'
+        ' S-O-T, /r, S-T-O, PsAng, PsAMV, RA_3sigma, DEC_3sigma,'.format(
+            magnitudes))
+    lines.append('$$SOE')
+    for i in range(len(jd)):
+        t = Time(jd[i], format='jd')
+        date = t.datetime.strftime('%Y-%b-%d %H:%M')
+        lines.append(
+            ' {}, {:.9f}, , , {:.6f}, {:.6f}, {:.5f}, {:.5f}, {:.2f},'
+            ' {:.2f}, {:.6f}, {:.4f}, {:.6f}, {:.4f}, 120.0000, /T,'
+            ' 20.0000, {:.3f}, {:.3f}, 0.500, 0.400,'.format(
+                date, jd[i], eph['ra'][i], eph['dec'][i], eph['dra'][i],
+                eph['ddec'][i], eph['mag'][i], eph['mag'][i] + 3,
+                eph['rh'][i], 1.0, eph['delta'][i], -1.0,
+                (eph['ra'][i] + 90) % 360, (eph['ra'][i] + 270) % 360))
+    lines.append('$$EOE')
+    return '\n'.join(lines) + '\n'
+
+
+def handler(latency=0, bandwidth=0, failure_rate=0, exposures=300,
+            clock=None, quad_delay=0, orbits=None, verbose=False):
+    """Request handler class for `http.server`.
+
+    Parameters
+    ----------
+    latency : float, optional
+      Seconds before each response.
+    bandwidth : float, optional
+      Response rate limit, bytes per second, or 0 for no limit.
+    failure_rate : float, optional
+      Fraction of requests answered with 503 Service Unavailable.
+    exposures : int, optional
+      Synthetic exposures per night.
+    clock : function, optional
+      Returns the current Julian date.  Exposures taken after it are
+      not yet in the archive, e.g., to replay a night as it is
+      observed.
+    quad_delay : float, optional
+      With `clock`, seconds between archiving successive quadrants
+      (rcid) of an exposure, so that an exposure may be partly
+      archived.
+    orbits : dict, optional
+      Orbital elements (e, q, Tp) by designation, replacing the
+      synthetic ones from `orbit`.
+    verbose : bool, optional
+      Log requests to stderr.
+
+    """
+
+    import re
+    import time
+    import random
+    from urllib.parse import urlparse, parse_qs
+    from http.server import BaseHTTPRequestHandler
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        counters = {'requests': 0, 'failed': 0, 'bytes': 0}
+
+        def log_message(self, *args):
+            if verbose:
+                super().log_message(*args)
+
+        def reply(self, status, body=b'', content_type='text/plain',
+                  headers={}):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+
+            chunk = 65536
+            for i in range(0, len(body), chunk):
+                self.wfile.write(body[i:i + chunk])
+                if bandwidth > 0:
+                    time.sleep(min(chunk, len(body) - i) / bandwidth)
+            self.counters['bytes'] += len(body)
+
+        def do_GET(self):
+            self.counters['requests'] += 1
+            if latency > 0:
+                time.sleep(latency)
+
+            if random.random() < failure_rate:
+                self.counters['failed'] += 1
+                self.reply(503, b'Service unavailable (stand-in)\n',
+                           headers={'Retry-After': '1'})
+                return
+
+            url = urlparse(self.path)
+            params = dict((k, v[0]) for k, v in
+                          parse_qs(url.query).items())
+            path = url.path
+
+            if path.startswith('/account/signon/'):
+                self.reply(200, b'OK\n', headers={
+                    'Set-Cookie': 'JOSSO_SESSIONID=standin; Path=/'})
+            elif path == '/ibe/search/ztf/products/sci':
+                self.search(params)
+            elif path.startswith('/ibe/data/ztf/products/sci/'):
+                data = image(path.split('/')[-1], params.get('center'),
+                             params.get('size'))
+                if data is None:
+                    self.reply(404, b'Not found\n')
+                else:
+                    self.reply(200, data, 'image/fits')
+            elif path.startswith('/api/horizons'):
+                self.reply(200, horizons(params, orbits).encode())
+            else:
+                self.reply(404, b'Not found\n')
+
+        def search(self, params):
+            import io
+            import numpy as np
+            where = params.get('WHERE', '')
+            start = re.search(r'obsjd\s*(>=?)\s*([0-9.]+)', where)
+            end = re.search(r'obsjd\s*<\s*([0-9.]+)', where)
+            if start is None or end is None:
+                self.reply(400, b'WHERE must constrain obsjd\n')
+                return
+
+            jd_start = float(start.group(2))
+            if start.group(1) == '>=':
+                jd_start = np.nextafter(jd_start, 0)
+            jd_end = float(end.group(1))
+            if clock is not None:
+                now = clock()
+                jd_end = min(jd_end, now)
+            tab = observations(jd_start, jd_end, exposures=exposures)
+            if clock is not None and quad_delay > 0:
+                archived = tab['obsjd'] + tab['rcid'] * quad_delay / 86400
+                tab = tab[archived <= now]
+            columns = params.get('COLUMNS')
+            if columns is not None:
+                tab = tab[columns.split(',')]
+
+            buf = io.StringIO()
+            tab.write(buf, format='ascii.ipac')
+            self.reply(200, buf.getvalue().encode())
+
+    return StandInHandler
+
+
+def start(port=0, **kwargs):
+    """Start a stand-in server in a background thread.
+
+    Parameters
+    ----------
+    port : int, optional
+      Port number, or 0 for any free port.
+    **kwargs
+      `handler` keyword arguments.
+
+    Returns
+    -------
+    server : http.server.HTTPServer
+      The server, with an additional `url` attribute.  Stop with
+      `server.shutdown()`.
+
+    """
+
+    import threading
+    from socketserver import ThreadingMixIn
+    from http.server import HTTPServer
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('localhost', port), handler(**kwargs))
+    server.url = 'http://localhost:{}'.format(server.server_port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(
+        prog='python3 -m zchecker.standin',
+        description='Local stand-in for the IRSA and Horizons services.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds before each response')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='response rate limit, bytes per second')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='fraction of requests answered with 503')
+    parser.add_argument('--exposures', type=int, default=300,
+                        help='synthetic exposures per night')
+    parser.add_argument('-v', action='store_true', help='log requests')
+    args = parser.parse_args()
+
+    server = start(args.port, latency=args.latency,
+                   bandwidth=args.bandwidth,
+                   failure_rate=args.failure_rate,
+                   exposures=args.exposures, verbose=args.v)
+    print('Serving on {}'.format(server.url))
+    print('  "irsa url": "{}",'.format(server.url))
+    print('  "horizons url": "{}/api/horizons.api"'.format(server.url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        c = server.RequestHandlerClass.counters
+        print('{} requests, {} failed, {} bytes sent'.format(
+            c['requests'], c['failed'], c['bytes']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""watch
+========
+
+`zchecker watch`: ingest and search a night while it is observed.
+
+Each poll asks IRSA for exposures taken since the last one in the
+database, adds them to the observation log, and runs the coarse and
+fine searches on the new images alone:
+
+  ztf-update (since the last exposure) -> search (new images)
+
+Quadrants of an exposure may be archived at different times, so
+exposures taken up to `lookback` seconds before the last one are
+requested again, and only quadrants not yet in the database are
+searched.  The first poll of a night takes everything observed so
+far.  Targets not yet searched in the earlier images of the night,
+e.g., with a new ephemeris, are searched in all of them.
+
+Polls start every `interval` seconds; a poll that takes longer delays
+the next one.  A poll that fails, e.g., on a service outage, is
+logged, and the images it added are searched by the next poll.  Each
+poll logs the number of new images and detections, and the lag from
+exposure to detection, i.e., the exposure's observation time to the
+time its detection was saved.  This includes the archive's
+processing delay, time waiting for the next poll, and the search
+itself.
+
+Targets need ephemerides covering the night, e.g., from
+`zchecker eph-update`.
+
+"""
+
+
+class Watch:
+    """Continuous ingest and search.
+
+    Parameters
+    ----------
+    z : ZChecker
+      Ingests and searches.
+    interval : float, optional
+      Seconds between the starts of two polls.
+    lookback : float, optional
+      Request exposures taken up to this many seconds before the
+      last one in the database, which may have been partly archived.
+    clock : function, optional
+      Returns the current Julian date, default: the system clock.
+      Sets the default date and measures the lag; for replaying a
+      night, e.g., with `standin.handler`.
+
+    """
+
+    def __init__(self, z, interval=60, lookback=600, clock=None):
+        self.z = z
+        self.interval = interval
+        self.lookback = lookback
+        self.clock = self._now if clock is None else clock
+
+        # per poll: start time (monotonic), new images, detections
+        self.polls = []
+        # new images not yet searched, by date
+        self.unsearched = {}
+        # per detection: seconds from exposure to detection
+        self.lags = []
+
+    @staticmethod
+    def _now():
+        from astropy.time import Time
+        return Time.now().jd
+
+    def run(self, date=None, objects=None, vlim=22.0, depth_margin=None,
+            skip_flagged=False, polls=None):
+        """Poll until interrupted.
+
+        Parameters
+        ----------
+        date : string, optional
+          UT date to watch, YYYY-MM-DD, default: the current UT date
+          at each poll.
+        objects : list of string, optional
+          Targets to search, default: all targets with ephemerides.
+        vlim : float, optional
+          Search magnitude limit.
+        depth_margin : float, optional
+          See `ZChecker.fov_search`.
+        skip_flagged : bool, optional
+          Do not search images with non-zero infobits.
+        polls : int, optional
+          Stop after this many polls.
+
+        """
+
+        import time
+        from .exceptions import ZCheckerError
+
+        self.z.logger.info('Watching for new exposures every {:g} s.'.format(
+            self.interval))
+        try:
+            while polls is None or len(self.polls) < polls:
+                if len(self.polls) > 0:
+                    time.sleep(max(0, self.polls[-1][0] + self.interval
+                                   - time.monotonic()))
+                try:
+                    self.poll(date=date, objects=objects, vlim=vlim,
+                              depth_margin=depth_margin,
+                              skip_flagged=skip_flagged)
+                except ZCheckerError as e:
+                    self.z.db.rollback()
+                    self.z.logger.error('Poll {} failed: {}'.format(
+                        len(self.polls), str(e)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.report()
+
+    def poll(self, date=None, objects=None, vlim=22.0, depth_margin=None,
+             skip_flagged=False):
+        """Ingest and search new exposures once.
+
+        Parameters are the same as for `run`.
+
+        Returns
+        -------
+        n : int
+          Number of new images.
+
+        Raises
+        ------
+        ZCheckerError
+          If the poll fails.  Images added by the poll are searched
+          by the next one.
+
+        """
+
+        import time
+        import numpy as np
+        from astropy.time import Time
+        from .exceptions import DateRangeError
+
+        z = self.z
+        t0 = time.monotonic()
+        if date is None:
+            date = Time(self.clock(), format='jd').iso[:10]
+
+        since = None
+        nightid = z.nightid(date)
+        if nightid is not None:
+            last = z.db.execute('SELECT max(obsjd) FROM obs WHERE nightid=?',
+                                [nightid]).fetchone()[0]
+            if last is not None:
+                since = last - self.lookback / 86400
+
+        lags = []
+
+        def found(rows, foundids, jd):
+            now = self.clock()
+            lags.extend([(now - row[1]) * 86400 for row in rows])
+
+        # count the poll, even if it fails
+        self.polls.append((t0, 0, 0))
+        pids = z.update_obs(date, since=since)
+        n = len(pids)
+        self.polls[-1] = (t0, n, 0)
+        pids = self.unsearched.pop(date, []) + pids
+        if len(pids) > 0:
+            self.unsearched[date] = pids
+            try:
+                z.fov_search(date, date, objects=objects, vlim=vlim,
+                             depth_margin=depth_margin,
+                             skip_flagged=skip_flagged, on_found=found,
+                             pids=pids)
+            except DateRangeError:
+                # e.g., all new images are flagged
+                pass
+            finally:
+                self.polls[-1] = (t0, n, len(lags))
+                self.lags.extend(lags)
+            del self.unsearched[date]
+
+        msg = 'Poll {}: {} new images, {} detections'.format(
+            len(self.polls), n, len(lags))
+        if len(lags) > 0:
+            msg += ', lag from exposure to detection: median {:.1f} s,' \
+                ' max {:.1f} s'.format(np.median(lags), max(lags))
+        z.logger.info(msg + ', poll took {:.1f} s.'.format(
+            time.monotonic() - t0))
+        return n
+
+    def report(self):
+        """Log the poll interval and lag."""
+        import numpy as np
+
+        log = self.z.logger
+        if len(self.polls) == 0:
+            return
+
+        t, images, found = list(zip(*self.polls))
+        log.info('Watched {} polls: {} new images, {} detections.'.format(
+            len(self.polls), sum(images), sum(found)))
+        if len(t) > 1:
+            dt = np.diff(t)
+            log.info('  Poll interval {:g} s, actual: median {:.1f} s,'
+                     ' max {:.1f} s.'.format(self.interval, np.median(dt),
+                                             dt.max()))
+        if len(self.lags) > 0:
+            log.info('  Lag from exposure to detection: min {:.1f} s,'
+                     ' median {:.1f} s, max {:.1f} s.'.format(
+                         min(self.lags), np.median(self.lags),
+                         max(self.lags)))
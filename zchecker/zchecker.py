@@ -13,47 +13,132 @@ class ZChecker:
 
     """
 
+    # ephemeris cache: rows are loaded this many days past the
+    # requested epoch, for at most this many objects
+    eph_cache_days = 4.0
+    eph_cache_size = 2000
+
     def __init__(self, config=None, log=False):
+        from collections import OrderedDict
         from . import logging
+        from . import remote
         from .config import Config
         self.config = Config() if config is None else config
+        self._eph_cache = OrderedDict()
         filename = self.config['log'] if log else '/dev/null'
         self.logger = logging.setup(filename=filename)
+        remote.configure(self.config.get('rate limits'), urls={
+            'irsa': self.config.get('irsa url'),
+            'horizons': self.config.get('horizons url')
+        })
         self.connect_db()
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args):
-        from astropy.time import Time
-        self.clean_stale_files()
+        from . import remote
+        from .logging import timestamp
+        for name in sorted(remote.services):
+            service = remote.services[name]
+            if service.counters['calls'] > 0:
+                self.logger.info(service.summary())
+        if self.config.get('defer gc', False):
+            n = self.db.execute('SELECT count() FROM stale_files').fetchone()[0]
+            if n > 0:
+                self.logger.info(
+                    '{} stale archive files pending, run gc to remove.'.format(n))
+        else:
+            self.clean_stale_files()
         self.logger.info('Closing database.')
         self.db.commit()
-        self.db.execute('PRAGMA optimize')
+        if self.db.total_changes > 0:
+            self.db.execute('PRAGMA optimize')
         self.db.close()
-        self.logger.info(Time.now().iso + 'Z')
+        self.logger.info(timestamp())
 
     def connect_db(self):
-        """Connect to database and setup tables, as needed."""
-        import numpy as np
-        import sqlite3
-        from .schema import schema
+        """Connect to database and setup tables, as needed.
+
+        Setup is skipped when the database user_version matches
+        `schema.version`.
 
-        sqlite3.register_adapter(np.int64, int)
-        sqlite3.register_adapter(np.int32, int)
-        sqlite3.register_adapter(np.float64, float)
-        sqlite3.register_adapter(np.float32, float)
+        """
+        import sqlite3
+        from . import schema
 
         filename = self.config['database']
-        self.db = sqlite3.connect(filename)
+        self.db = _connect(filename)
         self.db.execute('PRAGMA foreign_keys = 1')
         self.db.execute('PRAGMA recursive_triggers = 1')
         self.db.row_factory = sqlite3.Row
 
+        user_version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if user_version != schema.version:
+            self.setup_db()
+
+        self._data_version = self.db.execute(
+            'PRAGMA data_version').fetchone()[0]
+        self.logger.info('Connected to database: {}'.format(filename))
+
+    def copy(self):
+        """New instance with its own database connection.
+
+        The configuration and logger are shared.  SQLite connections
+        may only be used by the thread that created them, so call
+        this from the thread that will use the copy, e.g., a pipeline
+        stage.  Close it with ``copy.db.close()``.
+
+        """
+        import copy
+        from collections import OrderedDict
+        z = copy.copy(self)
+        z._eph_cache = OrderedDict()
+        z.connect_db()
+        return z
+
+    def refresh(self):
+        """Drop cached data if another connection wrote to the database.
+
+        For long-lived instances, e.g., `zchecker serve`.  Writes made
+        through this instance update the caches directly.  The
+        orbital elements cache, `eph.elements`, is also dropped, e.g.,
+        after another process updated the ephemerides.
+
+        """
+        from . import eph
+        data_version = self.db.execute('PRAGMA data_version').fetchone()[0]
+        if data_version != self._data_version:
+            self._eph_cache.clear()
+            eph.clear_elements()
+            self._data_version = data_version
+
+    def setup_db(self):
+        """Create or update tables, indices, views, and triggers."""
+        from .schema import schema, columns, backfill, version
+
+        tables = [row[0] for row in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'")]
+
         for cmd in schema:
             self.db.execute(cmd)
 
-        self.logger.info('Connected to database: {}'.format(filename))
+        for table, cmd in backfill:
+            if table not in tables:
+                self.db.execute(cmd)
+
+        if 'ephcov' not in tables:
+            self.update_ephcov()
+
+        for table, column, coltype in columns:
+            existing = [row[1] for row in
+                        self.db.execute('PRAGMA table_info({})'.format(table))]
+            if column not in existing:
+                self.db.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table, column, coltype))
+
+        self.db.commit()
+        self.db.execute('PRAGMA user_version = {}'.format(version))
 
     def fetch_iter(self, cmd, args=()):
         """Generator looping over a database execute statement.
@@ -76,19 +161,57 @@ class ZChecker:
             for row in rows:
                 yield row
 
-    def clean_stale_files(self):
-        """Delete stale files from the archive."""
+    def clean_stale_files(self, threads=8):
+        """Delete stale files from the archive.
+
+        Files are removed in a thread pool, without holding a database
+        lock, then their rows are deleted in one transaction.  Rows for
+        files that could not be removed are kept for the next sweep.
+
+        Run on exit, unless the "defer gc" configuration key is true.
+
+        Parameters
+        ----------
+        threads : int, optional
+          Number of concurrent file removals.
+
+        Returns
+        -------
+        count : int
+          Number of stale file entries cleaned.
+
+        """
+
         import os
-        rows = self.fetch_iter(
-            'SELECT rowid,path,archivefile FROM stale_files')
-        count = 0
-        for row in rows:
+        from concurrent.futures import ThreadPoolExecutor
+
+        rows = self.db.execute(
+            'SELECT rowid,path,archivefile FROM stale_files').fetchall()
+
+        def unlink(row):
             f = os.path.join(self.config[row[1]], row[2])
-            if os.path.exists(f):
+            try:
                 os.unlink(f)
-            self.db.execute('DELETE FROM stale_files WHERE rowid=?', [row[0]])
-            count += 1
-        self.logger.info('{} stale archive files removed.'.format(count))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logger.warning('Could not remove {}: {}'.format(
+                    f, str(e)))
+                return None
+            return row[0]
+
+        removed = []
+        if len(rows) > 0:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                removed = [rowid for rowid in executor.map(unlink, rows)
+                           if rowid is not None]
+
+        self.db.executemany('DELETE FROM stale_files WHERE rowid=?',
+                            [(rowid,) for rowid in removed])
+        self.db.commit()
+        self.logger.info('{} stale archive files removed.'.format(
+            len(removed)))
+        return len(removed)
 
     def nightid(self, date):
         c = self.db.execute('''
@@ -110,12 +233,74 @@ class ZChecker:
 
     def available_objects(self):
         rows = self.db.execute('''
-        SELECT DISTINCT desg,min(jd),max(jd),count(jd) FROM eph
+        SELECT desg,min(jd_start),max(jd_end),sum(n) FROM ephcov
         GROUP BY desg ORDER BY desg + 0
         ''').fetchall()
         return rows
 
-    def update_obs(self, date):
+    def update_ephcov(self, objects=None, gap=1.0):
+        """Update the ephemeris coverage table.
+
+        Coverage is summarized as intervals of consecutive epochs, row
+        counts, and the latest retrieval date.  Call after writing to
+        the eph table.
+
+        Parameters
+        ----------
+        objects : list, optional
+          Update these objects, or `None` to rebuild the whole table.
+        gap : float, optional
+          Epochs further apart than this start a new interval, days.
+
+        """
+
+        if objects is None:
+            self._eph_cache.clear()
+            self.db.execute('DELETE FROM ephcov')
+            objects = [row[0] for row in self.db.execute(
+                'SELECT DISTINCT desg FROM eph')]
+
+        for obj in objects:
+            self._eph_cache.pop(obj, None)
+            self.db.execute('DELETE FROM ephcov WHERE desg=?', [obj])
+            intervals = []
+            for jd, retrieved in self.db.execute('''
+            SELECT jd,retrieved FROM eph WHERE desg=? ORDER BY jd
+            ''', [obj]):
+                retrieved = '' if retrieved is None else retrieved
+                if len(intervals) > 0 and jd - intervals[-1][2] <= gap:
+                    interval = intervals[-1]
+                    interval[2] = jd
+                    interval[3] += 1
+                    interval[4] = max(interval[4], retrieved)
+                else:
+                    intervals.append([obj, jd, jd, 1, retrieved])
+
+            self.db.executemany('INSERT INTO ephcov VALUES (?,?,?,?,?)',
+                                intervals)
+
+    def update_obs(self, date, since=None):
+        """Retrieve a night's observation log from IRSA.
+
+        Exposures already in the database are kept, with their
+        detections and search history.
+
+        Parameters
+        ----------
+        date : string
+          UT date, YYYY-MM-DD.
+        since : float, optional
+          Only request exposures taken at or after this Julian date,
+          e.g., shortly before the last one already in the database,
+          in case recent exposures were only partly archived.
+
+        Returns
+        -------
+        pids : list of int
+          New images.
+
+        """
+
         import astropy.units as u
         from astropy.time import Time
         from . import ztf
@@ -123,7 +308,11 @@ class ZChecker:
         # update_obs takes days as input, splits them at 0 UT
         jd_start = Time(date).jd
         jd_end = jd_start + 1.0
-        q = "obsjd>{} AND obsjd<{}".format(jd_start, jd_end)
+        if since is None:
+            q = "obsjd>{} AND obsjd<{}".format(jd_start, jd_end)
+        else:
+            jd_start = max(jd_start, since)
+            q = "obsjd>={} AND obsjd<{}".format(jd_start, jd_end)
 
         cols = ['infobits', 'field', 'ccdid', 'qid', 'rcid', 'fid',
                 'filtercode', 'pid', 'expid', 'obsdate',
@@ -135,11 +324,17 @@ class ZChecker:
         payload = {'WHERE': q, 'COLUMNS': ','.join(cols)}
         tab = ztf.query(payload, self.config.auth, logger=self.logger)
 
+        # not INSERT OR REPLACE: the delete triggers would remove the
+        # night's observations, detections, and search history
         self.db.execute('''
-        INSERT OR REPLACE INTO nights (date,nframes) VALUES (?,?)
-        ''', [date, len(tab)])
+        INSERT OR IGNORE INTO nights (date,nframes) VALUES (?,0)
+        ''', [date])
 
         nightid = self.nightid(date)
+        known = set([row[0] for row in self.db.execute('''
+        SELECT pid FROM obs WHERE nightid=? AND obsjd>=?
+        ''', [nightid, jd_start])])
+        new = [int(pid) for pid in tab['pid'] if pid not in known]
 
         def rows(nightid, tab):
             for row in tab:
@@ -148,12 +343,73 @@ class ZChecker:
         self.db.executemany('''
         INSERT OR IGNORE INTO obs VALUES ({})
         '''.format(','.join('?' * (len(cols) + 1))), rows(nightid, tab))
+        self.db.execute('''
+        UPDATE nights SET nframes=(SELECT count() FROM obs WHERE nightid=?)
+        WHERE nightid=?
+        ''', [nightid, nightid])
+        self.update_coverage(nightid)
         self.db.commit()
 
-        self.logger.info(
-            'Updated observation log for {} UT with {} images.'.format(date, len(tab)))
+        if since is None:
+            self.logger.info(
+                'Updated observation log for {} UT with {} images.'.format(
+                    date, len(tab)))
+        else:
+            self.logger.info(
+                'Updated observation log for {} UT with {} new images.'.format(
+                    date, len(new)))
+        return new
+
+    def update_coverage(self, nightid):
+        """Update the sky coverage map for a night.
+
+        Parameters
+        ----------
+        nightid : int
+          The night to update.
+
+        """
+
+        from . import coverage
+
+        rows = self.db.execute('''
+        SELECT ra,dec,obsjd FROM obs WHERE nightid=?
+        ''', [nightid]).fetchall()
+        if len(rows) == 0:
+            self.db.execute('DELETE FROM coverage WHERE nightid=?', [nightid])
+            return
+
+        ra, dec, obsjd = zip(*rows)
+        self.db.execute('''
+        INSERT OR REPLACE INTO coverage VALUES (?,?,?,?)
+        ''', (nightid, min(obsjd), max(obsjd), coverage.pack(ra, dec)))
+
+    def update_ephemeris(self, objects, start, end, update=False,
+                         threads=4):
+        """Retrieve ephemerides from Horizons and save to the database.
+
+        Ephemerides are requested concurrently, but written to the
+        database by this thread in a single transaction.  Request
+        rates and retries are controlled by the 'horizons' remote
+        service.
+
+        Parameters
+        ----------
+        objects : list
+          List of object designations.
+        start, end : string
+          The date range to retrieve, UT, YYYY-MM-DD.  The interval
+          range is inclusive.
+        update : bool, optional
+          Set to `True` to replace existing ephemerides, otherwise
+          skip objects already covered over the date range, according
+          to the ephcov table.
+        threads : int, optional
+          Maximum number of concurrent Horizons requests.
+
+        """
 
-    def update_ephemeris(self, objects, start, end, update=False):
+        from concurrent.futures import ThreadPoolExecutor, as_completed
         from astropy.time import Time
         from . import eph
         from .exceptions import ZCheckerError
@@ -172,22 +428,35 @@ class ZChecker:
             self.logger.info(
                 'Verifying ephemerides for the time period {} to {} UT.'.format(date_start, date_end))
 
-        updated = 0
-        for obj in objects:
-            self.logger.debug('* ' + obj)
-
-            if not update:
-                c = self.db.execute('''
-                SELECT count() FROM eph
-                WHERE desg = ?
-                  AND jd >= ?
-                  AND jd <= ?
-                ''', (obj, jd_start, jd_end)).fetchone()[0]
-                if c > 2:
-                    self.logger.debug('  Ephemeris already exists.')
+            # covered to within the 6-hour step
+            rows = self.db.execute('''
+            SELECT DISTINCT desg FROM ephcov
+            WHERE jd_start <= ?
+              AND jd_end >= ?
+            ''', (jd_start + 0.25, jd_end - 0.25)).fetchall()
+            existing = set([row[0] for row in rows])
+            for obj in objects:
+                if obj in existing:
+                    self.logger.debug(
+                        '* {}: Ephemeris already exists.'.format(obj))
+            objects = [obj for obj in objects if obj not in existing]
+
+        updated = []
+        failed = {}
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = dict([(executor.submit(eph.update, obj, jd_start,
+                                             jd_end, 6), obj)
+                            for obj in objects])
+            for future in as_completed(futures):
+                obj = futures[future]
+                try:
+                    rows = future.result()
+                except ZCheckerError as e:
+                    self.logger.error(
+                        'Error retrieving ephemeris for {}'.format(obj))
+                    failed[obj] = str(e)
                     continue
 
-            try:
                 self.db.execute('''
                 DELETE FROM eph
                 WHERE desg=?
@@ -195,20 +464,22 @@ class ZChecker:
                   AND jd <= ?
                 ''', (obj, jd_start, jd_end))
                 self.db.executemany('''
-                INSERT OR REPLACE INTO eph VALUES (?,?,?,?,?,?,?,?)
-                ''', eph.update(
-                    obj,
-                    jd_start,
-                    jd_end,
-                    6))
-            except ZCheckerError as e:
-                self.logger.error(
-                    'Error retrieving ephemeris for {}'.format(obj))
-
-            updated += 1
+                INSERT OR REPLACE INTO eph
+                (desg,jd,ra,dec,dra,ddec,vmag,retrieved,ra3sig,dec3sig)
+                VALUES (?,?,?,?,?,?,?,?,?,?)
+                ''', rows)
+                self.update_ephcov([obj])
+                updated.append(obj)
+                self.logger.debug('* {}, {} epochs'.format(obj, len(rows)))
 
         self.db.commit()
-        self.logger.info('  - Updated {} objects.'.format(updated))
+
+        self.logger.info('  - Updated {} objects.'.format(len(updated)))
+        if len(failed) > 0:
+            self.logger.info('  - Failed to update {} objects:'.format(
+                len(failed)))
+            for obj in sorted(failed, key=leading_num_key):
+                self.logger.info('    {:15} {}'.format(obj, failed[obj]))
 
     def clean_ephemeris(self, objects, start=None, end=None):
         """Remove ephemerides from the database.
@@ -262,6 +533,7 @@ class ZChecker:
             self.logger.debug('* {}, {} epochs'.format(obj, n))
             self.db.execute('DELETE ' + cmd, (obj,) + args)
 
+        self.update_ephcov(objects)
         self.db.commit()
 
     def clean_found(self, objects, start=None, end=None):
@@ -275,9 +547,11 @@ class ZChecker:
           The date range to remove.  The interval range is inclusive.
           Default is to remove all dates.
 
+        Rows are deleted in a single transaction.  Archive files are
+        removed by `clean_stale_files`.
+
         """
 
-        import os
         from astropy.time import Time
 
         if start is None:
@@ -295,46 +569,56 @@ class ZChecker:
             cmd = '''WHERE desg=? AND pid IN
                      (SELECT pid FROM obs WHERE obsjd >= ? AND obsjd <= ?)'''
             args = (jd_start, jd_end)
+            searched = '''WHERE desg=? AND nightid IN
+                     (SELECT nightid FROM nights WHERE date >= ? AND date <= ?)'''
+            searched_args = (start, end)
         elif start is None and end is not None:
             msg = ('Cleaning the found object database of {} objects,'
                    ' all dates up to {}.').format(len(objects), end)
             cmd = '''WHERE desg=? AND pid IN
                      (SELECT pid FROM obs WHERE obsjd <= ?)'''
             args = (jd_end,)
+            searched = '''WHERE desg=? AND nightid IN
+                     (SELECT nightid FROM nights WHERE date <= ?)'''
+            searched_args = (end,)
         elif end is None and start is not None:
             msg = ('Cleaning the found object database of {} objects,'
                    ' all dates starting {}.').format(len(objects), start)
             cmd = '''WHERE desg=? AND pid IN
                      (SELECT pid FROM obs WHERE obsjd >= ?)'''
             args = (jd_start,)
+            searched = '''WHERE desg=? AND nightid IN
+                     (SELECT nightid FROM nights WHERE date >= ?)'''
+            searched_args = (start,)
         else:
             msg = ('Cleaning the found object database of {} objects,'
                    ' all dates.').format(len(objects))
             cmd = 'WHERE desg=?'
             args = ()
+            searched = 'WHERE desg=?'
+            searched_args = ()
 
         self.logger.info(msg)
         total = 0
-        path = self.config['cutout path'] + os.path.sep
-        for obj in objects:
-            count = 0
-            rows = self.fetch_iter(
-                'SELECT foundid,archivefile FROM found ' + cmd,
-                (obj,) + args)
+        # one transaction: triggers move archive files to stale_files,
+        # which are removed by clean_stale_files
+        with self.db:
+            for obj in objects:
+                count = self.db.execute('DELETE FROM found ' + cmd,
+                                        (obj,) + args).rowcount
 
-            for row in rows:
-                count += 1
-                self.db.execute('DELETE FROM found WHERE foundid=?',
-                                (row['foundid'],))
-                self.db.commit()
+                # forget the search history so that these nights may be
+                # searched again
+                self.db.execute('DELETE FROM searched ' + searched,
+                                (obj,) + searched_args)
 
-            self.logger.debug('* {}, {} detections'.format(obj, count))
-            total += count
+                self.logger.debug('* {}, {} detections'.format(obj, count))
+                total += count
 
         self.logger.info(
             'Removed {} items from found database.'.format(total))
 
-    def _get_ephemeris(self, obj, jd):
+    def _get_ephemeris(self, obj, jd, unc=False):
         """Retrieve approximate ephemeris by interpolation.
 
         Parameters
@@ -343,6 +627,8 @@ class ZChecker:
           Requested object.
         jd: float
           Requested Julian date.
+        unc: bool, optional
+          Set to `True` to also return the position uncertainty.
 
         Returns
         -------
@@ -352,6 +638,10 @@ class ZChecker:
           Declination in radians.
         vmag: float
           Apparent visual magnitude.
+        unc: float
+          If requested, the estimated interpolation error plus the
+          larger of the RA and Dec 3-sigma uncertainties, in radians.
+          `inf` if the ephemeris uncertainty is unknown.
 
         Raises
         ------
@@ -362,31 +652,13 @@ class ZChecker:
 
         import numpy as np
         from astropy.coordinates.angle_utilities import angular_separation
-        from .eph import interp
         from .exceptions import EphemerisError
 
-        rows = self.db.execute('''
-        SELECT ra,dec,vmag,jd FROM eph
-        WHERE desg=?
-          AND jd>?
-          AND jd<?
-        ''', (obj, jd - 1.01, jd + 1.01)).fetchall()
-        if len(rows) == 0:
+        ra, dec, vmag, eph_jd, ra3sig, dec3sig = self._eph_window(
+            obj, jd - 1.01, jd + 1.01)
+        if len(eph_jd) == 0:
             raise EphemerisError('No dates found for ' + obj)
 
-        ra, dec, vmag, eph_jd = zip(*rows)
-        ra = np.radians(ra)
-        dec = np.radians(dec)
-        vmag = np.array([
-            v if (
-                (v is not None)
-                and (v != b'\x00\x00\x00\x00\x00\x00\x00\x00')
-            ) else 99.0
-            for v in vmag])
-        vmag = np.ma.MaskedArray(vmag, mask=(vmag == 99.0))
-        vmag = vmag.filled(99)
-        eph_jd = np.array(eph_jd)
-
         # find bin index of requested jd
         i = np.digitize([jd], eph_jd)[0]
         if i <= 0 or i >= len(eph_jd):
@@ -405,15 +677,256 @@ class ZChecker:
         p1 = np.sin((1 - dt) * w) / np.sin(w)
         p2 = np.sin(dt * w) / np.sin(w)
 
-        ra = p1 * ra[i - 1] + p2 * ra[i]
-        dec = p1 * dec[i - 1] + p2 * dec[i]
+        _ra = p1 * ra[i - 1] + p2 * ra[i]
+        _dec = p1 * dec[i - 1] + p2 * dec[i]
         vmag = (1 - dt) * vmag[i - 1] + dt * vmag[i]
 
-        return ra, dec, vmag
+        if not unc:
+            return _ra, _dec, vmag
+
+        # interpolation error: the offset of the node between the
+        # neighboring ephemeris points from the interpolation over the
+        # double-width bin, scaled by the bin width squared
+        err = 0
+        for j in (i - 1, i):
+            if j - 1 < 0 or j + 1 >= len(eph_jd):
+                continue
+            t = (eph_jd[j] - eph_jd[j - 1]) / (eph_jd[j + 1] - eph_jd[j - 1])
+            w = angular_separation(ra[j - 1], dec[j - 1], ra[j + 1],
+                                   dec[j + 1])
+            if w == 0:
+                continue
+            p1 = np.sin((1 - t) * w) / np.sin(w)
+            p2 = np.sin(t * w) / np.sin(w)
+            d = angular_separation(p1 * ra[j - 1] + p2 * ra[j + 1],
+                                   p1 * dec[j - 1] + p2 * dec[j + 1],
+                                   ra[j], dec[j])
+            err = max(err, d / 4)
+
+        sig = (ra3sig[i - 1], ra3sig[i], dec3sig[i - 1], dec3sig[i])
+        if any([s is None for s in sig]):
+            sig = np.inf
+        else:
+            sig = np.radians(max(sig) / 3600)
+
+        return _ra, _dec, vmag, err + sig
 
-    def fov_search(self, start, end, objects=None, vlim=25):
+    def _eph_window(self, obj, jd0, jd1):
+        """Ephemeris of an object, jd0 < jd < jd1, sorted by jd.
+
+        Read from the database through a cache of per-object windows,
+        each extending `eph_cache_days` past jd1 when loaded.
+
+        Returns
+        -------
+        ra, dec : ndarray
+          Radians.
+        vmag : ndarray
+          Apparent visual magnitude, 99 where unknown.
+        jd : ndarray
+        ra3sig, dec3sig : list
+          Arcsec, `None` where unknown.
+
+        """
+
+        import numpy as np
+
+        window = self._eph_cache.get(obj)
+        if window is None or jd0 < window[0] or jd1 > window[1]:
+            lo, hi = jd0, jd1 + self.eph_cache_days
+            rows = self.db.execute('''
+            SELECT ra,dec,vmag,jd,ra3sig,dec3sig FROM eph
+            WHERE desg=?
+              AND jd>?
+              AND jd<?
+            ORDER BY jd
+            ''', (obj, lo, hi)).fetchall()
+            if len(rows) == 0:
+                rows = [[]] * 6
+            else:
+                rows = list(zip(*rows))
+            ra, dec, vmag, jd, ra3sig, dec3sig = rows
+            vmag = [
+                v if (
+                    (v is not None)
+                    and (v != b'\x00\x00\x00\x00\x00\x00\x00\x00')
+                ) else 99.0
+                for v in vmag]
+            window = (lo, hi, np.radians(np.array(ra, float)),
+                      np.radians(np.array(dec, float)),
+                      np.array(vmag, float), np.array(jd, float),
+                      list(ra3sig), list(dec3sig))
+            self._eph_cache[obj] = window
+            if len(self._eph_cache) > self.eph_cache_size:
+                self._eph_cache.popitem(last=False)
+        else:
+            self._eph_cache.move_to_end(obj)
+
+        i = np.searchsorted(window[5], jd0, side='right')
+        j = np.searchsorted(window[5], jd1, side='left')
+        return tuple(x[i:j] for x in window[2:])
+
+    def _pending_searches(self, objects, start, end, vlim, force=False,
+                          prune=None, ignore_nframes=False):
+        """Object-night pairs that need to be searched.
+
+        A pair needs to be searched if it is not in the search
+        history, or if the ephemeris retrieval date, the night's
+        number of frames, the magnitude limit, or the pruning rules
+        have changed since it was last searched.  A search without
+        pruning rules satisfies any rules.
+
+        Parameters
+        ----------
+        objects : list of strings
+          Objects to consider.
+        start, end : string
+          Date range to check, UT, YYYY-MM-DD.
+        vlim : float
+          Objects fainter than vlim are ignored.
+        force : bool, optional
+          Set to `True` to ignore the search history.
+        prune : string, optional
+          Pruning rules of this search, see `fov_search`.
+        ignore_nframes : bool, optional
+          Set to `True` to ignore changes to the number of frames,
+          e.g., to find the pairs that must be searched over the whole
+          night, rather than in new images alone.
+
+        Returns
+        -------
+        pending : dict
+          Objects to search, keyed by nightid.
+        history : list of tuples
+          New search history rows: desg, nightid, retrieved, nframes,
+          vlim, prune.
+
+        """
+
+        from astropy.time import Time
+
+        objects = set(objects)
+        pending = {}
+        history = []
+        nights = self.db.execute('''
+        SELECT nightid,date,nframes FROM nights WHERE date>=? AND date<=?
+        ''', (start, end)).fetchall()
+        for nightid, date, nframes in nights:
+            # same ephemeris window as _get_ephemeris
+            jd = Time(date).jd
+            rows = self.db.execute('''
+            SELECT desg,max(retrieved) FROM eph
+            WHERE jd>?
+              AND jd<?
+            GROUP BY desg
+            ''', (jd - 1.01, jd + 2.01)).fetchall()
+            retrieved = dict([(row[0], row[1]) for row in rows
+                              if row[0] in objects])
+
+            previous = {}
+            if not force:
+                rows = self.db.execute('''
+                SELECT desg,retrieved,nframes,vlim,prune FROM searched
+                WHERE nightid=?
+                ''', [nightid]).fetchall()
+                previous = dict([(row[0], row[1:]) for row in rows])
+
+            pending[nightid] = []
+            for obj in sorted(retrieved, key=leading_num_key):
+                if obj in previous:
+                    r, n, v, p = previous[obj]
+                    if (r == retrieved[obj]
+                            and (n == nframes or ignore_nframes)
+                            and v is not None and v >= vlim
+                            and (p is None or p == prune)):
+                        continue
+                pending[nightid].append(obj)
+                history.append((obj, nightid, retrieved[obj], nframes, vlim,
+                                prune))
+
+            if len(pending[nightid]) == 0:
+                del pending[nightid]
+
+        return pending, history
+
+    def _coverage_filter(self, pending):
+        """Remove objects that are not near any quad from a night.
+
+        Each object's track over the night is compared to the night's
+        coverage map, dilated to the 1.5 deg coarse search distance.
+
+        Parameters
+        ----------
+        pending : dict
+          Objects to search, keyed by nightid.  Updated in place.
+
+        Returns
+        -------
+        n : int
+          Number of object-night pairs removed.
+
+        """
+
+        import numpy as np
+        from . import coverage
+
+        removed = 0
+        for nightid in list(pending.keys()):
+            row = self.db.execute('''
+            SELECT jd_start,jd_end,cells FROM coverage WHERE nightid=?
+            ''', [nightid]).fetchone()
+            if row is None:
+                # observations from before coverage maps were introduced
+                self.update_coverage(nightid)
+                row = self.db.execute('''
+                SELECT jd_start,jd_end,cells FROM coverage WHERE nightid=?
+                ''', [nightid]).fetchone()
+                if row is None:
+                    continue
+
+            jd_start, jd_end, cells = row
+            # 0.026 rad coarse search cut, plus half the track
+            # sampling step
+            m = coverage.dilate(coverage.unpack(cells), 1.5 + 0.125)
+            m = m.ravel()
+
+            objects = set(pending[nightid])
+            ephs = {}
+            rows = self.fetch_iter('''
+            SELECT desg,jd,ra,dec FROM eph
+            WHERE jd>?
+              AND jd<?
+            ORDER BY desg,jd
+            ''', (jd_start - 1.01, jd_end + 1.01))
+            for row in rows:
+                if row[0] in objects:
+                    ephs.setdefault(row[0], []).append(row[1:])
+
+            keep = []
+            for obj in pending[nightid]:
+                if len(ephs.get(obj, [])) < 2:
+                    continue
+                jd, ra, dec = zip(*ephs[obj])
+                ra, dec = coverage.track(jd, ra, dec, jd_start, jd_end)
+                if np.any(m[coverage.cells(ra, dec)]):
+                    keep.append(obj)
+
+            removed += len(pending[nightid]) - len(keep)
+            if len(keep) == 0:
+                del pending[nightid]
+            else:
+                pending[nightid] = keep
+
+        return removed
+
+    def fov_search(self, start, end, objects=None, vlim=25, force=False,
+                   depth_margin=None, skip_flagged=False, on_found=None,
+                   pids=None):
         """Search for objects in ZTF fields.
 
+        Object-night pairs already searched are skipped, unless the
+        ephemeris or observations have since changed.
+
         Parameters
         ----------
         start, end : string
@@ -426,13 +939,45 @@ class ZChecker:
         vlim : float
           Objects fainter than vlim are ignored.
 
+        force : bool, optional
+          Set to `True` to search all object-night pairs, even if
+          previously searched.
+
+        depth_margin : float, optional
+          Skip epochs when the object is fainter than the image's
+          limiting magnitude (obs.maglimit) plus this margin, mag.  At
+          the coarse stage, the deepest of the nearest quads is used;
+          detections confirmed by the fine search are checked against
+          their own quad.
+
+        skip_flagged : bool, optional
+          Skip quads with non-zero infobits.
+
+        on_found : function, optional
+          Called after each batch of detections is saved, with the
+          detections (see `fine_quad_search`), their foundids, and the
+          Julian date of the last epoch searched: all detections up to
+          that date have been reported.  E.g., to start downloads while the
+          search continues.
+
+        pids : list of int, optional
+          Only search these images, e.g., those just added by
+          `update_obs`.  Object-night pairs searched before, when the
+          nights had fewer images, are searched in these images
+          alone.  Other pairs, e.g., targets new to the search history
+          or with an updated ephemeris, are searched in all images of
+          their nights.
+
         """
 
+        from itertools import chain
         import numpy as np
         import astropy.units as u
         from astropy.time import Time
         from astropy.coordinates.angle_utilities import angular_separation
+        from .candidates import CandidateBuffer, quad_dtype
         from .exceptions import DateRangeError
+        from . import profiling
 
         # fov_search takes days as input, splits them 0 UT
         jd_start = Time(start).jd
@@ -445,7 +990,7 @@ class ZChecker:
 
         if objects is None:
             c = self.db.execute('''
-            SELECT DISTINCT desg FROM eph WHERE jd>=? AND jd<=?
+            SELECT DISTINCT desg FROM ephcov WHERE jd_end>=? AND jd_start<=?
             ''', (jd_start, jd_end))
             objects = [str(row[0]) for row in c.fetchall()]
         assert isinstance(objects, (list, tuple, np.ndarray))
@@ -460,98 +1005,265 @@ class ZChecker:
 
         self.logger.info('Searching for {} objects.'.format(len(objects)))
 
+        prune = []
+        if depth_margin is not None:
+            prune.append('depth+{:g}'.format(depth_margin))
+        if skip_flagged:
+            prune.append('infobits')
+        prune = ','.join(prune) if len(prune) > 0 else None
+
+        if pids is not None:
+            # pairs that need more than the new images
+            pending, history = self._pending_searches(
+                objects, start, end, vlim, force=force, prune=prune,
+                ignore_nframes=True)
+            full = set([row[0] for row in history])
+            if len(full) > 0:
+                self.logger.info(
+                    '{} objects to search in all images.'.format(len(full)))
+                self.fov_search(start, end,
+                                objects=sorted(full, key=leading_num_key),
+                                vlim=vlim, force=force,
+                                depth_margin=depth_margin,
+                                skip_flagged=skip_flagged, on_found=on_found)
+                objects = [obj for obj in objects if obj not in full]
+
+            pids = set(pids)
+            self.logger.info('Searching {} new images for {} objects.'.format(
+                len(pids), len(objects)))
+
+        pending, history = self._pending_searches(
+            objects, start, end, vlim, force=force, prune=prune)
+        self.logger.info(
+            '{} object-night pairs to search, over {} nights.'.format(
+                len(history), len(pending)))
+
+        removed = self._coverage_filter(pending)
+        self.logger.info(
+            '{} object-night pairs not near any exposure.'.format(removed))
+
+        if len(pending) == 0:
+            # nothing to search, but update the history
+            self.db.executemany('''
+            INSERT OR REPLACE INTO searched VALUES (?,?,?,?,?,?)
+            ''', history)
+            self.db.commit()
+            return
+
         found_objects = {}
         horizons_chunk = 2000  # collect N obs before querying HORIZONS
-        follow_up = {}
-        follow_up_count = 0
-        searched = 0
+        # depth-pruned object-epochs in this batch, and totals: pruned
+        # epochs, Horizons calls, quads, and detections
+        batch_pruned = []
+        pruned = {'epochs': 0, 'calls': 0, 'quads': 0, 'found': 0}
+        candidates = CandidateBuffer()
+        batches = 0
+        total = 0
+        kept = 0
+
+        # the search history is saved as each night is completed;
+        # object-night pairs whose ephemeris failed are removed from
+        # it, and searched again next time
+        failed = set()
+        saved = set()
+        night_end = dict(self.db.execute('''
+        SELECT nightid,max(obsjd) FROM obs WHERE nightid IN ({})
+        GROUP BY nightid
+        '''.format(','.join('?' * len(pending))),
+            list(pending.keys())).fetchall())
+
+        def save_history(nightids):
+            self.db.executemany('''
+            INSERT OR REPLACE INTO searched VALUES (?,?,?,?,?,?)
+            ''', [row for row in history if row[1] in nightids
+                  and (row[0], row[1]) not in failed])
+            self.db.executemany('''
+            DELETE FROM searched WHERE desg=? AND nightid=?
+            ''', [pair for pair in failed if pair[1] in nightids])
+            self.db.commit()
+            saved.update(nightids)
 
         # get all quads over requested date range and search them one
         # epoch at a time
+        flagged = ''
+        if pids is not None:
+            # the new images' epochs, and flagged images, 500 at a time
+            first = jd_end
+            chunks = list(pids)
+            for i in range(0, len(chunks), 500):
+                chunk = chunks[i:i + 500]
+                row = self.db.execute('''
+                SELECT min(obsjd),total(infobits!=0) FROM obs
+                WHERE pid IN ({})
+                '''.format(','.join('?' * len(chunk))), chunk).fetchone()
+                if row[0] is not None:
+                    first = min(first, row[0])
+                if skip_flagged:
+                    pruned['quads'] += int(row[1])
+            jd_start = max(jd_start, first)
+
+        if skip_flagged:
+            flagged = 'AND infobits=0'
+            if pids is None:
+                pruned['quads'] = self.db.execute('''
+                SELECT count() FROM obs
+                WHERE obsjd>=? and obsjd<=?
+                  AND nightid IN ({})
+                  AND infobits!=0
+                '''.format(','.join('?' * len(pending))),
+                    [jd_start, jd_end] + list(pending.keys())).fetchone()[0]
+
         all_quads = self.fetch_iter('''
-        SELECT obsjd,pid,ra * 0.017453292519943295,dec * 0.017453292519943295,ra1 * 0.017453292519943295,ra2 * 0.017453292519943295,ra3 * 0.017453292519943295,ra4 * 0.017453292519943295,dec1 * 0.017453292519943295,dec2 * 0.017453292519943295,dec3 * 0.017453292519943295,dec4 * 0.017453292519943295 FROM obs
+        SELECT obsjd,pid,ra * 0.017453292519943295,dec * 0.017453292519943295,ra1 * 0.017453292519943295,ra2 * 0.017453292519943295,ra3 * 0.017453292519943295,ra4 * 0.017453292519943295,dec1 * 0.017453292519943295,dec2 * 0.017453292519943295,dec3 * 0.017453292519943295,dec4 * 0.017453292519943295,nightid,IFNULL(maglimit,99) FROM obs
         WHERE obsjd>=? and obsjd<=?
+          AND nightid IN ({})
+          {}
         ORDER BY obsjd
-        ''', (jd_start, jd_end))
+        '''.format(','.join('?' * len(pending)), flagged),
+            [jd_start, jd_end] + list(pending.keys()))
+        if pids is not None:
+            all_quads = (quad for quad in all_quads if quad[1] in pids)
+        all_quads = profiling.timed_iter('sql fetch', all_quads)
 
-        quad = next(all_quads)
+        quad = next(all_quads, None)
         if not quad:
             raise DateRangeError(
                 'No observations found for UT date range {} to {}.'.format(
                     start, end))
 
-        # initialize loop
-        quads = [quad]
+        # initialize loop, None marks the end of the quads
+        quads = [tuple(quad)]
         this_jd = quad[0]
-        searched = 0
-        for quad in all_quads:
-            searched += 1
-            if (searched % 100000) == 0:
-                self.logger.info('.' * (searched // 100000))
-
-            # collect by observation date
-            if quad[0] == this_jd:
-                quads.append(quad)
-            else:
-                # collected all quads
-                # coarse quad search
-                for obj, q in self.coarse_quad_search(
-                        this_jd, quads, objects, vlim):
-                    follow_up[obj] = follow_up.get(obj, []) + [q]
-                    follow_up_count += 1
-
-                # precise ephemeris check
-                if follow_up_count > horizons_chunk:
-                    found = self.fine_quad_search(follow_up)
-                    if len(found) > 0:
-                        for row in found:
-                            obj = row[0]
-                            found_objects[obj] = found_objects.get(obj, 0) + 1
-                        self._update_found(found)
-                    follow_up = {}
-                    follow_up_count = 0
+        searched = 1
+        for quad in chain(all_quads, [None]):
+            if quad is not None:
+                searched += 1
+                if (searched % 100000) == 0:
+                    self.logger.info('.' * (searched // 100000))
+
+                # collect by observation date
+                if quad[0] == this_jd:
+                    quads.append(tuple(quad))
+                    continue
 
+            # collected all quads, coarse quad search
+            quads = np.array(quads, quad_dtype)
+            with profiling.span('coarse search'):
+                matches = self.coarse_quad_search(
+                    this_jd, quads, pending[int(quads['nightid'][0])], vlim,
+                    depth_margin=depth_margin, pruned=batch_pruned)
+            if len(matches) > 0:
+                # only save the nearest quads to the window
+                nearest = np.unique(np.concatenate([m[1] for m in matches]))
+                offset = candidates.add_quads(quads[nearest])
+                for obj, i, ra, dec, margin in matches:
+                    candidates.add(obj, offset + np.searchsorted(nearest, i),
+                                   ra, dec, margin)
+
+            # precise ephemeris check
+            if len(candidates) > horizons_chunk or (
+                    quad is None and len(candidates) > 0):
+                batches += 1
+                total += len(candidates)
+                with profiling.span('local search'):
+                    kept += self.local_quad_search(candidates)
+
+                # objects without any epoch left in this batch need no
+                # Horizons query
+                remaining = set([candidates.objects[i] for i in np.unique(
+                    candidates.candidates['obj'])])
+                pruned['epochs'] += len(batch_pruned)
+                pruned['calls'] += len(set(batch_pruned) - remaining)
+                batch_pruned = []
+
+                fine_pruned = []
+                with profiling.span('fine search'):
+                    found = self.fine_quad_search(
+                        candidates, depth_margin=depth_margin,
+                        pruned=fine_pruned, failed=failed)
+                pruned['found'] += len(fine_pruned)
+                foundids = []
+                if len(found) > 0:
+                    for row in found:
+                        obj = row[0]
+                        found_objects[obj] = found_objects.get(obj, 0) + 1
+                    with profiling.span('update found'):
+                        foundids = self._update_found(found)
+                if on_found is not None:
+                    on_found(found, foundids, this_jd)
+                candidates.clear()
+                save_history(set([nightid for nightid in pending
+                                  if nightid not in saved
+                                  and night_end[nightid] <= this_jd]))
+
+            if quad is not None:
                 # reset quad list
-                quads = [quad]
+                quads = [tuple(quad)]
                 this_jd = quad[0]
 
-        # any remaining objects for follow_up?
-        if follow_up_count > 0:
-            found = self.fine_quad_search(follow_up)
-            if len(found) > 0:
-                for row in found:
-                    obj = row[0]
-                    found_objects[obj] = found_objects.get(obj, 0) + 1
-                self._update_found(found)
+        # depth-pruned epochs after the last batch
+        pruned['epochs'] += len(batch_pruned)
+        pruned['calls'] += len(set(batch_pruned))
+
+        save_history(set([row[1] for row in history]) - saved)
 
         self.logger.info('Searched {} quads.'.format(searched))
+        if len(failed) > 0:
+            self.logger.warning(
+                '{} objects failed the ephemeris check, {} object-night'
+                ' pairs will be searched again.'.format(
+                    len(set([pair[0] for pair in failed])), len(failed)))
+        if prune is not None:
+            self.logger.info(
+                'Pruning ({}): {} flagged quads skipped, {} object-epochs'
+                ' fainter than the image depth, up to {} Horizons calls'
+                ' and {} cutout downloads avoided.'.format(
+                    prune, pruned['quads'], pruned['epochs'],
+                    pruned['calls'], pruned['found']))
+        self.logger.info(
+            'Sent {} of {} candidate epochs to the fine search in {} batches'
+            ' ({:.0%} pruned by the local pre-check).'.format(
+                kept, total, batches, 1 - kept / max(total, 1)))
+        self.logger.info(
+            '  Candidate buffer peak size: {:.1f} kiB, hand-off format: '
+            'int32 quad indices (4 per epoch) into a structured array '
+            '({} bytes per quad).'.format(
+                candidates.peak_nbytes / 1024,
+                np.dtype(quad_dtype).itemsize))
         self.logger.info('Found {} objects.'.format(len(found_objects)))
         if len(found_objects) > 0:
             for k in sorted(found_objects, key=leading_num_key):
                 self.logger.info('  {:15} x{}'.format(k, found_objects[k]))
 
-    def coarse_quad_search(self, obsjd, quads, objects, vlim):
+    def coarse_quad_search(self, obsjd, quads, objects, vlim,
+                           depth_margin=None, pruned=None):
         """Nearest-neighbor search.
 
         Parameters
         ----------
         obsjd : float
           Julian date.
-        quads : list of lists
-          Each item is a list of quadrant parameters:
-            obsjd, pid, ra_c, dec_c, ra1, ra2, ra3, ra4, dec1, dec2, dec3, dec4
-          where 1..4 are coordinates of the corners.
+        quads : ndarray
+          Quadrant parameters, structured with
+          `candidates.quad_dtype`: obsjd, pid, ra, dec, ra1, ra2,
+          ra3, ra4, dec1, dec2, dec3, dec4, nightid, maglimit, where
+          1..4 are coordinates of the corners, all angles in radians.
         objects : list of string
           Objects.
         vlim : float
           Limiting magnitude to consider.
+        depth_margin : float, optional
+          Skip objects fainter than the deepest of their nearest quads'
+          maglimit plus this margin.
+        pruned : list, optional
+          Objects skipped by `depth_margin` are appended to this list.
 
         Returns
         -------
-        objects : list
-          Found objects.
-        quads : list
-          Nearest 4 quads for each object.
+        found : list of tuples
+          Found objects, the indices of their nearest 4 quads, and
+          their approximate positions and uncertainties (ra, dec,
+          margin) in radians.
 
         """
 
@@ -559,8 +1271,8 @@ class ZChecker:
         from astropy.coordinates.angle_utilities import angular_separation
         from .exceptions import EphemerisError
 
-        (ra_c, dec_c, ra1, ra2, ra3, ra4,
-         dec1, dec2, dec3, dec4) = tuple(zip(*quads))[2:]
+        ra_c = quads['ra']
+        dec_c = quads['dec']
 
         found = []
         for obj in objects:
@@ -583,18 +1295,83 @@ class ZChecker:
             if min(d) > 0.026:
                 continue
 
-            found.append((obj, [quads[i] for i in np.argsort(d)[:4]]))
+            nearest = np.argsort(d)[:4]
+            if (depth_margin is not None and
+                    vmag > quads['maglimit'][nearest].max() + depth_margin):
+                if pruned is not None:
+                    pruned.append(obj)
+                continue
+
+            ra, dec, vmag, margin = self._get_ephemeris(obj, obsjd, unc=True)
+            found.append((obj, nearest, ra, dec, margin))
 
         return found
 
-    def fine_quad_search(self, follow_up):
+    def local_quad_search(self, candidates, margin=10):
+        """Interior test with the approximate ephemeris.
+
+        Candidates that are clearly outside of all their nearest quads
+        are removed, so that they are not checked with Horizons.
+
+        Parameters
+        ----------
+        candidates : CandidateBuffer
+          Quads to search, organized by object and epoch.  Updated in
+          place.
+        margin : float, optional
+          Minimum margin around each quad, added to the candidate's
+          interpolation error and ephemeris uncertainty, arcsec.
+
+        Returns
+        -------
+        n : int
+          The number of remaining candidates.
+
+        """
+
+        import numpy as np
+
+        quads = candidates.quads
+        margin = np.radians(margin / 3600)
+        keep = np.zeros(len(candidates), bool)
+        for i, c in enumerate(candidates.candidates):
+            if not np.isfinite(c['margin']):
+                keep[i] = True
+                continue
+
+            for quad in quads[c['quads'][c['quads'] >= 0]]:
+                ra_corners = [quad[k] for k in ('ra1', 'ra2', 'ra3', 'ra4')]
+                dec_corners = [quad[k] for k in
+                               ('dec1', 'dec2', 'dec3', 'dec4')]
+                if interior_test(c['ra'], c['dec'], ra_corners, dec_corners,
+                                 margin=c['margin'] + margin):
+                    keep[i] = True
+                    break
+
+        self.logger.info(
+            'Local pre-check: {} of {} candidate epochs are inside or near'
+            ' a quad ({:.0%} pruned).'.format(
+                keep.sum(), len(keep), 1 - keep.sum() / max(len(keep), 1)))
+        candidates.keep(keep)
+        return int(keep.sum())
+
+    def fine_quad_search(self, candidates, depth_margin=None, pruned=None,
+                         failed=None):
         """Precise ephemeris check using Horizons.
 
         Parameters
         ----------
-        follow_up : dict
-          Each item is a list of quadrant lists to search, organized
-          by epoch, all angles in radians.
+        candidates : CandidateBuffer
+          Quads to search, organized by object and epoch.
+        depth_margin : float, optional
+          Drop detections fainter than their quad's maglimit plus this
+          margin.
+        pruned : list, optional
+          Dropped detections are appended to this list as (desg, pid).
+        failed : set, optional
+          Objects whose ephemeris could not be retrieved are skipped,
+          and added to this set as (desg, nightid) pairs.  Without it,
+          the error is raised.
 
         Returns
         -------
@@ -608,27 +1385,48 @@ class ZChecker:
         import numpy as np
         from astropy.time import Time
         from .eph import ephemeris
+        from .exceptions import ZCheckerError
 
-        self.logger.info('Checking {} objects in detail.'.format(
-            len(follow_up)))
+        groups = list(candidates.groups())
+        self.logger.info('Checking {} objects in detail.'.format(len(groups)))
 
+        quads = candidates.quads
         found = []
-        for desg, all_quads in follow_up.items():
+        for desg, c in groups:
+            nearest = c['quads']
             self.logger.debug('  {}, {} epochs'.format(
-                desg, len(all_quads)))
+                desg, len(nearest)))
 
-            obsjd = np.array([quads[0]['obsjd'] for quads in all_quads])
+            obsjd = quads['obsjd'][nearest[:, 0]]
             dt = np.diff(obsjd)
-            assert not np.any(dt<=0), 'Quads must be in time order, found a time step of {}; checking expids: {}'.format(str(dt[dt<=0]), [quads[0]['expid'] for quads in all_quads])
+            assert not np.any(dt<=0), 'Quads must be in time order, found a time step of {}; checking pids: {}'.format(str(dt[dt<=0]), list(quads['pid'][nearest[:, 0]]))
+
+            try:
+                eph = ephemeris(desg, obsjd)
+            except ZCheckerError as e:
+                if failed is None:
+                    raise
+                self.logger.error('  {}: {}'.format(desg, str(e)))
+                failed.update([(desg, int(nightid)) for nightid in set(
+                    quads['nightid'][nearest[:, 0]])])
+                continue
 
-            eph = ephemeris(desg, obsjd)
-            for i, quads in enumerate(all_quads):
-                for quad in quads:
+            for i in range(len(nearest)):
+                for quad in quads[nearest[i][nearest[i] >= 0]]:
                     ra = np.radians(eph['RA'][i])
                     dec = np.radians(eph['DEC'][i])
-                    ra_corners = quad[4:8]
-                    dec_corners = quad[8:12]
+                    ra_corners = [quad[k] for k in ('ra1', 'ra2', 'ra3', 'ra4')]
+                    dec_corners = [quad[k] for k in
+                                   ('dec1', 'dec2', 'dec3', 'dec4')]
                     if interior_test(ra, dec, ra_corners, dec_corners):
+                        V = eph['V'][i]
+                        if (depth_margin is not None
+                                and V is not np.ma.masked
+                                and V > quad['maglimit'] + depth_margin):
+                            if pruned is not None:
+                                pruned.append((desg, quad['pid']))
+                            continue
+
                         # stop at first match
                         row = [desg, obsjd[i]]
                         row.append(eph['RA'][i])
@@ -639,7 +1437,7 @@ class ZChecker:
                             ra3sig = float(eph['RA_3sigma'][i])
                             dec3sig = float(eph['DEC_3sigma'][i])
                         except ValueError:
-                            row.append((None, None))
+                            row.extend([None, None])
                         else:
                             if not np.isfinite(ra3sig):
                                 ra3sig = None
@@ -660,11 +1458,221 @@ class ZChecker:
 
         return found
 
+    def lookup(self, desg, start, end, margin=10, confirm=False):
+        """Images that contain, or may contain, one target.
+
+        A read-only alternative to `fov_search` for a single target.
+        The target's ephemeris track is walked one ephemeris step at a
+        time, against the quads taken during that step, selected with
+        the obs(obsjd) index and a declination window.  Nothing is
+        written to the database.
+
+        Parameters
+        ----------
+        desg : string
+          Target designation.
+        start, end : string
+          Date range, UT, YYYY-MM-DD, inclusive.
+        margin : float, optional
+          Minimum margin around each quad, added to the interpolation
+          error and ephemeris uncertainty, arcsec.
+        confirm : bool, optional
+          Check candidates with Horizons.  Those outside all quads are
+          dropped.
+
+        Returns
+        -------
+        rows : list of dict
+          One per quad, in time order: pid, obsdate, obsjd, filtercode,
+          infobits, maglimit, ra, dec (target, deg), vmag, and status.
+          status is 'found' for detections in the found table,
+          'confirmed' for candidates inside the quad according to
+          Horizons, 'inside' for candidates inside the quad according
+          to the interpolated ephemeris, and 'near' for candidates
+          within the position uncertainty and `margin` of the quad.
+
+        Raises
+        ------
+        EphemerisError
+          If the target has no ephemeris in the date range.
+
+        """
+
+        import numpy as np
+        from astropy.time import Time
+        from astropy.coordinates.angle_utilities import angular_separation
+        from .exceptions import EphemerisError
+
+        jd_start = Time(start).jd
+        jd_end = Time(end).jd + 1.0  # end of the day
+
+        window = self._eph_window(desg, jd_start - 1.01, jd_end + 1.01)
+        dec, eph_jd = window[1], window[3]
+        if len(eph_jd) < 2:
+            raise EphemerisError('No dates found for ' + desg)
+
+        # walk the track: quads within 1.5 deg of the target's
+        # declination during each ephemeris step
+        pad = 1.5
+        quads = []
+        for i in range(len(eph_jd) - 1):
+            # same coverage rules as _get_ephemeris
+            jd0 = max(eph_jd[i], jd_start)
+            jd1 = min(eph_jd[i + 1], eph_jd[i] + 1, jd_end)
+            if jd1 <= jd0:
+                continue
+
+            dec0, dec1 = np.degrees(sorted(dec[i:i + 2]))
+            quads.extend(self.db.execute('''
+            SELECT pid,obsdate,obsjd,filtercode,infobits,maglimit,
+              ra,dec,ra1,ra2,ra3,ra4,dec1,dec2,dec3,dec4
+            FROM obs
+            WHERE obsjd>=? AND obsjd<?
+              AND dec>=? AND dec<=?
+            ORDER BY obsjd
+            ''', (jd0, jd1, dec0 - pad, dec1 + pad)).fetchall())
+
+        found = dict([(row['pid'], row) for row in self.db.execute('''
+        SELECT pid,ra,dec,vmag FROM found
+        WHERE desg=? AND obsjd>=? AND obsjd<=?
+        ''', (desg, jd_start, jd_end))])
+
+        # target position at each exposure
+        positions = {}
+        for quad in quads:
+            jd = quad['obsjd']
+            if jd not in positions:
+                try:
+                    positions[jd] = self._get_ephemeris(desg, jd, unc=True)
+                except EphemerisError:
+                    positions[jd] = (np.nan,) * 4
+        target = np.array([positions[quad['obsjd']] for quad in quads],
+                          float).reshape((-1, 4))
+        center = np.radians([(quad['ra'], quad['dec']) for quad in quads]
+                            ).reshape((-1, 2))
+        near = angular_separation(target[:, 0], target[:, 1], center[:, 0],
+                                  center[:, 1]) <= np.radians(pad)
+
+        rows = []
+        for i, quad in enumerate(quads):
+            if not (near[i] or quad['pid'] in found):
+                continue
+
+            _ra, _dec, _vmag, unc = target[i]
+            ra_c = np.radians([quad[k] for k in ('ra1', 'ra2', 'ra3', 'ra4')])
+            dec_c = np.radians([quad[k] for k in
+                                ('dec1', 'dec2', 'dec3', 'dec4')])
+            if quad['pid'] in found:
+                status = 'found'
+            elif interior_test(_ra, _dec, ra_c, dec_c):
+                status = 'inside'
+            elif not np.isfinite(unc) or interior_test(
+                    _ra, _dec, ra_c, dec_c,
+                    margin=unc + np.radians(margin / 3600)):
+                status = 'near'
+            else:
+                continue
+
+            row = dict([(k, quad[k]) for k in
+                        ('pid', 'obsdate', 'obsjd', 'filtercode',
+                         'infobits', 'maglimit')])
+            row['ra'] = float(np.degrees(_ra) % 360)
+            row['dec'] = float(np.degrees(_dec))
+            row['vmag'] = float(_vmag)
+            row['status'] = status
+            if status == 'found':
+                f = found[quad['pid']]
+                row.update(ra=f['ra'], dec=f['dec'], vmag=f['vmag'])
+            rows.append((row, ra_c, dec_c))
+
+        if confirm:
+            rows = self._lookup_confirm(desg, rows)
+
+        return [row[0] for row in rows]
+
+    def _lookup_confirm(self, desg, rows):
+        """Check `lookup` candidates with Horizons."""
+
+        import numpy as np
+        from .eph import ephemeris
+
+        jd = sorted(set([row['obsjd'] for row, ra_c, dec_c in rows
+                         if row['status'] != 'found']))
+        if len(jd) == 0:
+            return rows
+
+        eph = ephemeris(desg, jd, orbit=False)
+        eph = dict(zip(jd, eph))
+        confirmed = []
+        for row, ra_c, dec_c in rows:
+            if row['status'] != 'found':
+                e = eph[row['obsjd']]
+                ra = np.radians(e['RA'])
+                dec = np.radians(e['DEC'])
+                if not interior_test(ra, dec, ra_c, dec_c):
+                    continue
+                row['status'] = 'confirmed'
+                row['ra'] = float(e['RA'])
+                row['dec'] = float(e['DEC'])
+                if e['V'] is not np.ma.masked:
+                    row['vmag'] = float(e['V'])
+            confirmed.append((row, ra_c, dec_c))
+
+        return confirmed
+
     def _update_found(self, found):
+        """Add or update found objects.
+
+        Detections already in the database keep their foundid and
+        downloaded products; only ephemeris-derived columns are
+        updated.  A detection whose position moved by more than the
+        "found tolerance" (arcsec, default 1) is replaced, which
+        queues its files for removal and resets its products.
+
+        Parameters
+        ----------
+        found : list
+          desg, obsjd, ra, dec, dra, ddec, ra3sig, dec3sig, vmag, rh,
+          rdot, delta, phase, selong, sangle, vangle, trueanomaly,
+          tmtp, and pid of each detection.
+
+        Returns
+        -------
+        foundids : list of int
+          foundid of each detection.
+
+        """
+
+        import numpy as np
         from astropy.time import Time
+
         now = Time.now().iso[: -4]
+        tol = self.config.get('found tolerance', 1.0) / 3600
+        found = [list(f) for f in found]
+
+        # small-angle offset, RA wrapped at 0/360
+        n = self.db.executemany('''
+            DELETE FROM found WHERE desg=:desg AND pid=:pid
+              AND ((min(abs(ra - :ra), 360 - abs(ra - :ra)) * :cosdec)
+                   * (min(abs(ra - :ra), 360 - abs(ra - :ra)) * :cosdec)
+                   + (dec - :dec) * (dec - :dec)) > :tol2
+            ''', [{'desg': f[0], 'pid': f[18], 'ra': f[2], 'dec': f[3],
+                   'cosdec': np.cos(np.radians(f[3])), 'tol2': tol**2}
+                  for f in found]).rowcount
+        if n > 0:
+            self.logger.debug(
+                '{} detections moved, products reset.'.format(n))
+
         self.db.executemany('''
-            INSERT OR REPLACE INTO found
+            UPDATE found SET
+              obsjd=?,ra=?,dec=?,dra=?,ddec=?,ra3sig=?,dec3sig=?,vmag=?,
+              rh=?,rdot=?,delta=?,phase=?,selong=?,sangle=?,vangle=?,
+              trueanomaly=?,tmtp=?,retrieved=?
+            WHERE desg=? AND pid=?
+            ''', [f[1:18] + [now, f[0], f[18]] for f in found])
+
+        self.db.executemany('''
+            INSERT OR IGNORE INTO found
             (desg,obsjd,ra,dec,dra,ddec,ra3sig,dec3sig,vmag,rh,rdot,delta,
              phase,selong,sangle,vangle,trueanomaly,tmtp,pid,x,y,retrieved,
              archivefile,sci_sync_date,sciimg,mskimg,scipsf,diffimg,diffpsf)
@@ -675,6 +1683,39 @@ class ZChecker:
             ''', [f + [now] for f in found])
         self.db.commit()
 
+        pids = sorted(set([f[18] for f in found]))
+        foundids = {}
+        for i in range(0, len(pids), 500):
+            chunk = pids[i:i + 500]
+            rows = self.db.execute('''
+            SELECT desg,pid,foundid FROM found WHERE pid IN ({})
+            '''.format(','.join('?' * len(chunk))), chunk)
+            foundids.update([((row['desg'], row['pid']), row['foundid'])
+                             for row in rows])
+        return [foundids[(f[0], f[18])] for f in found]
+
+    def update_cutout_meta(self, foundid, meta):
+        """Insert or update cutout metadata.
+
+        Parameters
+        ----------
+        foundid : int
+          Found object ID.
+        meta : dict
+          cutout_meta column names and values, see `cutout.meta`.
+
+        """
+
+        columns = sorted(meta)
+        self.db.execute('''
+        INSERT OR IGNORE INTO cutout_meta (foundid) VALUES (?)
+        ''', [foundid])
+        self.db.execute(
+            'UPDATE cutout_meta SET '
+            + ','.join([c + '=?' for c in columns])
+            + ' WHERE foundid=?',
+            [meta[c] for c in columns] + [foundid])
+
     def _fov_follow_up(self, follow_up, found_objects):
         """Check objects and FOVs in follow_up and update found_objects."""
         for obj, fovs in follow_up.items():
@@ -683,7 +1724,7 @@ class ZChecker:
             for i in range(0, len(fovs), 100):
                 found.extend(self._silicon_test(obj, fovs[i: i + 100]))
 
-            if len(found) is 0:
+            if len(found) == 0:
                 continue
 
             print('  Found', len(found), 'epochs for', obj)
@@ -723,30 +1764,84 @@ class ZChecker:
             return False
 
     def download_cutouts(self, desg=None, clean_failed=True,
-                         retry_failed=True):
+                         retry_failed=True, skip_flagged=False,
+                         foundids=None):
+        """Download cutouts of found objects.
+
+        Pending cutouts are grouped by image (pid).  The science
+        image, mask, and PSF are requested once for each group, as a
+        single cutout covering all targets, or as the full quadrant,
+        and the cutout for each target is extracted locally, see
+        `cutout_plan`.  Targets far apart on a sparsely used image are
+        requested separately.
+
+        Quadrant-level products, i.e., PSFs and full masks, are kept in
+        a local `ProductCache`, and reused by later cutouts of the
+        same image.  Configure with "cache path" (default: a
+        .product-cache directory in the cutout path) and "cache size"
+        (MiB, default: 2048).
+
+        Cutouts are assembled in memory and written once, in the
+        format given by "cutout format": 'gzip' (default), 'rice', or
+        'none', see `zchecker.cutout`.
+
+        Parameters
+        ----------
+        desg : string, optional
+          Only download cutouts for this target.
+        clean_failed : bool, optional
+          Remove the temporary files (in /tmp) left by failed
+          downloads; set to `False` to inspect them.
+        retry_failed : bool, optional
+          Retry previously failed downloads.
+        skip_flagged : bool, optional
+          Skip images with non-zero infobits, which zstack does not
+          use.
+        foundids : list of int, optional
+          Only download cutouts for these detections.
+
+        """
+
         import os
+        from itertools import groupby
         from tempfile import mktemp
         import numpy as np
         import astropy.units as u
         from astropy.io import fits
         from astropy.time import Time
         from astropy.wcs import WCS
+        from astropy.coordinates import SkyCoord
+        from astropy.nddata import Cutout2D, NoOverlapError
         from .ztf import IRSA
+        from .cache import ProductCache
+        from . import cutout
+        from . import profiling
 
         path = self.config['cutout path'] + os.path.sep
         if not os.path.exists(path):
             os.system('mkdir ' + path)
 
+        cache = ProductCache(
+            self.config.get('cache path', path + '.product-cache'),
+            self.config.get('cache size', 2048))
+
+        fmt = self.config.get('cutout format', 'gzip')
         fntemplate = os.path.join(
-            '{desg}', '{desg}-{datetime}-{prepost}{rh:.3f}-ztf.fits.gz')
+            '{desg}', '{desg}-{datetime}-{prepost}{rh:.3f}-ztf'
+            + cutout.suffix(fmt))
 
         if desg is None:
             desg_constraint = ''
             parameters = []
         else:
-            desg_constraint = ' AND desg=? '
+            desg_constraint = ' AND found.desg=? '
             parameters = [desg]
 
+        if foundids is not None:
+            desg_constraint += ' AND found.foundid IN ({}) '.format(
+                ','.join('?' * len(foundids)))
+            parameters.extend(foundids)
+
         if retry_failed:
             sync_constraint = ''
         else:
@@ -757,166 +1852,297 @@ class ZChecker:
             ''' + sync_constraint + desg_constraint, parameters
                                 ).fetchone()[0]
 
+        if skip_flagged:
+            sync_constraint += '''AND found.pid IN (
+              SELECT pid FROM obs WHERE infobits=0) '''
+            n = count
+            count = self.db.execute('''
+                SELECT count() FROM found
+                WHERE sciimg=0
+                ''' + sync_constraint + desg_constraint, parameters
+                                    ).fetchone()[0]
+            self.logger.info(
+                'Skipping {} cutouts of flagged images.'.format(n - count))
+
         if count == 0:
             self.logger.info('No cutouts to download.')
             return
 
         self.logger.info('Downloading {} cutouts.'.format(count))
+        ncutouts = count
 
         rows = self.fetch_iter('''
-        SELECT * FROM foundobs
+        SELECT found.*,url FROM found
+        INNER JOIN foundcat ON found.foundid=foundcat.foundid
         WHERE sciimg=0
         ''' + sync_constraint + '''
-        ''' + desg_constraint, parameters)
+        ''' + desg_constraint + '''
+        ORDER BY found.pid''', parameters)
+
+        stats = {'requests': 0, 'bytes': 0}
+
+        def download(url, filename, clean_failed):
+            with profiling.span('download'):
+                downloaded = self._download_file(irsa, url, filename,
+                                                 clean_failed=clean_failed)
+            stats['requests'] += 1
+            if downloaded:
+                stats['bytes'] += os.path.getsize(filename)
+            return downloaded
 
         with IRSA(path, self.config.auth) as irsa:
-            for row in rows:
-                # check if target cutout directory exists
-                d = desg2file(row['desg'])
-                if not os.path.exists(path + d):
-                    os.system('mkdir ' + path + d)
-
-                prepost = 'pre' if row['rdot'] < 0 else 'post'
-                sync_date = Time(float(row['obsjd']), format='jd').iso
-                t = sync_date.replace('-', '').replace(
-                    ':', '').replace(' ', '_')[:15]
-                fn = fntemplate.format(
-                    desg=d, prepost=prepost, rh=row['rh'],
-                    datetime=t)
-
-                if os.path.exists(path + fn):
-                    self.logger.error(
-                        path + fn +
-                        ' exists, but was not expected.  Removing.'
-                    )
-                    os.unlink(path + fn)
-
-                sciurl = row['url'] + '&size=5arcmin'
-                sci_downloaded = self._download_file(
-                    irsa, sciurl, path + fn, clean_failed=clean_failed)
-                if not sci_downloaded:
-                    self.db.execute('''
-                    UPDATE found SET
-                      sci_sync_date=?,
-                      sciimg=0,
-                      mskimg=0,
-                      scipsf=0,
-                      diffimg=0,
-                      diffpsf=0
-                    WHERE foundid=?
-                    ''', (sync_date, row['foundid']))
-                    self.db.commit()
-                    continue
+            for pid, group in groupby(rows, lambda row: row['pid']):
+                group = list(group)
+                baseurl = irsa.rebase(group[0]['url'])
+                baseurl = baseurl[:baseurl.rfind('?')]
+
+                psffn = cache.get(pid, 'sciimgdaopsfcent')
+                psf_downloaded = psffn is not None
+                if not psf_downloaded:
+                    psffn = mktemp(dir='/tmp')
+                    psf_downloaded = download(
+                        baseurl.replace('sciimg', 'sciimgdaopsfcent'),
+                        psffn, clean_failed=clean_failed)
+                    if psf_downloaded:
+                        psffn = cache.put(pid, 'sciimgdaopsfcent', psffn)
+                if psf_downloaded:
+                    psf = fits.getdata(psffn, memmap=False)
 
-                updates = {
-                    'desg': (row['desg'], 'Target designation'),
-                    'obsjd': (row['obsjd'], 'Shutter start time'),
-                    'rh': (row['rh'], 'Heliocentric distance, au'),
-                    'delta': (row['delta'], 'Observer-target distance, au'),
-                    'phase': (row['phase'], 'Sun-target-observer angle, deg'),
-                    'rdot': (row['rdot'], 'Heliocentric radial velocity, km/s'),
-                    'selong': (row['selong'], 'Solar elongation, deg'),
-                    'sangle': (row['sangle'], 'Projected target->Sun position angle, deg'),
-                    'vangle': (row['vangle'], 'Projected velocity position angle, deg'),
-                    'trueanom': (row['trueanomaly'], 'True anomaly (osculating), deg'),
-                    'tmtp': (row['tmtp'], 'T-Tp (osculating), days'),
-                    'tgtra': (row['ra'], 'Target RA, deg'),
-                    'tgtdec': (row['dec'], 'Target Dec, deg'),
-                    'tgtdra': (row['dra'], 'Target RA*cos(dec) rate of change, arcsec/s'),
-                    'tgtddec': (row['ddec'], 'Target Dec rate of change, arcsec/s'),
-                    'tgtrasig': (row['ra3sig'], 'Target RA 3-sigma uncertainty, arcsec'),
-                    'tgtdesig': (row['dec3sig'], 'Target Dec 3-sigma uncertainty, arcsec'),
-                    'foundid': (row['foundid'], 'ZChecker DB foundid'),
-                }
-
-                maskfn = mktemp(dir='/tmp')
-                _url = sciurl.replace('sciimg', 'mskimg')
-                mask_downloaded = self._download_file(
-                    irsa, _url, maskfn, clean_failed=clean_failed)
-
-                psffn = mktemp(dir='/tmp')
-                _url = sciurl.replace('sciimg', 'sciimgdaopsfcent')
-                _url = _url[:_url.rfind('?')]
-                psf_downloaded = self._download_file(
-                    irsa, _url, psffn, clean_failed=True)
-
-                difffn = mktemp(dir='/tmp')
-                #_url = sciurl.replace('sciimg.fits', 'scimrefdiffimg.fits.fz')
-                # diff_downloaded = self._download_file(
-                #    irsa, _url, difffn, clean_failed=True)
+                # diff images are not yet retrieved:
+                #   sciimg.fits -> scimrefdiffimg.fits.fz
+                #   sciimg -> diffimgpsf
                 diff_downloaded = False
-
-                diffpsffn = mktemp(dir='/tmp')
-                #_url = sciurl.replace('sciimg', 'diffimgpsf')
-                # if diff_downloaded:  # no need to DL PSF if diff not DL'ed
-                #    diffpsf_downloaded = self._download_file(
-                #        irsa, _url, diffpsffn, clean_failed=True)
-                # else:
-                #    diffpsf_downloaded = False
                 diffpsf_downloaded = False
 
-                # update header and add mask and PSF
-                with fits.open(path + fn, 'update') as hdu:
-                    hdu[0].name = 'sci'
-
-                    wcs = WCS(hdu[0].header)
-                    x, y = wcs.all_world2pix(
-                        row['ra'] * u.deg, row['dec'] * u.deg, 0)
-                    updates['tgtx'] = int(
-                        x), 'Target x coordinate, 0-based'
-                    updates['tgty'] = int(
-                        y), 'Target y coordinate, 0-based'
-
-                    try:
-                        hdu[0].header.update(updates)
-                    except ValueError as e:
-                        self.logger.error('Error creating FITS header for foundid {}: {}'.format(row['foundid'], str(e)))
-                        hdu.close()
-                        continue
+                plan = cutout_plan([row['ra'] for row in group],
+                                   [row['dec'] for row in group])
+                for ra, dec, size, members in plan:
+                    if ra is None:
+                        sciurl = baseurl
+                    else:
+                        sciurl = '{}?center={:f},{:f}deg&size={:.4g}arcmin'.format(
+                            baseurl, ra, dec, size)
+
+                    scifn = mktemp(dir='/tmp')
+                    sci_downloaded = download(sciurl, scifn,
+                                              clean_failed=clean_failed)
+                    mask_downloaded = False
+                    if sci_downloaded:
+                        with fits.open(scifn, memmap=False) as hdu:
+                            sci = fits.PrimaryHDU(hdu[0].data, hdu[0].header)
+                        os.unlink(scifn)
+                        wcs = WCS(sci.header)
+
+                        # use the full mask, if cached
+                        fullmaskfn = cache.get(pid, 'mskimg')
+                        if fullmaskfn is not None:
+                            with fits.open(fullmaskfn) as hdu:
+                                i = image_slices(hdu[0].header, sci.header)
+                                if i is not None:
+                                    mask = hdu[0].data[i].copy()
+                                    mask_header = hdu[0].header.copy()
+                                    mask_header['CRPIX1'] -= i[1].start
+                                    mask_header['CRPIX2'] -= i[0].start
+                                    mask_downloaded = True
+
+                    if sci_downloaded and not mask_downloaded:
+                        maskfn = mktemp(dir='/tmp')
+                        mask_downloaded = download(
+                            sciurl.replace('sciimg', 'mskimg'), maskfn,
+                            clean_failed=clean_failed)
+                        if mask_downloaded:
+                            mask, mask_header = fits.getdata(
+                                maskfn, header=True, memmap=False)
+                            if ra is None:
+                                cache.put(pid, 'mskimg', maskfn)
+                            else:
+                                os.unlink(maskfn)
+
+                    for row in [group[i] for i in members]:
+                        prepost = 'pre' if row['rdot'] < 0 else 'post'
+                        sync_date = Time(float(row['obsjd']), format='jd').iso
+                        t = sync_date.replace('-', '').replace(
+                            ':', '').replace(' ', '_')[:15]
+                        fn = fntemplate.format(
+                            desg=desg2file(row['desg']), prepost=prepost,
+                            rh=row['rh'], datetime=t)
+
+                        if not sci_downloaded:
+                            self.db.execute('''
+                            UPDATE found SET
+                              sci_sync_date=?,
+                              sciimg=0,
+                              mskimg=0,
+                              scipsf=0,
+                              diffimg=0,
+                              diffpsf=0
+                            WHERE foundid=?
+                            ''', (sync_date, row['foundid']))
+                            count -= 1
+                            continue
+
+                        # check if target cutout directory exists
+                        d = os.path.dirname(path + fn)
+                        if not os.path.exists(d):
+                            os.system('mkdir ' + d)
+
+                        if os.path.exists(path + fn):
+                            self.logger.error(
+                                path + fn +
+                                ' exists, but was not expected.  Removing.'
+                            )
+                            os.unlink(path + fn)
+
+                        header = sci.header.copy()
+                        if len(members) == 1:
+                            data = sci.data
+                            if mask_downloaded:
+                                mask_data = mask
+                                mask_hdr = mask_header
+                        else:
+                            try:
+                                sub = Cutout2D(
+                                    sci.data,
+                                    SkyCoord(row['ra'], row['dec'],
+                                             unit='deg'),
+                                    5 * u.arcmin, wcs=wcs, mode='trim')
+                            except NoOverlapError:
+                                self.logger.error(
+                                    'Target not in image for foundid {}.'.format(
+                                        row['foundid']))
+                                count -= 1
+                                continue
+
+                            data = sub.data
+                            header['CRPIX1'] -= sub.xmin_original
+                            header['CRPIX2'] -= sub.ymin_original
+                            if mask_downloaded:
+                                mask_data = mask[sub.slices_original]
+                                mask_hdr = mask_header.copy()
+                                mask_hdr['CRPIX1'] -= sub.xmin_original
+                                mask_hdr['CRPIX2'] -= sub.ymin_original
+
+                        updates = {
+                            'desg': (row['desg'], 'Target designation'),
+                            'obsjd': (row['obsjd'], 'Shutter start time'),
+                            'rh': (row['rh'], 'Heliocentric distance, au'),
+                            'delta': (row['delta'], 'Observer-target distance, au'),
+                            'phase': (row['phase'], 'Sun-target-observer angle, deg'),
+                            'rdot': (row['rdot'], 'Heliocentric radial velocity, km/s'),
+                            'selong': (row['selong'], 'Solar elongation, deg'),
+                            'sangle': (row['sangle'], 'Projected target->Sun position angle, deg'),
+                            'vangle': (row['vangle'], 'Projected velocity position angle, deg'),
+                            'trueanom': (row['trueanomaly'], 'True anomaly (osculating), deg'),
+                            'tmtp': (row['tmtp'], 'T-Tp (osculating), days'),
+                            'tgtra': (row['ra'], 'Target RA, deg'),
+                            'tgtdec': (row['dec'], 'Target Dec, deg'),
+                            'tgtdra': (row['dra'], 'Target RA*cos(dec) rate of change, arcsec/s'),
+                            'tgtddec': (row['ddec'], 'Target Dec rate of change, arcsec/s'),
+                            'tgtrasig': (row['ra3sig'], 'Target RA 3-sigma uncertainty, arcsec'),
+                            'tgtdesig': (row['dec3sig'], 'Target Dec 3-sigma uncertainty, arcsec'),
+                            'foundid': (row['foundid'], 'ZChecker DB foundid'),
+                        }
+
+                        x, y = WCS(header).all_world2pix(
+                            row['ra'] * u.deg, row['dec'] * u.deg, 0)
+                        updates['tgtx'] = int(
+                            x), 'Target x coordinate, 0-based'
+                        updates['tgty'] = int(
+                            y), 'Target y coordinate, 0-based'
 
-                    if mask_downloaded:
-                        with fits.open(maskfn) as mask:
-                            mask[0].name = 'mask'
-                            hdu.append(mask[0])
+                        try:
+                            header.update(updates)
+                        except ValueError as e:
+                            self.logger.error('Error creating FITS header for foundid {}: {}'.format(row['foundid'], str(e)))
+                            count -= 1
+                            continue
+
+                        with profiling.span('cutout write'):
+                            hdu = cutout.assemble(
+                                data, header,
+                                mask=mask_data if mask_downloaded else None,
+                                mask_header=(mask_hdr if mask_downloaded
+                                             else None),
+                                psf=psf if psf_downloaded else None,
+                                fmt=fmt)
+                            cutout.write(hdu, path + fn, fmt=fmt)
+
+                        # previous projection, if any, is now stale
+                        meta = cutout.meta(header)
+                        meta.update(dict.fromkeys(cutout.PROJECTION))
+                        self.update_cutout_meta(row['foundid'], meta)
+
+                        self.db.execute('''
+                        UPDATE found SET
+                          archivefile=?,
+                          sci_sync_date=?,
+                          sciimg=?,
+                          mskimg=?,
+                          scipsf=?,
+                          diffimg=?,
+                          diffpsf=?
+                        WHERE foundid=?
+                        ''', (fn, sync_date, sci_downloaded, mask_downloaded,
+                              psf_downloaded, diff_downloaded,
+                              diffpsf_downloaded, row['foundid']))
+
+                        self.logger.info('  [{}] {}'.format(
+                            count, os.path.basename(fn)))
+                        count -= 1
 
-                    if psf_downloaded:
-                        with fits.open(psffn) as psf:
-                            psf[0].name = 'psf'
-                            hdu.append(psf[0])
+                self.db.commit()
 
-                    if diff_downloaded:
-                        with fits.open(difffn) as diff:
-                            diff[0].name = 'diff'
-                            hdu.append(psf[0])
+        self.logger.info(
+            'IRSA: {} requests for {} cutouts ({} without grouping by'
+            ' image), {:.1f} MiB downloaded.'.format(
+                stats['requests'], ncutouts, 3 * ncutouts,
+                stats['bytes'] / 2**20))
+        self.logger.info(
+            'Product cache: {} hits, {} misses, {} files evicted.'.format(
+                cache.hits, cache.misses, cache.evicted))
 
-                    if diffpsf_downloaded:
-                        with fits.open(diffpsffn) as diffpsf:
-                            diffpsf[0].name = 'diff_psf'
-                            hdu.append(psf[0])
 
-                for f in (maskfn, psffn, difffn, diffpsffn):
-                    if os.path.exists(f):
-                        os.unlink(f)
+_numpy_adapted = False
 
-                self.db.execute('''
-                UPDATE found SET
-                  archivefile=?,
-                  sci_sync_date=?,
-                  sciimg=?,
-                  mskimg=?,
-                  scipsf=?,
-                  diffimg=?,
-                  diffpsf=?
-                WHERE foundid=?
-                ''', (fn, sync_date, sci_downloaded, mask_downloaded,
-                      psf_downloaded, diff_downloaded, diffpsf_downloaded,
-                      row['foundid']))
 
-                self.db.commit()
+def _adapt_numpy():
+    """Register NumPy scalar adapters, once NumPy has been imported."""
+    import sys
+    import sqlite3
+    global _numpy_adapted
+
+    np = sys.modules.get('numpy')
+    if _numpy_adapted or np is None:
+        return
+
+    sqlite3.register_adapter(np.int64, int)
+    sqlite3.register_adapter(np.int32, int)
+    sqlite3.register_adapter(np.float64, float)
+    sqlite3.register_adapter(np.float32, float)
+    _numpy_adapted = True
 
-                self.logger.info('  [{}] {}'.format(
-                    count, os.path.basename(fn)))
-                count -= 1
+
+def _connect(filename):
+    """Open a database connection that accepts NumPy scalars.
+
+    NumPy is not imported here: any NumPy scalar passed as a parameter
+    means NumPy is already loaded, so the adapters are registered on
+    the first statement executed after that.
+
+    """
+
+    import sqlite3
+
+    class Connection(sqlite3.Connection):
+        def execute(self, *args):
+            _adapt_numpy()
+            return super().execute(*args)
+
+        def executemany(self, *args):
+            _adapt_numpy()
+            return super().executemany(*args)
+
+    return sqlite3.connect(filename, factory=Connection)
 
 
 def desg2file(s): return s.replace('/', '').replace(' ', '').lower()
@@ -982,7 +2208,129 @@ def spherical_mean(ra, dec):
     return np.arctan2(y, x), np.arctan2(z, np.hypot(x, y))
 
 
-def interior_test(ra, dec, ra_corners, dec_corners):
+def image_slices(header, cutout_header):
+    """Location of a cutout in its parent image.
+
+    Parameters
+    ----------
+    header, cutout_header : astropy.io.fits.Header
+      Parent image and cutout headers, with the same WCS but for the
+      reference pixel.
+
+    Returns
+    -------
+    slices : tuple of slice
+      Parent image slices, or `None` if the cutout is not fully
+      contained.
+
+    """
+
+    x0 = int(round(header['CRPIX1'] - cutout_header['CRPIX1']))
+    y0 = int(round(header['CRPIX2'] - cutout_header['CRPIX2']))
+    x1 = x0 + cutout_header['NAXIS1']
+    y1 = y0 + cutout_header['NAXIS2']
+    if (x0 < 0 or y0 < 0 or x1 > header['NAXIS1']
+            or y1 > header['NAXIS2']):
+        return None
+
+    return slice(y0, y1), slice(x0, x1)
+
+
+def cutout_plan(ra, dec, size=5, overhead=4, quad_size=52):
+    """Plan cutout requests for targets on the same image.
+
+    All targets are covered by one request when its area is at most
+    `overhead` times the total area of the individual cutouts,
+    otherwise each target is requested separately.  Covering
+    requests as large as the image are made for the full quadrant.
+
+    Parameters
+    ----------
+    ra, dec : array-like
+      Target positions, degrees.
+    size : float, optional
+      Target cutout size, arcmin.
+    overhead : float, optional
+      Maximum ratio of covering to individual cutout areas.
+    quad_size : float, optional
+      Size of a full quadrant image, arcmin.
+
+    Returns
+    -------
+    requests : list of tuples
+      (ra, dec, size, members): request center in degrees and size in
+      arcmin, all `None` for the full quadrant, and the indices of the
+      targets covered.
+
+    """
+
+    import numpy as np
+
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    n = len(ra)
+    if n == 1:
+        return [(np.degrees(ra[0]), np.degrees(dec[0]), size, [0])]
+
+    # extent of the targets in the tangent plane, plus a margin for
+    # image rotation
+    ra0, dec0 = spherical_mean(ra, dec)
+    cosc = (np.sin(dec0) * np.sin(dec)
+            + np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0))
+    xi = np.cos(dec) * np.sin(ra - ra0) / cosc
+    eta = (np.cos(dec0) * np.sin(dec)
+           - np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cosc
+    cover = (np.degrees(2 * max(np.abs(xi).max(), np.abs(eta).max())) * 60
+             + size + 0.5)
+
+    if min(cover, quad_size)**2 > overhead * n * size**2:
+        return [(np.degrees(ra[i]), np.degrees(dec[i]), size, [i])
+                for i in range(n)]
+    elif cover >= quad_size:
+        return [(None, None, None, list(range(n)))]
+    else:
+        return [(np.degrees(ra0) % 360, np.degrees(dec0), cover,
+                 list(range(n)))]
+
+
+def expand_corners(ra_corners, dec_corners, margin):
+    """Move rectangle corners away from the center.
+
+    Corners are moved by `margin * sqrt(2)`, so that all points within
+    `margin` of the original rectangle's edges are enclosed.
+
+    Parameters
+    ----------
+    ra_corners, dec_corners : array-like
+      Corners of the rectangle, in radians.
+    margin : float
+      Radians.
+
+    Returns
+    -------
+    ra_corners, dec_corners : ndarray
+      Radians.
+
+    """
+
+    import numpy as np
+    from astropy.coordinates.angle_utilities import (
+        angular_separation, position_angle)
+
+    ra_c = np.array(ra_corners)
+    dec_c = np.array(dec_corners)
+    ra0, dec0 = spherical_mean(ra_c, dec_c)
+    d = angular_separation(ra0, dec0, ra_c, dec_c) + margin * np.sqrt(2)
+    pa = position_angle(ra0, dec0, ra_c, dec_c).rad
+
+    dec = np.arcsin(np.sin(dec0) * np.cos(d)
+                    + np.cos(dec0) * np.sin(d) * np.cos(pa))
+    ra = ra0 + np.arctan2(np.sin(pa) * np.sin(d) * np.cos(dec0),
+                          np.cos(d) - np.sin(dec0) * np.sin(dec))
+    return ra % (2 * np.pi), dec
+
+
+def interior_test(ra, dec, ra_corners, dec_corners, margin=0):
     """Test if point is within rectangular field of view.
 
     Corner order does not matter.  Test does not rigorously consider
@@ -998,6 +2346,9 @@ def interior_test(ra, dec, ra_corners, dec_corners):
       RA corners of the rectangle, in radians.
     dec_corners: array-like
       Dec. corners of the rectangle, in radians.
+    margin: float, optional
+      Also accept points up to about this far outside the rectangle,
+      in radians.  See `expand_corners`.
 
     Returns
     -------
@@ -1011,6 +2362,8 @@ def interior_test(ra, dec, ra_corners, dec_corners):
 
     ra_c = np.array(ra_corners)
     dec_c = np.array(dec_corners)
+    if margin > 0:
+        ra_c, dec_c = expand_corners(ra_c, dec_c, margin)
 
     # check if interior using triangle tests
     # first triangle: vertex 0 and next two closest
@@ -2,14 +2,14 @@
 from contextlib import contextmanager
 
 def query(params, auth, logger=None):
-    import requests
     from astropy.io import ascii
+    from . import remote
     
     # https://irsa.ipac.caltech.edu/ibe/search/ztf/products/sci?WHERE=obsdate>'2017-12-05 12:00'+AND+obsdate<'2017-12-06 12:00'+AND+ccdid=6+AND+qid=4&ct=html
 
     print('Querying IRSA...')
-    r = requests.get(
-        'https://irsa.ipac.caltech.edu/ibe/search/ztf/products/sci',
+    r = remote.get(
+        'irsa', remote.service('irsa').url + '/ibe/search/ztf/products/sci',
         auth=(auth['user'], auth['password']),
         params=params)
 
@@ -35,29 +35,42 @@ class IRSA:
     auth : dictionary
       IRSA 'user' and 'password'.
 
+    url : string, optional
+      IRSA base URL, default is that of the 'irsa' remote service.
+
     """
     
-    def __init__(self, path, auth):
+    def __init__(self, path, auth, url=None):
+        from . import remote
         self.path = path
         self.auth = auth
+        self.url = remote.service('irsa').url if url is None else url
 
     def __enter__(self):
         url = (
-            "https://irsa.ipac.caltech.edu/account/signon/login.do?"
+            "{}/account/signon/login.do?"
             "josso_cmd=login&josso_username={}&josso_password={}"
-        ).format(self.auth['user'], self.auth['password'])
+        ).format(self.url, self.auth['user'], self.auth['password'])
 
         self._wget(url, '/dev/null', save_cookies=True)
 
         return self
 
     def __exit__(self, *args):
-        self._wget("https://irsa.ipac.caltech.edu/account/signon/logout.do",
+        self._wget(self.url + "/account/signon/logout.do",
                    '/dev/null', save_cookies=True)
 
+    def rebase(self, url):
+        """Point an IRSA URL at this connection's base URL."""
+        from . import remote
+        return url.replace(remote.urls['irsa'], self.url, 1)
+
     def download(self, url, fn):
         """Download from IRSA.
 
+        Requests are rate limited and transient failures are retried
+        by the 'irsa' remote service.
+
         url : string
           The full URL of the file.
 
@@ -66,26 +79,71 @@ class IRSA:
 
         """
         import os
-        from subprocess import CalledProcessError
-        from .exceptions import DownloadError
-        
+        from .exceptions import DownloadError, RemoteError
+
         try:
             self._wget(url, fn)
-        except CalledProcessError as e:
-            raise DownloadError from e
+        except RemoteError as e:
+            raise DownloadError(str(e)) from e
         except KeyboardInterrupt as e:
             os.unlink(fn)
             raise e
 
     def _wget(self, url, fn, save_cookies=False):
-        import sys
-        from subprocess import check_call
-
-        args = ['wget']
-        if save_cookies:
-            args.append('--save-cookies={}/cookies.txt'.format(self.path))
-        else:
-            args.append('--load-cookies={}/cookies.txt'.format(self.path))
-        args.extend(['-O', fn, '-o', '/dev/null', url])
-        
-        check_call(args, stdout=sys.stderr)
+        from . import remote
+        return remote.service('irsa').call(
+            wget, url, fn, self.path, save_cookies=save_cookies)
+
+
+def wget(url, fn, path, save_cookies=False):
+    """Retrieve a URL with wget.
+
+    Parameters
+    ----------
+    url : string
+    fn : string
+      Output file name.
+    path : string
+      Directory of the cookies.txt file.
+    save_cookies : bool, optional
+      Set to `True` to save cookies, otherwise they are loaded.
+
+    Raises
+    ------
+    RemoteError
+      On failure, with the HTTP status code of the last response, if
+      any.
+
+    """
+
+    import re
+    from subprocess import run, PIPE
+    from .exceptions import RemoteError
+
+    args = ['wget', '--tries=1', '-nv', '-S']
+    if save_cookies:
+        args.append('--save-cookies={}/cookies.txt'.format(path))
+    else:
+        args.append('--load-cookies={}/cookies.txt'.format(path))
+    args.extend(['-O', fn, url])
+
+    result = run(args, stdout=PIPE, stderr=PIPE)
+    if result.returncode == 0:
+        return
+
+    log = result.stderr.decode(errors='replace')
+    status = re.findall('HTTP/[0-9.]+ ([0-9]{3})', log)
+    status = int(status[-1]) if len(status) > 0 else None
+    retry_after = re.findall('Retry-After: ([0-9.]+)', log)
+    retry_after = float(retry_after[-1]) if len(retry_after) > 0 else None
+
+    if status is None and result.returncode != 4:
+        # not a network failure, e.g., a write error; not worth
+        # retrying
+        status = 0
+    elif status is not None and status < 400:
+        status = 0
+
+    raise RemoteError('wget exit status {}, HTTP status {}: {}'.format(
+        result.returncode, status, url), status=status,
+        retry_after=retry_after)